@@ -1,9 +1,13 @@
 import os
-from paste.deploy import loadapp
 from waitress import serve
 
+from sgreen2_web import main
+from sgreen2_web.startup import load_settings
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app = loadapp('config:production.ini', relative_to='.')
+    # builds the app straight from the package in this directory, so it doesn't have to be installed first
+    app = main({}, **load_settings('production.ini'))
+    server = load_settings('production.ini', 'server:main')
 
-    serve(app, host='0.0.0.0', port=port)
+    serve(app, host='0.0.0.0', port=port, threads=int(server.get('threads', 4)))
@@ -0,0 +1,13 @@
+import logging
+import sys
+
+from sgreen2_web.rollups import serve
+from sgreen2_web.startup import load_settings
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    config_file = sys.argv[1] if len(sys.argv) > 1 else 'production.ini'
+    settings = load_settings(config_file)
+
+    serve(settings)
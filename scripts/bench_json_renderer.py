@@ -0,0 +1,78 @@
+#!../venv/bin/python3
+import json
+import os
+import sys
+import timeit
+
+from bson import json_util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sgreen2_web import renderers
+
+
+def make_data_readings(count: int) -> list:
+    """
+    Makes data readings that look like what GET /data_readings pulls out of the database
+    :param count: how many data readings to make
+    :return: a list of data readings
+    """
+    start_time = 1500000000000
+
+    return [{
+        "timestamp": start_time + i * 1000,
+        "reading": 70.0 + (i % 100) / 10.0,
+        "sensor": {
+            "type": "batt",
+            "name": "batt" + str(i % 20).zfill(2)
+        },
+        "health": "good"
+    } for i in range(count)]
+
+
+def round_trip(data: list) -> str:
+    """
+    What the views used to do: json_util round trip, then Pyramid's json renderer
+    """
+    return json.dumps(json_util.loads(json_util.dumps(data)))
+
+
+def single_pass(data: list) -> bytes:
+    """
+    The BSON aware renderer with whichever JSON backend is installed
+    """
+    return renderers.dumps(data)
+
+
+def single_pass_stdlib(data: list) -> bytes:
+    """
+    The BSON aware renderer forced onto the standard library backend
+    """
+    return json.dumps(data, default=renderers.default, separators=(",", ":")).encode("utf-8")
+
+
+def bench(name: str, func, data: list, repeat: int) -> float:
+    best = min(timeit.repeat(lambda: func(data), number=1, repeat=repeat))
+    print("{:<20} {:>10.2f} ms".format(name, best * 1000))
+    return best
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 3:
+        print("Usage: " + sys.argv[0] + " [number of data readings] [repeat]")
+        exit(1)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    data = make_data_readings(count)
+
+    backend = "orjson" if renderers.orjson else "json"
+    print("{} data readings, best of {}, backend: {}".format(count, repeat, backend))
+
+    baseline = bench("json_util round trip", round_trip, data, repeat)
+    bench("single pass (json)", single_pass_stdlib, data, repeat)
+    best = bench("single pass", single_pass, data, repeat)
+
+    print("speedup: {:.1f}x".format(baseline / best))
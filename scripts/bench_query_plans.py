@@ -0,0 +1,293 @@
+#!../venv/bin/python3
+"""
+Seeds a scratch database with realistic volumes, runs the query behind every endpoint,
+records its latency and winning plan, and fails if a query scans a whole collection or sorts in memory.
+
+Usage: bench_query_plans.py [configfile] [--mongo-uri URI] [--database NAME] [--days DAYS] [--output FILE]
+"""
+import argparse
+import configparser
+import json
+import random
+import statistics
+import sys
+import time
+
+import pymongo
+from bson import ObjectId
+from pymongo import MongoClient
+
+from reinitialize_db import add_actuators, create_indexes
+from sgreen2_web.rollups import TIERS, bucket_pipeline, roll_up
+
+# stages that mean the query isn't served by an index
+BAD_STAGES = {"COLLSCAN", "SORT", "SORT_KEY_GENERATOR"}
+
+SENSOR_TYPES = ["soil", "temp", "humid", "batt", "fanspeed"]
+
+MINUTE = 60 * 1000
+DAY = 24 * 60 * MINUTE
+
+
+def seed(db, config: configparser.ConfigParser, days: float, sensors_per_type: int) -> int:
+    """
+    Fills the scratch database with actuators, a state log, data readings, server states and settings
+    :param db: the scratch database
+    :param config: the db_config.ini configuration parser
+    :param days: how many days of history to make
+    :param sensors_per_type: how many sensors of each type report once a minute
+    :return: the timestamp the history ends at
+    """
+    for collection in ["actuators", "actuators_state_log", "data_readings", "greenhouse_server_uptime", "settings",
+                       "counters", "rollup_state"] + [tier.collection for tier in TIERS]:
+        db[collection].drop()
+
+    add_actuators(db, config)
+    create_indexes(db)
+
+    end_time = int(time.time()) * 1000
+    start_time = end_time - int(days * DAY)
+
+    # a data reading from every sensor every minute
+    batch = list()
+    for timestamp in range(start_time, end_time, MINUTE):
+        for sensor_type in SENSOR_TYPES:
+            for i in range(sensors_per_type):
+                batch.append({
+                    "timestamp": timestamp,
+                    "reading": random.uniform(0, 100),
+                    "sensor": {"type": sensor_type, "name": sensor_type + str(i + 1).zfill(2)}
+                })
+
+        if len(batch) >= 10000:
+            db.data_readings.insert_many(batch, ordered=False)
+            batch = list()
+
+    if batch:
+        db.data_readings.insert_many(batch, ordered=False)
+
+    # every actuator switches a few times an hour
+    names = [actuator["name"] for actuator in db.actuators.find(projection={"name": 1})]
+    db.actuators_state_log.insert_many([{
+        "name": name,
+        "to_state": bool(i % 2),
+        "timestamp": timestamp
+    } for name in names for i, timestamp in enumerate(range(start_time, end_time, 15 * MINUTE))], ordered=False)
+
+    # the greenhouse server is up for 6 hours, then down for 10 minutes
+    db.greenhouse_server_uptime.insert_many([{
+        "start_time": timestamp,
+        "end_time": timestamp + 6 * 60 * MINUTE,
+        "pings": 6 * 60
+    } for timestamp in range(start_time, end_time, 6 * 60 * MINUTE + 10 * MINUTE)], ordered=False)
+
+    db.settings.insert_one({"version": 1})
+
+    # every tier rolled up to the end of the history like runrollups.py would, except the last hour
+    roll_up(db, 60 * MINUTE, int(days * 24 * 60), end_time)
+
+    return end_time
+
+
+def get_queries(db, end_time: int) -> list:
+    """
+    The queries the views make, with the widest time range the history allows.
+    Keep these in step with sgreen2_web/views/
+    :param db: the scratch database
+    :param end_time: the timestamp the history ends at
+    :return: a list of (name, function that runs the query, function that explains the query)
+    """
+    start_time = end_time - DAY
+    page_size = 1000
+    last_id = ObjectId()
+
+    readings_filter = {"sensor.type": "temp", "timestamp": {"$gte": start_time, "$lte": end_time}}
+    readings_sort = [("sensor.name", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+    readings_next_page = dict(readings_filter, **{"$or": [
+        {"sensor.name": {"$gt": "temp01"}},
+        {"sensor.name": "temp01", "timestamp": {"$lt": end_time - 60 * MINUTE}},
+        {"sensor.name": "temp01", "timestamp": end_time - 60 * MINUTE, "_id": {"$lt": last_id}}
+    ]})
+
+    state_log_filter = {"name": "fan01", "timestamp": {"$gte": start_time, "$lte": end_time}}
+    state_log_sort = [("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+
+    rollups_filter = {"sensor.type": "temp", "timestamp": {"$gte": start_time, "$lte": end_time,
+                                                           "$lt": end_time - 60 * MINUTE}}
+    rollups_sort = [("sensor.name", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)]
+
+    def find(collection, query, **kwargs):
+        return (lambda: list(db[collection].find(query, **kwargs)),
+                lambda: db[collection].find(query, **kwargs).explain())
+
+    def aggregate(collection, pipeline):
+        return (lambda: list(db[collection].aggregate(pipeline)),
+                lambda: db.command("aggregate", collection, pipeline=pipeline, explain=True))
+
+    return [
+        ("GET /actuators",) + find("actuators", {}, projection={"_id": 0},
+                                   sort=[("type", pymongo.ASCENDING), ("name", pymongo.ASCENDING)]),
+        ("GET /actuators (version)",) + find("actuators", {}, projection={"_id": 0, "version": 1},
+                                             sort=[("version", pymongo.DESCENDING)], limit=1),
+        ("GET /actuators?since_version",) + find("actuators",
+                                                 {"$or": [{"version": {"$gt": 10}}, {"version_pending": True}]},
+                                                 projection={"_id": 0, "version_pending": 0},
+                                                 sort=[("type", pymongo.ASCENDING), ("name", pymongo.ASCENDING)]),
+        ("actuator by name",) + find("actuators", {"name": "fan01"}, limit=1),
+        ("PUT /actuators/{name}/state",) + find("actuators", {"name": "fan01", "state": {"$ne": True}}, limit=1),
+        ("GET /actuators/{name}/state",) + find("actuators_state_log", state_log_filter, sort=state_log_sort,
+                                                limit=page_size + 1),
+        ("duty cycle (state before range)",) + find("actuators_state_log",
+                                                    {"name": "fan01", "timestamp": {"$lt": start_time}},
+                                                    sort=state_log_sort, limit=1),
+        ("duty cycle (state after start)",) + find("actuators_state_log",
+                                                   {"name": "fan01", "timestamp": {"$gte": start_time}},
+                                                   sort=[("timestamp", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                                                   limit=1),
+        ("duty cycle (state log)",) + find("actuators_state_log", state_log_filter,
+                                           sort=[("timestamp", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]),
+        ("GET /actuators/duty_cycle",) + find("actuators", {"type": "fan"}, projection={"_id": 0},
+                                              sort=[("type", pymongo.ASCENDING), ("name", pymongo.ASCENDING)]),
+        ("GET /data_readings",) + find("data_readings", readings_filter, sort=readings_sort, limit=page_size + 1),
+        ("GET /data_readings (next page)",) + find("data_readings", readings_next_page, sort=readings_sort,
+                                                   limit=page_size + 1),
+        ("GET /data_readings/aggregate",) + aggregate("data_readings", bucket_pipeline(
+            "temp", {"$gte": start_time, "$lte": end_time}, 5 * MINUTE)),
+        ("GET /data_readings?resolution=1h",) + find("data_readings_1h", rollups_filter, projection={"_id": 0},
+                                                     sort=rollups_sort, limit=page_size + 1),
+        ("GET /data_readings?resolution (recent)",) + aggregate("data_readings", bucket_pipeline(
+            "temp", {"$gte": end_time - 60 * MINUTE, "$lte": end_time}, 60 * MINUTE)),
+        ("rollup (high-water mark)",) + find("rollup_state", {"_id": "1h"}, limit=1),
+        ("rollup (1m)",) + aggregate("data_readings", bucket_pipeline(
+            "temp", {"$gte": end_time - 60 * MINUTE, "$lt": end_time}, MINUTE)),
+        ("rollup (1h from 1m)",) + aggregate("data_readings_1m", bucket_pipeline(
+            "temp", {"$gte": start_time, "$lt": end_time}, 60 * MINUTE, rolled_up=True)),
+        ("GET /data_readings/stream (missed)",) + find("data_readings", {"sensor.type": "temp",
+                                                                         "timestamp": {"$gte": end_time - 5000},
+                                                                         "_id": {"$ne": last_id}},
+                                                       sort=[("timestamp", pymongo.ASCENDING),
+                                                             ("_id", pymongo.ASCENDING)],
+                                                       limit=page_size),
+        ("live feed (start)",) + find("data_readings", {"sensor.type": "temp", "timestamp": {"$gte": end_time - 5000}},
+                                      projection={"timestamp": 1}),
+        ("GET /actuators/{name}/state/watch",) + find("actuators_state_log",
+                                                      {"name": "fan01", "timestamp": {"$gte": end_time - 5000}},
+                                                      sort=[("timestamp", pymongo.ASCENDING),
+                                                            ("_id", pymongo.ASCENDING)],
+                                                      limit=page_size),
+        ("GET /greenhouse_server_state",) + find("greenhouse_server_uptime",
+                                                 {"end_time": {"$gte": start_time}, "start_time": {"$lte": end_time}},
+                                                 sort=[("end_time", pymongo.DESCENDING)]),
+        ("POST /greenhouse_server_state (new interval)",) + find("greenhouse_server_uptime",
+                                                                 {"previous_id": last_id}, limit=1),
+        ("POST /greenhouse_server_state",) + find("greenhouse_server_uptime",
+                                                  {"end_time": {"$gte": end_time - 2 * MINUTE}},
+                                                  sort=[("end_time", pymongo.DESCENDING)], limit=1),
+        ("GET /settings",) + find("settings", {}, sort=[("_id", pymongo.DESCENDING)], limit=1),
+        ("counter",) + find("counters", {"_id": "actuators_version"}, limit=1),
+    ]
+
+
+def get_winning_stages(explain) -> list:
+    """
+    Collects the stage names of every winning plan in an explain result, including aggregation explains
+    :param explain: the explain output
+    :return: a list of stage names
+    """
+    stages = list()
+
+    def walk_plan(plan):
+        if isinstance(plan, dict):
+            if "stage" in plan:
+                stages.append(plan["stage"])
+            for value in plan.values():
+                walk_plan(value)
+        elif isinstance(plan, list):
+            for value in plan:
+                walk_plan(value)
+
+    def find_winning_plans(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "winningPlan":
+                    walk_plan(value)
+                else:
+                    find_winning_plans(value)
+        elif isinstance(node, list):
+            for value in node:
+                find_winning_plans(value)
+
+    find_winning_plans(explain)
+
+    return stages
+
+
+def run(db, end_time: int, repeat: int) -> list:
+    """
+    Times and explains every query
+    :param db: the scratch database
+    :param end_time: the timestamp the history ends at
+    :param repeat: how many times to run each query
+    :return: a list of results
+    """
+    results = list()
+
+    for name, query, explain in get_queries(db, end_time):
+        latencies = list()
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        latencies.sort()
+        stages = get_winning_stages(explain())
+
+        results.append({
+            "query": name,
+            "median_ms": round(statistics.median(latencies), 3),
+            "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))], 3),
+            "winning_plan": stages,
+            "ok": not BAD_STAGES.intersection(stages)
+        })
+
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Checks the query plan and latency of every endpoint's query")
+    arg_parser.add_argument("configfile", help="db_config.ini, used for the actuators")
+    arg_parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    arg_parser.add_argument("--database", default="greenhouse_bench", help="scratch database, it is dropped")
+    arg_parser.add_argument("--days", type=int, default=7, help="days of history to seed")
+    arg_parser.add_argument("--sensors-per-type", type=int, default=4)
+    arg_parser.add_argument("--repeat", type=int, default=20, help="times to run each query")
+    arg_parser.add_argument("--no-seed", action="store_true", help="reuse the data from the last run")
+    arg_parser.add_argument("--output", help="write the results as JSON to this file")
+    args = arg_parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.configfile)
+
+    db = MongoClient(args.mongo_uri)[args.database]
+
+    if args.no_seed:
+        latest = db.data_readings.find_one(sort=[("timestamp", pymongo.DESCENDING)])
+        end_time = latest["timestamp"] + 1
+    else:
+        end_time = seed(db, config, args.days, args.sensors_per_type)
+
+    results = run(db, end_time, args.repeat)
+
+    for result in results:
+        print("{:<34} {:>9.2f} ms {:>9.2f} ms  {:<4} {}".format(result["query"], result["median_ms"],
+                                                                result["p95_ms"], "ok" if result["ok"] else "FAIL",
+                                                                " > ".join(result["winning_plan"])))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if not all(result["ok"] for result in results):
+        print("some queries scan a whole collection or sort in memory")
+        sys.exit(1)
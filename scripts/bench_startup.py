@@ -0,0 +1,92 @@
+#!../venv/bin/python3
+"""
+Measures how long a fresh process takes to import the app, configure it and answer its first request,
+with the views scanned or registered by hand and with or without warm-up.
+Every sample is a new interpreter so nothing is already imported.
+
+Usage: bench_startup.py [--ini FILE] [--repeat N] [--warm-up] [--output FILE]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# runs in the fresh interpreter and prints its timings as JSON
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+
+from sgreen2_web import main
+from sgreen2_web.startup import load_settings
+imported = time.perf_counter()
+
+settings = load_settings(sys.argv[1])
+settings.update(json.loads(sys.argv[2]))
+settings.pop("pyramid.includes", None)
+app = main({}, **settings)
+configured = time.perf_counter()
+
+from webob import Request
+Request.blank("/metrics").get_response(app)
+answered = time.perf_counter()
+
+print(json.dumps({"import_ms": (imported - start) * 1000, "configure_ms": (configured - imported) * 1000,
+                  "first_request_ms": (answered - configured) * 1000, "total_ms": (answered - start) * 1000}))
+"""
+
+
+def sample(ini: str, settings: dict) -> dict:
+    """
+    Starts the app once in a new interpreter
+    :param ini: the .ini file to read the settings from
+    :param settings: settings to override
+    :return: the timings in milliseconds
+    """
+    output = subprocess.check_output([sys.executable, "-c", CHILD, ini, json.dumps(settings)], cwd=ROOT)
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def bench(ini: str, settings: dict, repeat: int) -> dict:
+    """
+    :param ini: the .ini file to read the settings from
+    :param settings: settings to override
+    :param repeat: how many fresh interpreters to time
+    :return: the median of each timing in milliseconds
+    """
+    samples = [sample(ini, settings) for _ in range(repeat)]
+    return {key: round(statistics.median(s[key] for s in samples), 1) for key in samples[0]}
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Measures the cold start time of the app")
+    arg_parser.add_argument("--ini", default="development.ini", help="relative to the repository root")
+    arg_parser.add_argument("--repeat", type=int, default=10, help="fresh interpreters per mode")
+    arg_parser.add_argument("--warm-up", action="store_true", help="also time startup.warm_up, needs the mongo_uri")
+    arg_parser.add_argument("--output", help="write the results as JSON to this file")
+    args = arg_parser.parse_args()
+
+    modes = [
+        ("scan", {"startup.scan": "true", "startup.warm_up": "false"}),
+        ("explicit", {"startup.scan": "false", "startup.warm_up": "false"}),
+    ]
+
+    if args.warm_up:
+        modes.append(("explicit + warm-up", {"startup.scan": "false", "startup.warm_up": "true"}))
+
+    results = dict()
+
+    print("{:<20} {:>10} {:>13} {:>15} {:>10}".format("mode", "import ms", "configure ms", "1st request ms",
+                                                      "total ms"))
+
+    for name, settings in modes:
+        result = results[name] = bench(args.ini, settings, args.repeat)
+        print("{:<20} {:>10} {:>13} {:>15} {:>10}".format(name, result["import_ms"], result["configure_ms"],
+                                                          result["first_request_ms"], result["total_ms"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,417 @@
+#!../venv/bin/python3
+"""
+Runs the app under waitress against a local mongod and drives it with the traffic mix of a real greenhouse:
+sensors POSTing data readings, controllers polling /settings and /actuators, actuator toggles, heartbeats and
+dashboards pulling wide /data_readings ranges. Reports throughput, p50/p95/p99 latency per endpoint and the
+server's memory, and saves or compares against a baseline.
+
+Usage: load_test.py [configfile] --mongo-uri URI [--duration SECONDS] [--concurrency N] [--save-baseline FILE]
+                    [--compare FILE]
+"""
+import argparse
+import configparser
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from pymongo import MongoClient
+
+from bench_query_plans import SENSOR_TYPES, MINUTE, seed
+from reinitialize_db import add_default_settings
+
+# relative weights of what the clients do, roughly what a greenhouse with a few dashboards open sends
+TRAFFIC_MIX = [
+    ("POST /data_readings", 50),
+    ("GET /settings", 10),
+    ("GET /actuators", 15),
+    ("PUT /actuators/{name}/state", 3),
+    ("DELETE /actuators/{name}/state", 3),
+    ("POST /greenhouse_server_state", 5),
+    ("GET /data_readings", 4),
+    ("GET /data_readings/aggregate", 2),
+]
+
+
+def serve_app(port: int, settings: dict) -> None:
+    """
+    Runs the app under waitress in this process. The harness starts this in a subprocess so the server's memory
+    and CPU are its own
+    :param port: the port to listen on
+    :param settings: the app settings
+    :return: None
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+    from waitress import serve
+    from sgreen2_web import main
+
+    serve(main({}, **settings), host="127.0.0.1", port=port, threads=int(settings.get("waitress.threads", 4)),
+          _quiet=True)
+
+
+def start_server(port: int, settings: dict) -> subprocess.Popen:
+    """
+    Starts the server in a subprocess and waits until it accepts connections
+    :param port: the port to listen on
+    :param settings: the app settings
+    :return: the server process
+    """
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port),
+                                "--settings", json.dumps(settings)])
+
+    deadline = time.time() + 30
+
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited with " + str(process.returncode))
+
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError("server did not start in 30 seconds")
+
+
+def get_rss_mb(pid: int):
+    """
+    Gets the resident memory of a process
+    :param pid: the process id
+    :return: the resident memory in MB, None if it can't be read on this platform
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+
+    return None
+
+
+class Client(threading.Thread):
+    """
+    A closed loop client that picks what to do next from TRAFFIC_MIX and records the latency of each request
+    """
+
+    def __init__(self, port: int, sensors: list, actuators: list, history_start: int, stop_at: float,
+                 record_after: float, seed_number: int):
+        super(Client, self).__init__(daemon=True)
+        self.port = port
+        self.sensors = sensors
+        self.actuators = actuators
+        self.history_start = history_start
+        self.stop_at = stop_at
+        self.record_after = record_after
+        self.random = random.Random(seed_number)
+
+        # endpoint to list of latencies in seconds and to the number of failed requests
+        self.latencies = dict()
+        self.errors = dict()
+
+        # controllers revalidate what they already have
+        self.etags = dict()
+
+        names = [name for name, weight in TRAFFIC_MIX]
+        weights = [weight for name, weight in TRAFFIC_MIX]
+        self.next_endpoints = lambda: self.random.choices(names, weights, k=100)
+
+    def make_request(self, endpoint: str) -> tuple:
+        """
+        :param endpoint: one of the TRAFFIC_MIX names
+        :return: a tuple of (method, path, body, headers)
+        """
+        method = endpoint.split()[0]
+        now = int(time.time()) * 1000
+
+        if endpoint == "POST /data_readings":
+            sensor_type, name = self.random.choice(self.sensors)
+            body = {"sensor": {"type": sensor_type, "name": name}, "reading": round(self.random.uniform(0, 100), 2)}
+            return method, "/data_readings", json.dumps(body), {"Content-Type": "application/json"}
+
+        if endpoint in ("GET /settings", "GET /actuators"):
+            path = endpoint.split()[1]
+            headers = {"If-None-Match": self.etags[path]} if path in self.etags else dict()
+            return method, path, None, headers
+
+        if endpoint.endswith("/state"):
+            return method, "/actuators/{}/state".format(self.random.choice(self.actuators)), None, dict()
+
+        if endpoint == "POST /greenhouse_server_state":
+            return method, "/greenhouse_server_state", None, dict()
+
+        # dashboards pull the last 6 hours of a sensor type
+        sensor_type = self.random.choice(SENSOR_TYPES)
+        start_time = max(self.history_start, now - 6 * 60 * MINUTE)
+
+        if endpoint == "GET /data_readings":
+            return method, "/data_readings?type={}&start_time={}&end_time={}&limit=5000".format(
+                sensor_type, start_time, now), None, dict()
+
+        return method, "/data_readings/aggregate?type={}&start_time={}&end_time={}&bucket=5m".format(
+            sensor_type, start_time, now), None, dict()
+
+    def run(self):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        endpoints = list()
+
+        while time.time() < self.stop_at:
+            if not endpoints:
+                endpoints = self.next_endpoints()
+
+            endpoint = endpoints.pop()
+            method, path, body, headers = self.make_request(endpoint)
+
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                failed = response.status >= 400
+
+                if response.getheader("ETag"):
+                    self.etags[path] = response.getheader("ETag")
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+                failed = True
+            seconds = time.perf_counter() - start
+
+            # the first seconds warm the server up and aren't counted
+            if time.time() < self.record_after:
+                continue
+
+            self.latencies.setdefault(endpoint, list()).append(seconds)
+
+            if failed:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+        connection.close()
+
+
+def percentile(latencies: list, p: float) -> float:
+    """
+    :param latencies: sorted latencies
+    :param p: the percentile, 0 to 100
+    :return: the latency at that percentile by the nearest rank method
+    """
+    return latencies[max(0, min(len(latencies) - 1, int(round(p / 100.0 * len(latencies))) - 1))]
+
+
+def run(port: int, db, settings: dict, duration: float, warmup: float, concurrency: int) -> dict:
+    """
+    Starts the server, runs the clients and collects the results
+    :param port: the port the server listens on
+    :param db: the database the server uses, already seeded
+    :param settings: the app settings
+    :param duration: seconds to record for
+    :param warmup: seconds to run before recording
+    :param concurrency: how many clients run at once
+    :return: the results
+    """
+    sensors = [(sensor["type"], sensor["name"]) for sensor in db.data_readings.distinct("sensor")]
+    actuators = [actuator["name"] for actuator in db.actuators.find(projection={"name": 1})]
+    history_start = db.data_readings.find_one(sort=[("timestamp", 1)])["timestamp"]
+
+    server = start_server(port, settings)
+
+    try:
+        memory = {"start_mb": get_rss_mb(server.pid), "peak_mb": get_rss_mb(server.pid)}
+        stop_sampling = threading.Event()
+
+        def sample_memory():
+            while not stop_sampling.wait(0.5):
+                rss = get_rss_mb(server.pid)
+
+                if rss is not None and (memory["peak_mb"] is None or rss > memory["peak_mb"]):
+                    memory["peak_mb"] = rss
+
+        sampler = threading.Thread(target=sample_memory, daemon=True)
+        sampler.start()
+
+        record_after = time.time() + warmup
+        stop_at = record_after + duration
+        clients = [Client(port, sensors, actuators, history_start, stop_at, record_after, i)
+                   for i in range(concurrency)]
+
+        for client in clients:
+            client.start()
+
+        for client in clients:
+            client.join()
+
+        stop_sampling.set()
+        sampler.join()
+        memory["end_mb"] = get_rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return summarize(clients, duration, settings, memory)
+
+
+def summarize(clients: list, duration: float, settings: dict, memory: dict) -> dict:
+    """
+    Combines what the clients recorded into the results
+    :param clients: the clients, after they finished
+    :param duration: seconds they recorded for
+    :param settings: the app settings
+    :param memory: the server's memory at start, peak and end, in MB
+    :return: the results
+    """
+    endpoints = dict()
+
+    for name, weight in TRAFFIC_MIX:
+        latencies = sorted(latency for client in clients for latency in client.latencies.get(name, list()))
+
+        if not latencies:
+            continue
+
+        endpoints[name] = {
+            "requests": len(latencies),
+            "errors": sum(client.errors.get(name, 0) for client in clients),
+            "throughput_rps": round(len(latencies) / duration, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2)
+        }
+
+    requests = sum(endpoint["requests"] for endpoint in endpoints.values())
+
+    return {
+        "duration_s": duration,
+        "concurrency": len(clients),
+        "ingest_mode": settings.get("ingest.mode", "sync"),
+        "requests": requests,
+        "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+        "throughput_rps": round(requests / duration, 1),
+        "endpoints": endpoints,
+        "memory": memory
+    }
+
+
+def print_results(results: dict) -> None:
+    print("{:<34} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}".format("endpoint", "requests", "errors", "req/s",
+                                                              "p50 ms", "p95 ms", "p99 ms"))
+
+    for name, endpoint in results["endpoints"].items():
+        print("{:<34} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}".format(name, endpoint["requests"], endpoint["errors"],
+                                                                  endpoint["throughput_rps"], endpoint["p50_ms"],
+                                                                  endpoint["p95_ms"], endpoint["p99_ms"]))
+
+    print("total {} requests, {} errors, {} req/s".format(results["requests"], results["errors"],
+                                                          results["throughput_rps"]))
+
+    memory = results["memory"]
+
+    if memory["start_mb"] is not None:
+        print("server memory: {:.1f} MB at start, {:.1f} MB peak, {:.1f} MB at end".format(
+            memory["start_mb"], memory["peak_mb"], memory["end_mb"]))
+
+
+def save_baseline(results: dict, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_baseline(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    Prints the change from the baseline of every endpoint's p95 latency and throughput
+    :param results: the results of this run
+    :param baseline: the results of the baseline run
+    :param tolerance: how many percent worse p95 latency or throughput can get before it counts as a regression
+    :return: True if nothing regressed
+    """
+    ok = True
+
+    def change(new, old):
+        return (new - old) * 100.0 / old if old else 0.0
+
+    print("{:<34} {:>12} {:>12} {:>9}".format("compared to baseline", "p95", "req/s", ""))
+
+    for name, endpoint in results["endpoints"].items():
+        if name not in baseline["endpoints"]:
+            continue
+
+        old = baseline["endpoints"][name]
+        p95_change = change(endpoint["p95_ms"], old["p95_ms"])
+        throughput_change = change(endpoint["throughput_rps"], old["throughput_rps"])
+        regressed = p95_change > tolerance or throughput_change < -tolerance
+        ok = ok and not regressed
+
+        print("{:<34} {:>+11.1f}% {:>+11.1f}% {:>9}".format(name, p95_change, throughput_change,
+                                                            "WORSE" if regressed else "ok"))
+
+    if results["memory"]["peak_mb"] is not None and baseline["memory"]["peak_mb"] is not None:
+        print("peak server memory {:+.1f}%".format(change(results["memory"]["peak_mb"], baseline["memory"]["peak_mb"])))
+
+    return ok
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Load tests the app under waitress with greenhouse traffic")
+    arg_parser.add_argument("configfile", nargs="?", help="db_config.ini, used for the actuators and settings")
+    arg_parser.add_argument("--mongo-uri", help="the mongod to run against")
+    arg_parser.add_argument("--database", default="greenhouse_load", help="scratch database, it is dropped")
+    arg_parser.add_argument("--port", type=int, default=6543)
+    arg_parser.add_argument("--duration", type=float, default=30, help="seconds to record for")
+    arg_parser.add_argument("--warmup", type=float, default=5, help="seconds to run before recording")
+    arg_parser.add_argument("--concurrency", type=int, default=16, help="clients running at once")
+    arg_parser.add_argument("--days", type=int, default=1, help="days of history to seed")
+    arg_parser.add_argument("--sensors-per-type", type=int, default=4)
+    arg_parser.add_argument("--no-seed", action="store_true", help="reuse the data from the last run")
+    arg_parser.add_argument("--setting", action="append", default=list(), metavar="KEY=VALUE",
+                            help="an app setting to run with, for example ingest.mode=buffered")
+    arg_parser.add_argument("--save-baseline", metavar="FILE", help="write the results as JSON to this file")
+    arg_parser.add_argument("--compare", metavar="FILE", help="compare the results to a saved baseline")
+    arg_parser.add_argument("--tolerance", type=float, default=20,
+                            help="percent p95 latency or throughput can get worse before --compare fails")
+    # used by the harness to start the server in a subprocess
+    arg_parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    arg_parser.add_argument("--settings", help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.serve:
+        serve_app(args.serve, json.loads(args.settings))
+        sys.exit(0)
+
+    if not args.configfile or not args.mongo_uri:
+        arg_parser.error("configfile and --mongo-uri are required")
+
+    config = configparser.ConfigParser()
+    config.read(args.configfile)
+
+    db = MongoClient(args.mongo_uri)[args.database]
+
+    if not args.no_seed:
+        seed(db, config, args.days, args.sensors_per_type)
+        db.settings.drop()
+        add_default_settings(db, config)
+
+    settings = {"mongo_uri": args.mongo_uri, "mongo.database": args.database}
+    settings.update(setting.split("=", 1) for setting in args.setting)
+
+    results = run(args.port, db, settings, args.duration, args.warmup, args.concurrency)
+    print_results(results)
+
+    if args.save_baseline:
+        save_baseline(results, args.save_baseline)
+
+    if args.compare:
+        if not compare(results, load_baseline(args.compare), args.tolerance):
+            print("p95 latency or throughput got more than {}% worse".format(args.tolerance))
+            sys.exit(1)
@@ -0,0 +1,101 @@
+#!../venv/bin/python3
+import configparser
+import os
+import sys
+import time
+
+from pymongo import MongoClient
+from pymongo.database import Database
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from migrations import MIGRATIONS
+from sgreen2_web.tenancy import find_sites
+
+
+def get_applied_versions(db: Database) -> set:
+    """
+    Gets the versions of the migrations that have been applied
+    :param db: the greenhouse database
+    :return: a set of versions
+    """
+    return set(migration["_id"] for migration in db.schema_migrations.find(projection={"_id": 1}))
+
+
+def migrate(db: Database, dry_run: bool = False) -> None:
+    """
+    Applies the pending migrations in order and records each one in the schema_migrations collection
+    :param db: the greenhouse database
+    :param dry_run: only print what would be done and what it would cost
+    :return: None
+    """
+    applied = get_applied_versions(db)
+    pending = [migration for migration in MIGRATIONS if migration.version not in applied]
+
+    if not pending:
+        print("database is up to date")
+        return
+
+    for migration in pending:
+        print("{:04d} {}".format(migration.version, migration.description))
+
+        operations = migration.pending_operations(db)
+
+        if not operations:
+            print("    nothing to do")
+
+        for operation in operations:
+            print("    " + operation.describe(db))
+
+        if dry_run:
+            continue
+
+        start = time.perf_counter()
+
+        for operation in operations:
+            operation.apply(db)
+
+        duration_ms = int((time.perf_counter() - start) * 1000)
+
+        db.schema_migrations.insert_one({
+            "_id": migration.version,
+            "description": migration.description,
+            "applied_at": int(time.time()) * 1000,
+            "duration_ms": duration_ms
+        })
+
+        print("    done in {} ms".format(duration_ms))
+
+
+def migrate_all(client: MongoClient, database: str, database_prefix: str, dry_run: bool = False) -> None:
+    """
+    Migrates the default database and then the database of every site
+    :param client: the MongoClient
+    :param database: the name of the default database
+    :param database_prefix: the prefix of every site's database name
+    :param dry_run: only print what would be done and what it would cost
+    :return: None
+    """
+    for name in [database] + [database_prefix + site for site in find_sites(client, database_prefix)]:
+        print("== " + name)
+        migrate(client[name], dry_run)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] != "--dry-run"):
+        print("Usage: " + sys.argv[0] + " [configfile] [--dry-run]")
+        exit(1)
+
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+
+    mongo_uri = config["mongo"]["mongo_uri"]
+
+    if mongo_uri:
+        client = MongoClient(mongo_uri)
+    else:
+        client = MongoClient()
+
+    database = config["mongo"].get("database", "greenhouse")
+    migrate_all(client, database, config["mongo"].get("database_prefix", database + "_"), dry_run=len(sys.argv) == 3)
@@ -0,0 +1,168 @@
+import pymongo
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+
+def estimate_cost(db: Database, collection: str) -> str:
+    """
+    Estimates how much data an operation on a collection has to go through
+    :param db: the greenhouse database
+    :param collection: the name of the collection
+    :return: a description of the estimated cost
+    """
+    try:
+        stats = db.command("collStats", collection)
+    except OperationFailure:
+        return "collection does not exist yet"
+
+    return "~{} documents, {:.1f} MB".format(stats["count"], stats["size"] / 1000000.0)
+
+
+class CreateIndex(object):
+    """
+    Builds an index in the background unless an index with the same name and keys already exists
+    """
+
+    def __init__(self, collection: str, keys: list, name: str, **kwargs):
+        self.collection = collection
+        self.keys = keys
+        self.name = name
+        self.kwargs = kwargs
+
+    def is_done(self, db: Database) -> bool:
+        index = db[self.collection].index_information().get(self.name)
+        return index is not None and index["key"] == self.keys
+
+    def describe(self, db: Database) -> str:
+        return "create index {} on {} {} ({})".format(self.name, self.collection, self.keys,
+                                                      estimate_cost(db, self.collection))
+
+    def apply(self, db: Database) -> None:
+        db[self.collection].create_index(self.keys, name=self.name, background=True, **self.kwargs)
+
+
+class DropIndex(object):
+    """
+    Drops an index if it exists
+    """
+
+    def __init__(self, collection: str, name: str):
+        self.collection = collection
+        self.name = name
+
+    def is_done(self, db: Database) -> bool:
+        return self.name not in db[self.collection].index_information()
+
+    def describe(self, db: Database) -> str:
+        return "drop index {} on {}".format(self.name, self.collection)
+
+    def apply(self, db: Database) -> None:
+        db[self.collection].drop_index(self.name)
+
+
+class ConvertPingsToIntervals(object):
+    """
+    Collapses the old one document per ping greenhouse_server_state collection into uptime intervals, then renames
+    it to greenhouse_server_state_converted, drop that once the intervals look right. Intervals are upserted by start
+    time, so running it again after a failure doesn't duplicate them
+    """
+
+    def __init__(self, heartbeat_gap: int):
+        self.heartbeat_gap = heartbeat_gap
+
+    def is_done(self, db: Database) -> bool:
+        return db.greenhouse_server_state.find_one() is None
+
+    def describe(self, db: Database) -> str:
+        return "convert greenhouse_server_state pings into greenhouse_server_uptime intervals ({})".format(
+            estimate_cost(db, "greenhouse_server_state"))
+
+    def apply(self, db: Database) -> None:
+        interval = None
+
+        for ping in db.greenhouse_server_state.find(projection={"_id": 0, "timestamp": 1},
+                                                    sort=[("timestamp", pymongo.ASCENDING)]):
+            if interval is not None and ping["timestamp"] - interval["end_time"] <= self.heartbeat_gap:
+                interval["end_time"] = ping["timestamp"]
+                interval["pings"] += 1
+                continue
+
+            if interval is not None:
+                self.__save(db, interval)
+
+            interval = {"start_time": ping["timestamp"], "end_time": ping["timestamp"], "pings": 1}
+
+        if interval is not None:
+            self.__save(db, interval)
+
+        # nothing writes pings any more, so this is done for good
+        if "greenhouse_server_state" in db.list_collection_names():
+            db.greenhouse_server_state.rename("greenhouse_server_state_converted", dropTarget=True)
+
+    @staticmethod
+    def __save(db: Database, interval: dict) -> None:
+        db.greenhouse_server_uptime.update_one({"start_time": interval["start_time"]},
+                                               {"$max": {"end_time": interval["end_time"]},
+                                                "$setOnInsert": {"pings": interval["pings"]}},
+                                               upsert=True)
+
+
+class Migration(object):
+    """
+    An ordered set of operations. Every operation checks whether it is already done,
+    so a migration that failed half way can be run again
+    """
+
+    def __init__(self, version: int, description: str, operations: list):
+        self.version = version
+        self.description = description
+        self.operations = operations
+
+    def pending_operations(self, db: Database) -> list:
+        return [operation for operation in self.operations if not operation.is_done(db)]
+
+
+# append new migrations to the end, never change or reorder applied ones
+MIGRATIONS = [
+    Migration(1, "replace the TEXT index on actuators.name with indexes that serve name lookups and sorting", [
+        CreateIndex("actuators", [("name", pymongo.ASCENDING)], "name_unique_index", unique=True),
+        CreateIndex("actuators", [("type", pymongo.ASCENDING), ("name", pymongo.ASCENDING)], "type_name_index"),
+        CreateIndex("actuators", [("version", pymongo.DESCENDING)], "version_index"),
+        DropIndex("actuators", "name_index"),
+    ]),
+    Migration(2, "index the sort keys of the paginated state log and data readings queries", [
+        CreateIndex("actuators_state_log",
+                    [("name", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+                    "name_timestamp_id_index"),
+        CreateIndex("data_readings",
+                    [("sensor.type", pymongo.ASCENDING), ("sensor.name", pymongo.ASCENDING),
+                     ("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+                    "type_name_timestamp_id_index"),
+        # name_timestamp_id_index has the same prefix
+        DropIndex("actuators_state_log", "name_timestamp_index"),
+    ]),
+    Migration(3, "store greenhouse server pings as uptime intervals", [
+        CreateIndex("greenhouse_server_uptime", [("end_time", pymongo.DESCENDING)], "end_time_index"),
+        # same as the default heartbeat_gap of the app
+        ConvertPingsToIntervals(2 * 60 * 1000),
+    ]),
+    Migration(4, "index the rollup tiers of data readings, buckets are upserted and read by these keys", [
+        CreateIndex(collection,
+                    [("sensor.type", pymongo.ASCENDING), ("sensor.name", pymongo.ASCENDING),
+                     ("timestamp", pymongo.DESCENDING)],
+                    "type_name_timestamp_unique_index", unique=True)
+        for collection in ["data_readings_1m", "data_readings_1h", "data_readings_1d"]
+    ]),
+    Migration(5, "index the (timestamp, _id) order GET /data_readings/stream resumes in", [
+        CreateIndex("data_readings",
+                    [("sensor.type", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING),
+                     ("_id", pymongo.DESCENDING)],
+                    "type_timestamp_id_index"),
+        # type_timestamp_id_index has the same prefix
+        DropIndex("data_readings", "type_timestamp_index"),
+    ]),
+    Migration(6, "key each new uptime interval on the one before it so concurrent pings can't start two", [
+        CreateIndex("greenhouse_server_uptime", [("previous_id", pymongo.ASCENDING)], "previous_id_unique_index",
+                    unique=True, sparse=True),
+    ]),
+]
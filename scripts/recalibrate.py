@@ -0,0 +1,264 @@
+#!../venv/bin/python3
+"""
+Re-converts a sensor's stored data readings after its calibration changes. Stored readings already have the old
+calibration applied, so each one is put through the inverse of the old calibration and then the new one.
+Readings are converted a batch at a time with the same conversions POST /data_readings uses. The sensor's buckets in
+the rollup tiers are converted the same way, stop runrollups.py while this runs. The results are clamped to the range
+of the unit conversion the sensor's readings come in with, as POST /data_readings clamps them.
+
+Usage: recalibrate.py [configfile] [name] --old GAIN [OFFSET] --new GAIN [OFFSET] [--unit UNIT | --range MIN MAX]
+                      [--start-time MS] [--end-time MS] [--site SITE] [--dry-run]
+"""
+import argparse
+import configparser
+import itertools
+import os
+import sys
+
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sgreen2_web.readings import DEFAULT_CONVERSIONS, LinearConversion, battery_health
+from sgreen2_web.rollups import TIERS
+from sgreen2_web.tenancy import SITE_PATTERN
+
+BATCH_SIZE = 1000
+
+
+def recalibrate(db, name: str, old: LinearConversion, new: LinearConversion, start_time: int = None,
+                end_time: int = None, dry_run: bool = False, unit: LinearConversion = None) -> tuple:
+    """
+    Applies the new calibration in place of the old one to a sensor's data readings
+    :param db: the greenhouse database
+    :param name: the name of the sensor
+    :param old: the calibration the readings were stored with
+    :param new: the calibration to store them with
+    :param start_time: only readings at or after this timestamp
+    :param end_time: only readings at or before this timestamp
+    :param dry_run: only count the readings that would change
+    :param unit: the unit conversion of the sensor's readings, its range clamps the results. None if there is none
+    :return: a tuple of (readings updated, readings that could not be updated, rollup buckets updated)
+    """
+    # undo the old calibration then apply the new one, clamped like the readings POST /data_readings stores with it
+    undo_old = LinearConversion(1.0 / old.scale, -old.offset / old.scale)
+    conversion = undo_old.then(new)
+
+    if unit is not None:
+        conversion = LinearConversion(conversion.scale, conversion.offset, unit.minimum, unit.maximum)
+
+    # checked before anything is changed
+    check_rollup_boundaries(db, name, start_time, end_time)
+
+    query = {"sensor.name": name}
+
+    if start_time is not None or end_time is not None:
+        query["timestamp"] = dict()
+
+        if start_time is not None:
+            query["timestamp"]["$gte"] = start_time
+
+        if end_time is not None:
+            query["timestamp"]["$lte"] = end_time
+
+    updated = 0
+    failed = 0
+    batch = list()
+
+    def write(batch: list) -> tuple:
+        ids = [data_reading["_id"] for data_reading in batch]
+        readings = conversion.convert([data_reading["reading"] for data_reading in batch])
+        requests = list()
+
+        for data_reading, _id, reading in zip(batch, ids, readings):
+            update = {"reading": reading}
+
+            if data_reading["sensor"]["type"] == "batt":
+                update["health"] = battery_health(reading)
+
+            requests.append(UpdateOne({"_id": _id}, {"$set": update}))
+
+        if dry_run:
+            return len(requests), 0
+
+        try:
+            result = db.data_readings.bulk_write(requests, ordered=False)
+            return result.modified_count, 0
+        except BulkWriteError as err:
+            # data_readings is capped, an update that changes the size of a document (a new health) fails
+            return err.details["nModified"], len(err.details["writeErrors"])
+
+    for data_reading in db.data_readings.find(query, projection={"reading": 1, "sensor.type": 1}):
+        batch.append(data_reading)
+
+        if len(batch) == BATCH_SIZE:
+            batch_updated, batch_failed = write(batch)
+            updated += batch_updated
+            failed += batch_failed
+            batch = list()
+
+    if batch:
+        batch_updated, batch_failed = write(batch)
+        updated += batch_updated
+        failed += batch_failed
+
+    return updated, failed, recalibrate_rollups(db, name, conversion, start_time, end_time, dry_run)
+
+
+def get_database(client: MongoClient, config: configparser.ConfigParser, site: str = None):
+    """
+    Gets the database of a greenhouse site, as reinitialize_db.py provisions it
+    :param client: the MongoClient
+    :param config: the configuration parser
+    :param site: the greenhouse site, None for the default database
+    :return: the database
+    """
+    database = config["mongo"].get("database", "greenhouse")
+
+    # the app finds a site's database by the same prefix, tenancy.database_prefix in the .ini file
+    if site is not None:
+        if not SITE_PATTERN.match(site):
+            raise ValueError("site names are lowercase letters, digits, _ and -")
+
+        database = config["mongo"].get("database_prefix", database + "_") + site
+
+    return client[database]
+
+
+def check_rollup_boundaries(db, name: str, start_time: int = None, end_time: int = None) -> None:
+    """
+    Makes sure the time range doesn't cut through a rollup bucket of the sensor. Part of the data readings of such a
+    bucket would keep the old calibration, so the bucket can't be converted
+    :param db: the greenhouse database
+    :param name: the name of the sensor
+    :param start_time: the start of the time range, or None
+    :param end_time: the end of the time range, or None
+    :return: None
+    """
+    for tier in TIERS:
+        # a bucket covers timestamp to timestamp + bucket - 1
+        cut = list()
+
+        if start_time is not None:
+            cut.append({"timestamp": {"$gt": start_time - tier.bucket, "$lt": start_time}})
+
+        if end_time is not None:
+            cut.append({"timestamp": {"$gt": end_time - tier.bucket + 1, "$lte": end_time}})
+
+        if cut and db[tier.collection].find_one({"sensor.name": name, "$or": cut}, projection={"_id": 1}):
+            raise ValueError("the time range cuts through {} rollup buckets of {}, start and end it on a bucket "
+                             "boundary".format(tier.name, name))
+
+
+def recalibrate_rollups(db, name: str, conversion: LinearConversion, start_time: int = None, end_time: int = None,
+                        dry_run: bool = False) -> int:
+    """
+    Converts the sensor's buckets in every rollup tier. Conversions are linear, so the min, max and mean of a bucket
+    are converted like readings and its count stays the same. A mean is only approximate once some of its readings
+    were clamped
+    :param db: the greenhouse database
+    :param name: the name of the sensor
+    :param conversion: the conversion from the old calibration to the new one
+    :param start_time: only buckets that start at or after this timestamp
+    :param end_time: only buckets that end at or before this timestamp
+    :param dry_run: only count the buckets that would change
+    :return: how many buckets were updated
+    """
+    updated = 0
+
+    for tier in TIERS:
+        query = {"sensor.name": name}
+
+        if start_time is not None or end_time is not None:
+            query["timestamp"] = dict()
+
+            if start_time is not None:
+                query["timestamp"]["$gte"] = start_time
+
+            if end_time is not None:
+                query["timestamp"]["$lte"] = end_time - tier.bucket + 1
+
+        buckets = db[tier.collection].find(query, projection={"min": 1, "max": 1, "mean": 1})
+
+        while True:
+            batch = list(itertools.islice(buckets, BATCH_SIZE))
+
+            if not batch:
+                break
+
+            if dry_run:
+                updated += len(batch)
+                continue
+
+            requests = list()
+
+            for b in batch:
+                low, high, mean = conversion.convert([b["min"], b["max"], b["mean"]])
+                # a negative gain turns the minimum into the maximum
+                requests.append(UpdateOne({"_id": b["_id"]}, {"$set": {"min": min(low, high), "max": max(low, high),
+                                                                       "mean": mean}}))
+
+            updated += db[tier.collection].bulk_write(requests, ordered=False).modified_count
+
+    return updated
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Re-converts a sensor's data readings after a calibration change")
+    arg_parser.add_argument("configfile", help="db_config.ini, used for the mongo uri")
+    arg_parser.add_argument("name", help="the name of the sensor")
+    arg_parser.add_argument("--old", type=float, nargs="+", default=[1.0], metavar="GAIN [OFFSET]",
+                            help="the calibration the readings were stored with (default: none)")
+    arg_parser.add_argument("--new", type=float, nargs="+", required=True, metavar="GAIN [OFFSET]",
+                            help="the calibration to store the readings with, as in calibration.<name> in the .ini")
+    unit = arg_parser.add_mutually_exclusive_group()
+    unit.add_argument("--unit", help="the unit the sensor sends its readings in, for the range of its conversion")
+    unit.add_argument("--range", type=float, nargs=2, metavar=("MIN", "MAX"),
+                      help="the range of the sensor's unit conversion, for units from unit.<type>.<unit> in the .ini")
+    arg_parser.add_argument("--start-time", type=int)
+    arg_parser.add_argument("--end-time", type=int)
+    arg_parser.add_argument("--site", help="the greenhouse site whose readings to convert (default: the default "
+                                           "database)")
+    arg_parser.add_argument("--dry-run", action="store_true", help="only count the readings that would change")
+    args = arg_parser.parse_args()
+
+    if len(args.old) > 2 or len(args.new) > 2 or args.old[0] == 0:
+        arg_parser.error("calibrations are a non-zero gain and an optional offset")
+
+    config = configparser.ConfigParser()
+    config.read(args.configfile)
+
+    mongo_uri = config["mongo"]["mongo_uri"]
+
+    if mongo_uri:
+        client = MongoClient(mongo_uri)
+    else:
+        client = MongoClient()
+
+    try:
+        db = get_database(client, config, args.site)
+    except ValueError as err:
+        arg_parser.error(str(err))
+
+    unit_conversion = None
+
+    if args.range is not None:
+        unit_conversion = LinearConversion(minimum=args.range[0], maximum=args.range[1])
+    elif args.unit is not None:
+        sensor = db.data_readings.find_one({"sensor.name": args.name}, projection={"sensor.type": 1})
+
+        if sensor is not None:
+            unit_conversion = DEFAULT_CONVERSIONS.get((sensor["sensor"]["type"], args.unit.lower()))
+
+    try:
+        updated, failed, buckets = recalibrate(db, args.name, LinearConversion(*args.old),
+                                               LinearConversion(*args.new), args.start_time, args.end_time,
+                                               args.dry_run, unit_conversion)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+
+    print("{} {} data readings{} and {} rollup buckets".format("would update" if args.dry_run else "updated",
+                                                               updated, ", {} failed".format(failed) if failed else "",
+                                                               buckets))
@@ -1,11 +1,20 @@
 #!../venv/bin/python3
 import configparser
+import os
 import sys
 
 import pymongo
 from dateutil import parser
 from pymongo import MongoClient
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sgreen2_web.rollups import TIERS
+from sgreen2_web.tenancy import SITE_PATTERN
+
+# what "all" provisions, such as the database of a new site
+ALL_TABLES = ["actuators", "actuators_state_log", "settings", "data_readings", "greenhouse_server_uptime", "rollups"]
+
 
 def add_actuators(db: MongoClient, config: configparser.ConfigParser) -> None:
     """
@@ -99,28 +108,51 @@ def add_default_settings(db: MongoClient, config: configparser.ConfigParser) ->
 
 def create_indexes(db: MongoClient) -> None:
     """
-    Creates indexes on the database
+    Creates indexes on the database. Check the query plans with bench_query_plans.py after changing these
     :param db: the MongoClient
     :return: None
     """
-    # need this index to make sure all the names are unique
-    db.actuators.create_index([("name", pymongo.TEXT)], name="name_index", default_language="english", unique=True)
+    # need this index to make sure all the names are unique and to look actuators up by name
+    db.actuators.create_index([("name", pymongo.ASCENDING)], name="name_unique_index", unique=True)
 
-    # need these indexes because these collections could be large and we always query on name/sensor.type and timestamp
-    db.actuators_state_log.create_index([("name", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)],
-                                        name="name_timestamp_index",
-                                        default_language="english")
-    db.data_readings.create_index([("sensor.type", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)],
-                                  name="type_timestamp_index",
-                                  default_language="english")
-    db.greenhouse_server_state.create_index([("timestamp", pymongo.DESCENDING)], name="timestamp_index")
+    # GET /actuators sorts by type then by name
+    db.actuators.create_index([("type", pymongo.ASCENDING), ("name", pymongo.ASCENDING)], name="type_name_index")
 
+    # GET /actuators looks up the latest version on every poll
+    db.actuators.create_index([("version", pymongo.DESCENDING)], name="version_index")
 
-def reinitialize_db(config: configparser.ConfigParser, tables: list = None) -> None:
+    # need these indexes because these collections could be large and we always query on name/sensor.type and timestamp
+    # equality fields come first, then the sort fields (_id breaks ties for pagination), so no sort is done in memory
+    db.actuators_state_log.create_index([("name", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING),
+                                         ("_id", pymongo.DESCENDING)],
+                                        name="name_timestamp_id_index")
+    db.data_readings.create_index([("sensor.type", pymongo.ASCENDING), ("sensor.name", pymongo.ASCENDING),
+                                   ("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+                                  name="type_name_timestamp_id_index")
+    # GET /data_readings/aggregate only filters on type and timestamp, GET /data_readings/stream also sorts on _id
+    db.data_readings.create_index([("sensor.type", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING),
+                                   ("_id", pymongo.DESCENDING)],
+                                  name="type_timestamp_id_index")
+
+    # uptime intervals are found and extended by their end time
+    db.greenhouse_server_uptime.create_index([("end_time", pymongo.DESCENDING)], name="end_time_index")
+    # a new interval is upserted by the one before it, so two processes can't both start one after a silence
+    db.greenhouse_server_uptime.create_index([("previous_id", pymongo.ASCENDING)], name="previous_id_unique_index",
+                                             unique=True, sparse=True)
+
+    # rollup buckets are upserted by sensor and timestamp and read in the same order as data readings
+    for tier in TIERS:
+        db[tier.collection].create_index([("sensor.type", pymongo.ASCENDING), ("sensor.name", pymongo.ASCENDING),
+                                          ("timestamp", pymongo.DESCENDING)],
+                                         name="type_name_timestamp_unique_index", unique=True)
+
+
+def reinitialize_db(config: configparser.ConfigParser, tables: list = None, site: str = None) -> None:
     """
     Initializes the greenhouse database with data or reinitializes it
     :param config: the configuration parser
     :param tables: a list of tables to fill (actuators, settings, etc)
+    :param site: the greenhouse site whose database to initialize, None for the default database
     :return: None
     """
 
@@ -131,7 +163,16 @@ def reinitialize_db(config: configparser.ConfigParser, tables: list = None) -> N
     else:
         client = MongoClient()
 
-    db = client.greenhouse
+    database = config["mongo"].get("database", "greenhouse")
+
+    # the app finds a site's database by the same prefix, tenancy.database_prefix in the .ini file
+    if site is not None:
+        if not SITE_PATTERN.match(site):
+            raise ValueError("site names are lowercase letters, digits, _ and -")
+
+        database = config["mongo"].get("database_prefix", database + "_") + site
+
+    db = client[database]
 
     if "actuators" in tables:
         db.actuators.drop()
@@ -151,24 +192,29 @@ def reinitialize_db(config: configparser.ConfigParser, tables: list = None) -> N
         data_readings_size = 350 * 1000000
         db.create_collection("data_readings", capped=True, size=data_readings_size)
 
-    if "greenhouse_server_state" in tables:
-        db.greenhouse_server_state.drop()
-        pings_size = 5 * 1000000
-        db.create_collection("greenhouse_server_state", capped=True, size=pings_size)
+    if "greenhouse_server_uptime" in tables:
+        db.greenhouse_server_uptime.drop()
+
+    # the rollup tiers aren't capped, they keep the history data_readings evicts
+    if "rollups" in tables:
+        for tier in TIERS:
+            db[tier.collection].drop()
+
+        db.rollup_state.drop()
 
     create_indexes(db)
 
 
 if __name__ == "__main__":
 
-    if len(sys.argv) != 3:
-        print("Usage: " + sys.argv[0] + " [configfile] [tables (comma separated)]")
+    if len(sys.argv) not in (3, 4):
+        print("Usage: " + sys.argv[0] + " [configfile] [tables (comma separated) or all] [site]")
         exit(1)
 
     config = configparser.ConfigParser()
     config.read(sys.argv[1])
     tables_str = sys.argv[2]
 
-    tables = tables_str.split(",")
+    tables = ALL_TABLES if tables_str == "all" else tables_str.split(",")
 
-    reinitialize_db(config, tables)
+    reinitialize_db(config, tables, sys.argv[3] if len(sys.argv) == 4 else None)
@@ -24,6 +24,7 @@ tests_require = [
     'WebTest >= 1.3.1',  # py3 compat
     'pytest',  # includes virtualenv
     'pytest-cov',
+    'mongomock',  # the tests run the app against an in memory database
     ]
 
 
@@ -46,6 +47,9 @@ setup(name='sgreen2_web',
       zip_safe=False,
       extras_require={
           'testing': tests_require,
+          'fast_json': ['orjson'],
+          'msgpack': ['msgpack'],
+          'numpy': ['numpy'],
       },
       install_requires=requires,
       entry_points="""\
@@ -1,4 +1,7 @@
+import atexit
+
 from pyramid.config import Configurator
+from pyramid.settings import asbool
 
 try:
     # for python 2
@@ -7,8 +10,16 @@ except ImportError:
     # for python 3
     from urllib.parse import urlparse
 
-from gridfs import GridFS
-from pymongo import MongoClient
+from sgreen2_web.cache import ResponseCache, SettingsCache
+from sgreen2_web.db import create_client
+from sgreen2_web.ingest import IngestionQueue, close_on_sigterm
+from sgreen2_web.live import ActuatorWatches, LiveFeeds
+from sgreen2_web.metrics import Metrics, MongoCommandListener
+from sgreen2_web.readings import get_unit_converter, insert_data_readings
+from sgreen2_web.renderers import BSONJSONRenderer
+from sgreen2_web.startup import warm_up
+from sgreen2_web.tenancy import SITE_HEADER, Tenants
+from sgreen2_web.views.greenhouse_server_state import get_heartbeat_gap, record_pings
 
 
 def main(global_config, **settings):
@@ -18,31 +29,118 @@ def main(global_config, **settings):
 
     # MongoDB and Pyramid
 
-    db_url = settings['mongo_uri']
-    config.registry.db = MongoClient(db_url)
+    # request and Mongo command metrics, served by GET /metrics
+    config.registry.metrics = Metrics(slow_request_seconds=float(settings.get('metrics.slow_request_ms', 0)) / 1000)
+
+    # pool size, timeouts and compression come from the mongo.* settings
+    config.registry.db = create_client(settings, event_listeners=[MongoCommandListener(config.registry.metrics)])
+    # every greenhouse site shares the client, the site of a request picks its database (see tenancy.mode)
+    config.registry.tenants = Tenants(config.registry.db, settings)
+    # the default database once per read/write profile, see sgreen2_web/db.py
+    config.registry.databases = config.registry.tenants.get_databases(None)
 
     def add_db(request):
-        return config.registry.db.greenhouse
+        return config.registry.tenants.get_databases(request.site)[None]
+
+    def get_db(request, profile):
+        return config.registry.tenants.get_databases(request.site)[profile]
 
     def add_fs(request):
+        from gridfs import GridFS
         return GridFS(request.db)
 
     config.add_request_method(add_db, 'db', reify=True)
+    config.add_request_method(get_db, 'get_db')
     config.add_request_method(add_fs, 'fs', reify=True)
 
+    # formatted settings are cached per process, other processes' writes are noticed within the check interval
+    config.registry.settings_cache = SettingsCache(float(settings.get('settings_cache.check_interval', 5)))
+
+    # responses for time windows in the past are cached per process, cache.max_bytes = 0 turns it off
+    config.registry.response_cache = None
+
+    if int(settings.get('cache.max_bytes', 0)) > 0:
+        # shared caches in front must not serve one site's response to another either
+        vary = ('Accept', SITE_HEADER) if config.registry.tenants.mode == 'header' else ('Accept',)
+        config.registry.response_cache = ResponseCache(int(settings['cache.max_bytes']),
+                                                       settle=float(settings.get('cache.settle', 300)),
+                                                       max_age=float(settings.get('cache.max_age', 86400)),
+                                                       recent_ttl=float(settings.get('cache.recent_ttl', 0)),
+                                                       vary=vary)
+
+    config.add_view_deriver('sgreen2_web.cache.response_cache_view')
+
+    # unit conversions and sensor calibrations for POSTed data readings
+    config.registry.unit_converter = get_unit_converter(settings)
+
+    # optionally queue POSTed data readings and pings and write them in batches from a background thread
+    config.registry.ingest_queue = None
+
+    if settings.get('ingest.mode', 'sync') == 'buffered':
+        heartbeat_gap = get_heartbeat_gap(settings)
+
+        # items are queued with the readings or heartbeats database of their site
+        config.registry.ingest_queue = IngestionQueue(
+            config.registry.databases[None],
+            {
+                'data_readings': insert_data_readings,
+                'greenhouse_server_uptime': lambda db, timestamps: record_pings(db, timestamps, heartbeat_gap)
+            },
+            max_size=int(settings.get('ingest.queue_size', 10000)),
+            batch_size=int(settings.get('ingest.batch_size', 500)),
+            flush_interval=float(settings.get('ingest.flush_interval', 1)))
+
+        atexit.register(config.registry.ingest_queue.close)
+        close_on_sigterm(config.registry.ingest_queue)
+
+    # one tailable cursor per site and sensor type follows new data readings for every GET /data_readings/stream client
+    resume_overlap_seconds = float(settings.get('live.resume_overlap', 5))
+    config.registry.live_feeds = LiveFeeds(max_clients=int(settings.get('live.max_clients', 50)),
+                                           client_queue_size=int(settings.get('live.client_queue_size', 1000)),
+                                           keepalive_seconds=float(settings.get('live.keepalive', 15)),
+                                           resume_overlap_seconds=resume_overlap_seconds)
+    # one tailable cursor per site on the actuators_state_log wakes every GET /actuators/{name}/state/watch request
+    config.registry.actuator_watches = ActuatorWatches(max_waiters=int(settings.get('watch.max_waiters', 20)),
+                                                       max_timeout_seconds=float(settings.get('watch.timeout', 25)),
+                                                       resume_overlap_seconds=resume_overlap_seconds)
+
+    # encode BSON types and cursors in one pass instead of round tripping through json_util
+    config.add_renderer('json', BSONJSONRenderer)
+
+    # added first so it runs inside the metrics tween, which then also times requests for unknown sites
+    config.add_tween('sgreen2_web.tenancy.tenancy_tween_factory')
+    config.add_tween('sgreen2_web.metrics.metrics_tween_factory')
+
     # Routes
     config.add_route('home', '/')
 
     config.add_route('data_readings', '/data_readings')
+    config.add_route('data_readings_aggregate', '/data_readings/aggregate')
+    config.add_route('data_readings_stream', '/data_readings/stream')
 
     config.add_route('settings', '/settings')
 
     config.add_route('actuators', '/actuators')
+    config.add_route('actuators_type_duty_cycle', '/actuators/duty_cycle')
     config.add_route('actuators_state', '/actuators/{name}/state')
+    config.add_route('actuators_state_watch', '/actuators/{name}/state/watch')
+    config.add_route('actuators_duty_cycle', '/actuators/{name}/duty_cycle')
 
     config.add_route('greenhouse_server_state', '/greenhouse_server_state')
 
-    config.scan('sgreen2_web.views')
+    config.add_route('metrics', '/metrics')
+
+    # scanning imports and walks every module in the package, registering the views by hand is faster
+    if asbool(settings.get('startup.scan', False)):
+        config.scan('sgreen2_web.views')
+    else:
+        config.include('sgreen2_web.views')
+
+    app = config.make_wsgi_app()
+
+    # the server only accepts traffic once main returns
+    if asbool(settings.get('startup.warm_up', False)):
+        warm_up(config.registry)
 
     from wsgicors import CORS
-    return CORS(config.make_wsgi_app(), headers="*", methods="*", maxage="180", origin="*")
+    return CORS(app, headers="*", methods="*", maxage="180", origin="*")
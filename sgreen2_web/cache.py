@@ -0,0 +1,234 @@
+import collections
+import threading
+import time
+
+from pyramid.request import Request
+from pyramid.response import Response
+
+from sgreen2_web.helpers import get_timestamp
+
+# the GET endpoints whose responses for a time window only change while the window is recent
+HISTORICAL_ROUTES = ("data_readings", "data_readings_aggregate", "actuators_state", "greenhouse_server_state")
+
+# response headers that are cached along with the body
+CACHED_HEADERS = ("Content-Type", "X-Next-Cursor", "Link", "X-Resolution")
+
+
+class SettingsCache(object):
+    """
+    Holds the formatted settings of each site for this process. Settings written by other processes
+    are picked up by checking the settings version at most every check_interval seconds
+    """
+
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+
+        # site to (version, settings), replaced as a whole so waitress threads never see half an update
+        self.__entries = dict()
+        # site to when its version was last checked
+        self.__checked_at = dict()
+
+    def get(self, site: str = None) -> tuple:
+        """
+        Gets the cached settings
+        :param site: the site, or None for the default database
+        :return: a tuple of (version, settings) or None if nothing is cached
+        """
+        return self.__entries.get(site)
+
+    def set(self, version: str, settings: dict, site: str = None) -> None:
+        """
+        Caches the formatted settings
+        :param version: the version of the settings
+        :param settings: the formatted settings
+        :param site: the site, or None for the default database
+        :return: None
+        """
+        # touched first so a concurrent needs_check never sees an entry without a check time
+        self.touch(site)
+        self.__entries[site] = (version, settings)
+
+    def needs_check(self, site: str = None) -> bool:
+        """
+        :param site: the site, or None for the default database
+        :return: True if nothing is cached or the version hasn't been checked in check_interval seconds
+        """
+        return site not in self.__entries or \
+            time.monotonic() - self.__checked_at.get(site, 0) >= self.check_interval
+
+    def touch(self, site: str = None) -> None:
+        """
+        Marks the cached version as checked
+        :param site: the site, or None for the default database
+        :return: None
+        """
+        self.__checked_at[site] = time.monotonic()
+
+
+class ResponseCache(object):
+    """
+    LRU cache of the responses of HISTORICAL_ROUTES within a budget of bytes. Windows that ended more than settle
+    seconds ago are kept for max_age seconds, windows closer to now for recent_ttl seconds or not at all if it's 0.
+    Entries still expire because eviction from the capped collections changes old windows too
+    """
+
+    def __init__(self, max_bytes: int, settle: float, max_age: float, recent_ttl: float, vary: tuple = ("Accept",)):
+        """
+        :param max_bytes: the most bytes of responses to keep, a single response over an eighth of it isn't cached
+        :param settle: seconds after which data in a window no longer changes, such as queued data readings
+        :param max_age: seconds to keep and let clients keep the response for a settled window
+        :param recent_ttl: seconds to keep the response for a window that isn't settled, 0 doesn't cache it
+        :param vary: the request headers the response depends on, shared caches in front key on them too
+        """
+        self.max_bytes = max_bytes
+        self.settle = settle
+        self.max_age = max_age
+        self.recent_ttl = recent_ttl
+        self.vary = vary
+
+        # key to (expires_at, status, headers, body), least recently used first
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def count(self) -> int:
+        return len(self.__entries)
+
+    def get_ttl(self, request: Request) -> float:
+        """
+        Gets how long the response to a request can be cached from its end_time
+        :param request: the Pyramid request
+        :return: the seconds, 0 if it can't be cached
+        """
+        try:
+            end_time = int(request.GET["end_time"])
+        except (KeyError, ValueError):
+            # end_time defaults to now, and bad requests aren't cached
+            return self.recent_ttl if "end_time" not in request.GET.keys() else 0
+
+        if end_time <= get_timestamp() - self.settle * 1000 and not getattr(request, "window_changing", False):
+            return self.max_age
+
+        return self.recent_ttl
+
+    def get(self, key: tuple) -> Response:
+        """
+        :param key: the normalized request
+        :return: the cached response, or None
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+
+            if entry is not None and entry[0] <= time.monotonic():
+                self.__remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+
+        expires_at, status, headers, body = entry
+
+        response = Response(body=body, status=status, headerlist=list(headers))
+        response.headers["X-Cache"] = "hit"
+        self.__make_public(response, expires_at - time.monotonic())
+
+        return response
+
+    def set(self, key: tuple, response: Response, ttl: float) -> None:
+        """
+        Caches a response, evicting the least recently used ones to stay within max_bytes
+        :param key: the normalized request
+        :param response: the response, only buffered responses are cached
+        :param ttl: seconds to keep it
+        :return: None
+        """
+        response.headers["X-Cache"] = "miss"
+        self.__make_public(response, ttl)
+
+        # streamed responses aren't buffered
+        if not isinstance(response.app_iter, list):
+            return
+
+        body = response.body
+
+        if len(body) > self.max_bytes // 8:
+            return
+
+        headers = tuple((name, value) for name, value in response.headerlist if name in CACHED_HEADERS)
+
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+
+            self.__entries[key] = (time.monotonic() + ttl, response.status, headers, body)
+            self.size += len(body)
+
+            while self.size > self.max_bytes:
+                self.__remove(next(iter(self.__entries)))
+                self.evictions += 1
+
+    def __make_public(self, response: Response, max_age: float) -> None:
+        """
+        Lets shared caches keep the response, keyed on the same request headers as this cache
+        """
+        response.cache_control.max_age = int(max_age)
+        response.cache_control.public = True
+        response.vary = tuple(response.vary or ()) + tuple(name for name in self.vary
+                                                           if name not in (response.vary or ()))
+
+    def __remove(self, key: tuple) -> None:
+        self.size -= len(self.__entries.pop(key)[3])
+
+
+def mark_window_changing(request: Request) -> None:
+    """
+    Tells the response cache that the response for this window can still change even if it ended a while ago,
+    so it is treated like a recent window
+    :param request: the Pyramid request
+    :return: None
+    """
+    request.window_changing = True
+
+
+def response_cache_view(view, info):
+    """
+    View deriver that serves GET requests of HISTORICAL_ROUTES from the registry's response_cache
+    """
+    if info.options.get("route_name") not in HISTORICAL_ROUTES:
+        return view
+
+    def cached_view(context, request):
+        cache = request.registry.response_cache
+
+        # windows that touch now aren't looked up when recent_ttl is 0
+        if cache is None or request.method != "GET" or cache.get_ttl(request) <= 0:
+            return view(context, request)
+
+        # the rendered response also depends on the site and the negotiated format
+        key = (request.site, request.matched_route.name, tuple(sorted(request.matchdict.items())),
+               tuple(sorted(request.GET.items())), request.headers.get("Accept", ""))
+
+        response = cache.get(key)
+
+        if response is not None:
+            return response
+
+        response = view(context, request)
+        # the view may have marked the window as changing
+        ttl = cache.get_ttl(request)
+
+        if response.status_code == 200 and ttl > 0:
+            cache.set(key, response, ttl)
+
+        return response
+
+    return cached_view
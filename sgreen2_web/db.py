@@ -0,0 +1,113 @@
+from pymongo import MongoClient, ReadPreference, WriteConcern
+
+DEFAULT_DATABASE = "greenhouse"
+
+# .ini setting to (MongoClient option, type). Settings that aren't given keep pymongo's default
+CLIENT_OPTIONS = {
+    "mongo.max_pool_size": ("maxPoolSize", int),
+    "mongo.min_pool_size": ("minPoolSize", int),
+    "mongo.max_idle_time_ms": ("maxIdleTimeMS", int),
+    "mongo.wait_queue_timeout_ms": ("waitQueueTimeoutMS", int),
+    "mongo.connect_timeout_ms": ("connectTimeoutMS", int),
+    "mongo.socket_timeout_ms": ("socketTimeoutMS", int),
+    "mongo.server_selection_timeout_ms": ("serverSelectionTimeoutMS", int),
+    "mongo.compressors": ("compressors", str),
+    "mongo.zlib_compression_level": ("zlibCompressionLevel", int),
+    "mongo.app_name": ("appname", str)
+}
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST
+}
+
+# the read/write profiles endpoints pick from and their defaults:
+# history: GETs of data readings, the actuator state log and uptime, which can be a little stale
+# readings: data reading inserts, which are high volume and can be unacknowledged (0)
+# heartbeats: greenhouse server pings, which are high volume but need a reply to extend an uptime interval
+# rollups: rollup buckets and high-water marks, a lost high-water mark write rolls a window up twice or never
+# control: settings and actuator changes, which must not be lost
+READ_PROFILES = {
+    "history": "secondaryPreferred"
+}
+WRITE_PROFILES = {
+    "readings": "1",
+    "heartbeats": "1",
+    "rollups": "1",
+    "control": "majority"
+}
+
+
+def get_database_name(settings: dict) -> str:
+    return settings.get("mongo.database", DEFAULT_DATABASE)
+
+
+def create_client(settings: dict, **kwargs) -> MongoClient:
+    """
+    Creates the MongoClient with the pool, timeout and compression settings from the .ini file
+    :param settings: the app settings
+    :param kwargs: more MongoClient options, such as event_listeners
+    :return: the MongoClient
+    """
+    options = dict()
+
+    for setting, (option, option_type) in CLIENT_OPTIONS.items():
+        if settings.get(setting, "") != "":
+            options[option] = option_type(settings[setting])
+
+    options.update(kwargs)
+
+    return MongoClient(settings["mongo_uri"], **options)
+
+
+def _get_write_concern(setting: str, value: str, timeout_ms: int) -> WriteConcern:
+    if value == "majority":
+        return WriteConcern(w="majority", wtimeout=timeout_ms)
+
+    try:
+        w = int(value)
+    except ValueError:
+        raise ValueError(setting + " must be majority or a number of members, 0 for unacknowledged")
+
+    return WriteConcern(w=w, wtimeout=timeout_ms if w > 1 else None)
+
+
+def get_databases(client: MongoClient, settings: dict, name: str = None) -> dict:
+    """
+    Gets the database once per read/write profile. mongo.read_preference.<profile> and
+    mongo.write_concern.<profile> in the .ini file override the defaults
+    :param client: the MongoClient
+    :param settings: the app settings
+    :param name: the name of the database, defaults to mongo.database
+    :return: a dict of profile to Database, None is the database with the client's defaults
+    """
+    if name is None:
+        name = get_database_name(settings)
+    timeout_ms = int(settings.get("mongo.write_concern_timeout_ms", 5000)) or None
+
+    databases = {None: client.get_database(name)}
+
+    for profile, default in READ_PROFILES.items():
+        setting = "mongo.read_preference." + profile
+        mode = settings.get(setting, default)
+
+        if mode not in READ_PREFERENCES:
+            raise ValueError(setting + " must be one of " + ", ".join(READ_PREFERENCES))
+
+        databases[profile] = client.get_database(name, read_preference=READ_PREFERENCES[mode])
+
+    for profile, default in WRITE_PROFILES.items():
+        setting = "mongo.write_concern." + profile
+        write_concern = _get_write_concern(setting, settings.get(setting, default), timeout_ms)
+        databases[profile] = client.get_database(name, write_concern=write_concern)
+
+    if not databases["heartbeats"].write_concern.acknowledged:
+        raise ValueError("mongo.write_concern.heartbeats can't be 0, extending an uptime interval needs the reply")
+
+    if not databases["rollups"].write_concern.acknowledged:
+        raise ValueError("mongo.write_concern.rollups can't be 0, a lost high-water mark write breaks the rollups")
+
+    return databases
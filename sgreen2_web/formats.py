@@ -0,0 +1,86 @@
+from pyramid.request import Request
+from pyramid.response import Response
+
+from sgreen2_web.renderers import default
+
+try:
+    # msgpack is optional, without it clients get JSON
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def process_response_format(request: Request, stream_format: str) -> tuple:
+    """
+    Gets the encoding from the format query param or the Accept header and the shape from the shape query param
+    :param request: the Pyramid request
+    :param stream_format: the streaming format asked for, if any
+    :return: a tuple of ("json" or "msgpack", True if the response should be columnar)
+    """
+    encoding = JSON
+
+    if "format" in request.GET.keys():
+        encoding = request.GET.getone("format")
+
+        if encoding not in (JSON, MSGPACK):
+            raise ValueError("format must be one of " + JSON + ", " + MSGPACK)
+
+        if encoding == MSGPACK and msgpack is None:
+            raise ValueError("format " + MSGPACK + " is not available")
+    elif msgpack is not None and any(content_type in request.headers.get("Accept", "")
+                                     for content_type in MSGPACK_CONTENT_TYPES):
+        encoding = MSGPACK
+
+    shape = request.GET.get("shape", "rows")
+
+    if shape not in ("rows", "columnar"):
+        raise ValueError("shape must be one of rows, columnar")
+
+    if stream_format and (encoding == MSGPACK or shape == "columnar"):
+        raise ValueError("stream can only be used with JSON rows")
+
+    return encoding, shape == "columnar"
+
+
+def to_columnar(documents, get_group, columns: dict) -> dict:
+    """
+    Turns documents into parallel arrays per group so key names aren't repeated for every document
+    :param documents: an iterable of documents
+    :param get_group: a function that returns the group of a document, such as the sensor name
+    :param columns: maps each output array name to the document field it holds
+    :return: a dict of group to a dict of array name to values, in the order of the documents
+    """
+    columnar = dict()
+
+    for document in documents:
+        key = get_group(document)
+
+        if key not in columnar:
+            columnar[key] = {name: list() for name in columns}
+
+        group = columnar[key]
+
+        for name, field in columns.items():
+            group[name].append(document.get(field))
+
+    return columnar
+
+
+def make_response(request: Request, data, encoding: str) -> Response:
+    """
+    Gets the response to send data with, streamed pages are written by streaming.stream_page instead
+    :param request: the Pyramid request
+    :param data: a list of documents or a columnar dict
+    :param encoding: "json" or "msgpack"
+    :return: a MessagePack response, or request.response if the json renderer should be used
+    """
+    if encoding == MSGPACK:
+        return Response(body=msgpack.packb(data, use_bin_type=True, default=default),
+                        content_type=MSGPACK_CONTENT_TYPES[0])
+
+    return request.response
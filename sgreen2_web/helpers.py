@@ -1,6 +1,12 @@
+import base64
 import time
 
+from bson import json_util
+from pymongo import ReturnDocument
+from pymongo.cursor import Cursor
+from pymongo.database import Database
 from pyramid.request import Request
+from pyramid.response import Response
 
 
 def process_start_time_end_time(request: Request) -> tuple:
@@ -29,3 +35,163 @@ def process_start_time_end_time(request: Request) -> tuple:
 
 def get_timestamp() -> int:
     return int(time.time()) * 1000
+
+
+def next_sequence(db: Database, name: str, count: int = 1) -> int:
+    """
+    Atomically increments a counter in the counters collection
+    :param db: the greenhouse database
+    :param name: the name of the counter
+    :param count: how many values to reserve, the caller owns every value up to the one returned
+    :return: the new value of the counter, starting at 1
+    """
+    counter = db.counters.find_one_and_update({"_id": name}, {"$inc": {"seq": count}},
+                                              upsert=True,
+                                              return_document=ReturnDocument.AFTER)
+    return counter["seq"]
+
+
+# milliseconds in each duration unit
+DURATION_UNITS = {
+    "s": 1000,
+    "m": 60 * 1000,
+    "h": 60 * 60 * 1000,
+    "d": 24 * 60 * 60 * 1000
+}
+
+
+def parse_duration(duration: str, param_name: str) -> int:
+    """
+    Parses a duration such as 30s, 5m, 1h or 1d, or a plain number of milliseconds
+    :param duration: the duration string
+    :param param_name: the name of the query param, used in the error message
+    :return: the duration in milliseconds
+    """
+    try:
+        if duration[-1:] in DURATION_UNITS:
+            milliseconds = int(duration[:-1]) * DURATION_UNITS[duration[-1]]
+        else:
+            milliseconds = int(duration)
+    except ValueError:
+        milliseconds = 0
+
+    if milliseconds <= 0:
+        raise ValueError(param_name + " must be a positive duration such as 30s, 5m, 1h, 1d or milliseconds")
+
+    return milliseconds
+
+
+# largest page a paginated endpoint returns if max_page_size is not set in the .ini file
+DEFAULT_MAX_PAGE_SIZE = 10000
+
+
+def get_max_page_size(request: Request) -> int:
+    """
+    Gets the largest number of documents or buckets an endpoint returns at once
+    :param request: the Pyramid request
+    :return: the maximum page size
+    """
+    return int(request.registry.settings.get("max_page_size", DEFAULT_MAX_PAGE_SIZE))
+
+
+def process_limit(request: Request) -> int:
+    """
+    Gets the page size from the request. Defaults to and is capped at the maximum page size
+    :param request: the Pyramid request
+    :return: the page size
+    """
+    max_page_size = get_max_page_size(request)
+
+    if "limit" not in request.GET.keys():
+        return max_page_size
+
+    try:
+        limit = int(request.GET.getone("limit"))
+    except ValueError:
+        limit = 0
+
+    if limit <= 0:
+        raise ValueError("limit must be a positive integer")
+
+    return min(limit, max_page_size)
+
+
+def process_page_cursor(request: Request, key_types: tuple, param: str = "next") -> list:
+    """
+    Gets the sort key of the last document of the previous page from the opaque next query param
+    :param request: the Pyramid request
+    :param key_types: the type of each value of the sort key, such as (str, int, ObjectId)
+    :param param: the query param that holds the cursor
+    :return: the sort key values or None if this is the first page
+    """
+    if param not in request.GET.keys():
+        return None
+
+    key = decode_page_cursor(request.GET.getone(param))
+
+    # the values go into the query, so a dict such as {"$ne": 1} must not get through as a timestamp
+    if not isinstance(key, list) or len(key) != len(key_types) or \
+            not all(isinstance(value, key_type) and not isinstance(value, bool)
+                    for value, key_type in zip(key, key_types)):
+        raise ValueError(param + " is not a valid cursor")
+
+    return key
+
+
+def paginate(cursor: Cursor, limit: int, get_key) -> tuple:
+    """
+    Reads one page off a cursor that was queried with a limit of one more than the page size
+    :param cursor: the pymongo cursor or a list, sorted by the sort key
+    :param limit: the page size
+    :param get_key: a function that returns the sort key values of a document
+    :return: a tuple of the page without _id and the opaque cursor for the next page (None if this is the last page)
+    """
+    page = list(cursor)
+    next_cursor = None
+
+    if len(page) > limit:
+        page.pop()
+        next_cursor = encode_page_cursor(get_key(page[-1]))
+
+    for document in page:
+        document.pop("_id", None)
+
+    return page, next_cursor
+
+
+def encode_page_cursor(key: list) -> str:
+    """
+    :param key: the sort key values of the last document of a page
+    :return: the opaque cursor process_page_cursor reads back
+    """
+    return base64.urlsafe_b64encode(json_util.dumps(key).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_page_cursor(token: str):
+    """
+    :param token: an opaque cursor from encode_page_cursor
+    :return: the values it holds, unchecked, or None if it can't be decoded
+    """
+    try:
+        return json_util.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("utf-8"))
+    except Exception:
+        # anything from bad base64 to extended JSON such as {"$oid": "zz"} or {"$date": "bad"}
+        return None
+
+
+def add_next_cursor_headers(request: Request, response: Response, next_cursor: str) -> None:
+    """
+    Adds the X-Next-Cursor and Link headers pointing to the next page
+    :param request: the Pyramid request
+    :param response: the response to add the headers to
+    :param next_cursor: the opaque cursor for the next page or None if this is the last page
+    :return: None
+    """
+    if next_cursor is None:
+        return
+
+    query = [(key, value) for key, value in request.GET.items() if key != "next"]
+    query.append(("next", next_cursor))
+
+    response.headers["X-Next-Cursor"] = next_cursor
+    response.headers["Link"] = "<" + request.current_route_url(_query=query) + ">; rel=\"next\""
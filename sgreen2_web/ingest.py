@@ -0,0 +1,185 @@
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+
+from pymongo.database import Database
+
+log = logging.getLogger(__name__)
+
+
+class IngestionQueueFull(Exception):
+    pass
+
+
+class IngestionQueue(object):
+    """
+    Bounded in process queue of writes that a background thread flushes to the database
+    in batches, once batch_size items are waiting or the oldest has waited flush_interval seconds.
+    Each kind of item has a handler that writes a list of them
+    """
+
+    def __init__(self, db: Database, handlers: dict, max_size: int, batch_size: int, flush_interval: float):
+        """
+        :param db: the greenhouse database
+        :param handlers: maps each kind of item to a function taking the database and a list of items
+        :param max_size: how many items can wait before put raises IngestionQueueFull
+        :param batch_size: flush once this many items are waiting
+        :param flush_interval: flush once the oldest item has waited this many seconds
+        """
+        self.db = db
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # counters, only written by the flusher thread except for enqueued and rejected
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.failed = 0
+        self.flushes = 0
+        self.flush_seconds_total = 0.0
+        self.last_flush_seconds = 0.0
+
+        self.__queue = queue.Queue(max_size)
+        self.__lock = threading.Lock()
+        self.__stopping = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name="ingestion-flusher", daemon=True)
+        self.__thread.start()
+
+    @property
+    def depth(self) -> int:
+        """
+        :return: how many items are waiting to be written
+        """
+        return self.__queue.qsize()
+
+    def put(self, kind: str, item, db: Database = None) -> None:
+        """
+        Queues an item to be written without blocking
+        :param kind: the kind of item, one of the handler keys
+        :param item: the item
+        :param db: the database to write it to, such as the readings database of a site, defaults to the queue's
+        :return: None
+        """
+        # close stops under the same lock, so every item queued before it is there for the final drain
+        with self.__lock:
+            if self.__stopping.is_set():
+                raise IngestionQueueFull("ingestion queue is shutting down")
+
+            try:
+                self.__queue.put_nowait((kind, item, db if db is not None else self.db))
+            except queue.Full:
+                self.rejected += 1
+                raise IngestionQueueFull("ingestion queue is full")
+
+            self.enqueued += 1
+
+    def close(self, timeout: float = 30.0) -> None:
+        """
+        Stops taking items and waits for everything queued to be written
+        :param timeout: how many seconds to wait for the flusher thread
+        :return: None
+        """
+        with self.__lock:
+            self.__stopping.set()
+
+        # wakes the flusher if it is waiting on an empty queue, a full one wakes it anyway
+        try:
+            self.__queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+        self.__thread.join(timeout)
+
+    def __run(self) -> None:
+        pending = list()
+        deadline = None
+
+        while True:
+            timeout = self.flush_interval if deadline is None else max(0.0, deadline - time.monotonic())
+
+            try:
+                item = self.__queue.get(timeout=timeout)
+
+                # None is only put by close to wake this thread up
+                if item is not None:
+                    pending.append(item)
+
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+            except queue.Empty:
+                pass
+
+            if self.__stopping.is_set():
+                # drain whatever is left and stop
+                while True:
+                    try:
+                        item = self.__queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    if item is not None:
+                        pending.append(item)
+
+                self.__flush(pending)
+                return
+
+            if pending and (len(pending) >= self.batch_size or time.monotonic() >= deadline):
+                self.__flush(pending)
+                pending = list()
+                deadline = None
+
+    def __flush(self, pending: list) -> None:
+        if not pending:
+            return
+
+        # (kind, database name) to (database, items)
+        batches = dict()
+        for kind, item, db in pending:
+            batches.setdefault((kind, db.name), (db, list()))[1].append(item)
+
+        start = time.perf_counter()
+
+        for (kind, _), (db, items) in batches.items():
+            try:
+                self.handlers[kind](db, items)
+                self.flushed += len(items)
+            except Exception:
+                self.failed += len(items)
+                log.exception("failed to write %d queued %s", len(items), kind)
+
+        self.last_flush_seconds = time.perf_counter() - start
+        self.flush_seconds_total += self.last_flush_seconds
+        self.flushes += 1
+
+        log.debug("flushed %d queued items in %.1f ms, %d waiting", len(pending), self.last_flush_seconds * 1000,
+                  self.depth)
+
+
+def close_on_sigterm(ingest_queue: IngestionQueue) -> None:
+    """
+    Writes everything still queued when the process gets SIGTERM, which is how Heroku stops dynos. The default
+    action of SIGTERM doesn't run atexit handlers. Signal handlers can only be installed from the main thread
+    :param ingest_queue: the ingestion queue
+    :return: None
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        ingest_queue.close()
+
+        if callable(previous):
+            previous(signum, frame)
+            return
+
+        # the previous action, such as exiting, is taken as if the handler was never installed
+        signal.signal(signum, previous if previous is not None else signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
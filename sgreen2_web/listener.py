@@ -0,0 +1,218 @@
+import logging
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from sgreen2_web.db import create_client, get_databases
+from sgreen2_web.ingest import IngestionQueue, IngestionQueueFull, close_on_sigterm
+from sgreen2_web.metrics import CONTENT_TYPE, write_ingest_queue, write_listener
+from sgreen2_web.readings import UnitConverter, build_data_readings, get_unit_converter, insert_data_readings
+
+log = logging.getLogger(__name__)
+
+# the largest UDP payload
+MAX_DATAGRAM_SIZE = 65507
+
+
+def parse_line(line: str) -> dict:
+    """
+    Parses a line of the line protocol, "sensor_type,name value [unit]", for example "temp,temp01 21.5 temp_c"
+    :param line: the line without the newline
+    :return: the data reading in the same shape POST /data_readings takes
+    """
+    fields = line.split()
+
+    if len(fields) not in (2, 3) or fields[0].count(",") != 1:
+        raise Exception("line must be 'sensor_type,name value [unit]'")
+
+    sensor_type, name = fields[0].split(",")
+
+    body = {
+        "sensor": {
+            "type": sensor_type,
+            "name": name
+        },
+        "reading": fields[1]
+    }
+
+    if len(fields) == 3:
+        body["unit"] = fields[2]
+
+    return body
+
+
+class LineProtocolListener(object):
+    """
+    Turns line protocol lines into data readings and queues them to be written in batches.
+    Bad lines and lines that don't fit in the queue are dropped, the sender isn't told
+    """
+
+    def __init__(self, ingest_queue: IngestionQueue, converter: UnitConverter):
+        self.ingest_queue = ingest_queue
+        self.converter = converter
+
+        # counters
+        self.lock = threading.Lock()
+        self.received = 0
+        self.invalid = 0
+        self.dropped = 0
+
+    def handle_line(self, line: bytes) -> None:
+        self.handle_lines([line])
+
+    def handle_lines(self, lines: list) -> None:
+        """
+        Converts the lines together so readings of the same sensor and unit are converted in one call
+        :param lines: the lines as bytes
+        :return: None
+        """
+        lines = [line.decode("utf-8", "replace").strip() for line in lines]
+        # blank lines and comments
+        lines = [line for line in lines if line and not line.startswith("#")]
+
+        if not lines:
+            return
+
+        bodies = list()
+
+        for line in lines:
+            try:
+                bodies.append(parse_line(line))
+            except Exception as err:
+                bodies.append(err)
+
+        data_readings = build_data_readings([None if isinstance(body, Exception) else body for body in bodies],
+                                            self.converter)
+
+        with self.lock:
+            self.received += len(lines)
+
+        for line, body, data_reading in zip(lines, bodies, data_readings):
+            if isinstance(body, Exception):
+                data_reading = body
+
+            try:
+                if isinstance(data_reading, Exception):
+                    raise data_reading
+
+                self.ingest_queue.put("data_readings", data_reading)
+            except IngestionQueueFull as err:
+                with self.lock:
+                    self.dropped += 1
+                log.warning("dropped %r: %s", line, err)
+            except ValueError:
+                with self.lock:
+                    self.invalid += 1
+                log.debug("invalid line %r: data reading must be of type float", line)
+            except Exception as err:
+                with self.lock:
+                    self.invalid += 1
+                log.debug("invalid line %r: %s", line, err)
+
+
+class _UDPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data = self.request[0]
+
+        # a datagram can hold many lines
+        self.server.listener.handle_lines(data.splitlines())
+
+
+class _TCPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            self.server.listener.handle_line(line)
+
+
+class _UDPServer(socketserver.UDPServer):
+    allow_reuse_address = True
+    max_packet_size = MAX_DATAGRAM_SIZE
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        lines = list()
+        write_listener(lines, self.server.listener)
+        write_ingest_queue(lines, self.server.listener.ingest_queue)
+        body = ("\n".join(lines) + "\n").encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class _MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(settings: dict) -> None:
+    """
+    Listens for line protocol data readings over UDP and/or TCP until interrupted
+    :param settings: the app settings from the .ini file
+    :return: None
+    """
+    db = get_databases(create_client(settings), settings)["readings"]
+
+    ingest_queue = IngestionQueue(db, {"data_readings": insert_data_readings},
+                                  max_size=int(settings.get("ingest.queue_size", 10000)),
+                                  batch_size=int(settings.get("ingest.batch_size", 500)),
+                                  flush_interval=float(settings.get("ingest.flush_interval", 1)))
+    close_on_sigterm(ingest_queue)
+    listener = LineProtocolListener(ingest_queue, get_unit_converter(settings))
+
+    host = settings.get("listener.host", "0.0.0.0")
+    udp_port = int(settings.get("listener.udp_port", 0))
+    tcp_port = int(settings.get("listener.tcp_port", 0))
+    metrics_port = int(settings.get("listener.metrics_port", 0))
+
+    servers = list()
+
+    if udp_port:
+        servers.append(("UDP", _UDPServer((host, udp_port), _UDPHandler)))
+
+    if tcp_port:
+        servers.append(("TCP", _TCPServer((host, tcp_port), _TCPHandler)))
+
+    if not servers:
+        raise ValueError("set listener.udp_port and/or listener.tcp_port")
+
+    # the listener runs in its own process so it serves its own GET /metrics
+    if metrics_port:
+        servers.append(("metrics", _MetricsServer((host, metrics_port), _MetricsHandler)))
+
+    threads = list()
+
+    for protocol, server in servers:
+        server.listener = listener
+        thread = threading.Thread(target=server.serve_forever, name=protocol + "-listener", daemon=True)
+        thread.start()
+        threads.append(thread)
+        log.info("%s listener on %s:%d", protocol, host, server.server_address[1])
+
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for protocol, server in servers:
+            server.shutdown()
+            server.server_close()
+
+        # write whatever is still queued
+        ingest_queue.close()
@@ -0,0 +1,361 @@
+import logging
+import queue
+import threading
+import time
+
+import pymongo
+from bson import ObjectId
+from pymongo import CursorType
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+
+from sgreen2_web.helpers import decode_page_cursor, get_timestamp
+from sgreen2_web.renderers import dumps
+
+log = logging.getLogger(__name__)
+
+EVENT_STREAM_CONTENT_TYPE = "text/event-stream"
+
+
+def format_event(document: dict, event_id: str) -> bytes:
+    """
+    Formats a data reading as a Server-Sent Event
+    :param document: the data reading
+    :param event_id: the id of the event, a client that reconnects sends the last one back as Last-Event-ID
+    :return: the event
+    """
+    data = dict(document)
+    data.pop("_id")
+
+    return b"id: " + event_id.encode("ascii") + b"\nevent: data_reading\ndata: " + dumps(data) + b"\n\n"
+
+
+def parse_event_id(event_id: str, overlap_ms: int):
+    """
+    Parses the id of an event, such as a Last-Event-ID header. Event ids are ResumePoint keys as encode_page_cursor
+    encodes them. The timestamp and _id of a data reading joined by a dash, what event ids used to be, are read as the
+    resume point of that one data reading
+    :param event_id: the event id
+    :param overlap_ms: how far before the newest timestamp to re-read
+    :return: the ResumePoint, or None if it isn't one
+    """
+    timestamp, _, _id = event_id.partition("-")
+
+    if timestamp.isdigit() and ObjectId.is_valid(_id):
+        return ResumePoint.from_key([int(timestamp), [[int(timestamp), ObjectId(_id)]]], overlap_ms)
+
+    key = decode_page_cursor(event_id)
+
+    try:
+        return ResumePoint.from_key(key, overlap_ms)
+    except (TypeError, ValueError):
+        return None
+
+
+class ResumePoint(object):
+    """
+    Where a feed or a client picks up again. _ids are generated by the app and listener processes, so they aren't
+    in insertion order across processes and resuming with _id > last _id skips documents. Timestamps are only a few
+    seconds out of insertion order, so resuming re-reads from the newest timestamp less an overlap and skips the _ids
+    that were already handed out
+    """
+
+    def __init__(self, overlap_ms: int):
+        """
+        :param overlap_ms: how far before the newest timestamp to re-read, longer than the ingest flush interval
+        """
+        self.overlap_ms = overlap_ms
+        self.newest = None
+        # _id to timestamp of the documents handed out since newest - overlap_ms
+        self.seen = dict()
+        self.__prune_at = 1000
+
+    def add(self, document: dict) -> bool:
+        """
+        Records a document that is handed out
+        :param document: the document, with _id and timestamp
+        :return: False if it was handed out before
+        """
+        if document["_id"] in self.seen:
+            return False
+
+        timestamp = document["timestamp"]
+
+        if self.newest is None or timestamp > self.newest:
+            self.newest = timestamp
+
+        if timestamp >= self.newest - self.overlap_ms:
+            self.seen[document["_id"]] = timestamp
+
+            if len(self.seen) >= self.__prune_at:
+                self.prune()
+                self.__prune_at = max(1000, 2 * len(self.seen))
+
+        return True
+
+    def prune(self) -> None:
+        since = self.newest - self.overlap_ms
+        self.seen = {_id: timestamp for _id, timestamp in self.seen.items() if timestamp >= since}
+
+    def get_key(self) -> list:
+        """
+        :return: the resume point as a cursor key, from_key reads it back
+        """
+        self.prune()
+        return [self.newest, [[timestamp, _id] for _id, timestamp in self.seen.items()]]
+
+    @classmethod
+    def from_key(cls, key: list, overlap_ms: int):
+        """
+        :param key: a cursor key from get_key
+        :param overlap_ms: how far before the newest timestamp to re-read
+        :return: the ResumePoint
+        """
+        newest, seen = key
+
+        if type(newest) is not int or not isinstance(seen, list) or \
+                not all(isinstance(pair, list) and len(pair) == 2 and type(pair[0]) is int and
+                        isinstance(pair[1], ObjectId) for pair in seen):
+            raise ValueError("not a valid resume point")
+
+        resume_point = cls(overlap_ms)
+        resume_point.newest = newest
+        resume_point.seen = {_id: timestamp for timestamp, _id in seen}
+
+        return resume_point
+
+    def query(self, query: dict) -> dict:
+        """
+        :param query: the documents that are followed
+        :return: the query that reads them again from the resume point, skip the ones add returns False for
+        """
+        return dict(query, timestamp={"$gte": self.newest - self.overlap_ms})
+
+
+class LiveFeedFull(Exception):
+    pass
+
+
+class LiveClient(object):
+    """
+    One connected client of a feed. Documents wait in a bounded queue until the response writes them out,
+    a client that falls too far behind is dropped and can resume with Last-Event-ID
+    """
+
+    def __init__(self, queue_size: int, match=None):
+        """
+        :param queue_size: how many documents can wait before the client is dropped
+        :param match: only the documents this returns True for are queued, all of them if None
+        """
+        self.queue = queue.Queue(queue_size)
+        self.match = match
+        self.dropped = False
+
+    def push(self, document: dict) -> None:
+        if self.match is not None and not self.match(document):
+            return
+
+        try:
+            self.queue.put_nowait(document)
+        except queue.Full:
+            self.dropped = True
+
+
+class TailingFeed(object):
+    """
+    Follows the new documents of a capped collection that match a query with a single tailable await cursor
+    and hands each one to every connected client
+    """
+
+    def __init__(self, collection: Collection, query: dict, name: str, max_await_seconds: float,
+                 resume_overlap_seconds: float):
+        """
+        :param collection: the capped collection
+        :param query: the documents to follow
+        :param name: what the feed is called in thread names and logs
+        :param max_await_seconds: how long a getMore waits for new documents
+        :param resume_overlap_seconds: how far back the feed re-reads when its cursor dies, see ResumePoint
+        """
+        self.collection = collection
+        self.query = query
+        self.name = name
+        self.max_await_seconds = max_await_seconds
+        self.resume_overlap_seconds = resume_overlap_seconds
+
+        self.clients = set()
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def subscribe(self, client: LiveClient) -> None:
+        with self.__lock:
+            self.clients.add(client)
+
+            # the cursor thread stops when the last client leaves and starts again with the next one
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name="live-feed-" + self.name, daemon=True)
+                self.__thread.start()
+
+    def unsubscribe(self, client: LiveClient) -> None:
+        with self.__lock:
+            self.clients.discard(client)
+
+    def __has_clients(self) -> bool:
+        with self.__lock:
+            if not self.clients:
+                self.__thread = None
+                return False
+
+            return True
+
+    def __start(self) -> ResumePoint:
+        """
+        Starts from the newest document. The documents already there are marked as handed out,
+        clients read the ones they missed with a normal query
+        """
+        resume_point = ResumePoint(int(self.resume_overlap_seconds * 1000))
+        latest = self.collection.find_one(self.query, projection={"timestamp": 1},
+                                          sort=[("$natural", pymongo.DESCENDING)])
+        resume_point.newest = latest["timestamp"] if latest is not None else get_timestamp()
+
+        for document in self.collection.find(resume_point.query(self.query), projection={"timestamp": 1}):
+            resume_point.add(document)
+
+        return resume_point
+
+    def __run(self) -> None:
+        resume_point = None
+
+        # once __has_clients returns False another thread may be started, so this one must stop right away
+        while self.__has_clients():
+            try:
+                if resume_point is None:
+                    resume_point = self.__start()
+
+                # tailable cursors can't use an index, the first batch scans the capped collection in insertion order
+                cursor = self.collection.find(resume_point.query(self.query),
+                                              cursor_type=CursorType.TAILABLE_AWAIT,
+                                              max_await_time_ms=int(self.max_await_seconds * 1000))
+
+                while cursor.alive:
+                    for document in cursor:
+                        # the overlap re-reads documents that were handed out before the cursor died
+                        if not resume_point.add(document):
+                            continue
+
+                        with self.__lock:
+                            clients = list(self.clients)
+
+                        for client in clients:
+                            client.push(document)
+
+                    # no new documents within the await time
+                    if not self.__has_clients():
+                        cursor.close()
+                        return
+            except PyMongoError:
+                log.exception("live feed %s failed, retrying", self.name)
+
+            # the cursor dies if the collection is empty or the feed fell behind the end of the capped collection
+            time.sleep(1)
+
+
+class LiveFeeds(object):
+    """
+    The feed of each site and sensor type, shared by every client of this process
+    """
+
+    def __init__(self, max_clients: int, client_queue_size: int, keepalive_seconds: float,
+                 max_await_seconds: float = 1.0, resume_overlap_seconds: float = 5.0):
+        """
+        :param max_clients: how many clients can be connected at once, each one holds a server thread
+        :param client_queue_size: how many documents can wait for a client before it is dropped
+        :param keepalive_seconds: how often an idle client is sent a comment, which also finds clients that are gone
+        :param max_await_seconds: how long a getMore waits for new documents
+        :param resume_overlap_seconds: how far back a feed or a client with Last-Event-ID re-reads, see ResumePoint
+        """
+        self.max_clients = max_clients
+        self.client_queue_size = client_queue_size
+        self.keepalive_seconds = keepalive_seconds
+        self.max_await_seconds = max_await_seconds
+        self.resume_overlap_seconds = resume_overlap_seconds
+
+        # (database name, sensor type) to TailingFeed
+        self.feeds = dict()
+        self.__lock = threading.Lock()
+
+    @property
+    def client_count(self) -> int:
+        return sum(len(feed.clients) for feed in list(self.feeds.values()))
+
+    def subscribe(self, db: Database, sensor_type: str) -> tuple:
+        """
+        Connects a client to the feed of a sensor type
+        :param db: the greenhouse database of the client's site
+        :param sensor_type: the sensor type
+        :return: a tuple of (feed, client)
+        """
+        with self.__lock:
+            if self.client_count >= self.max_clients:
+                raise LiveFeedFull("too many live clients")
+
+            feed = self.feeds.get((db.name, sensor_type))
+
+            if feed is None:
+                feed = self.feeds[(db.name, sensor_type)] = TailingFeed(
+                    db.data_readings, {"sensor.type": sensor_type}, db.name + "-data-readings-" + sensor_type,
+                    self.max_await_seconds, self.resume_overlap_seconds)
+
+            client = LiveClient(self.client_queue_size)
+            feed.subscribe(client)
+
+        return feed, client
+
+
+class ActuatorWatches(object):
+    """
+    Wakes the requests waiting on GET /actuators/{name}/state/watch when their actuator is switched. One feed per site
+    follows the actuators_state_log for every waiting request of this process
+    """
+
+    def __init__(self, max_waiters: int, max_timeout_seconds: float, queue_size: int = 100,
+                 max_await_seconds: float = 1.0, resume_overlap_seconds: float = 5.0):
+        """
+        :param max_waiters: how many requests can wait at once, each one holds a server thread
+        :param max_timeout_seconds: the longest a request can wait, below the timeout of any proxy in front
+        :param queue_size: how many switches can wait for a request before it stops being handed more
+        :param max_await_seconds: how long a getMore waits for new documents
+        :param resume_overlap_seconds: how far back the feed re-reads when its cursor dies, see ResumePoint
+        """
+        self.max_waiters = max_waiters
+        self.max_timeout_seconds = max_timeout_seconds
+        self.queue_size = queue_size
+        self.max_await_seconds = max_await_seconds
+        self.resume_overlap_seconds = resume_overlap_seconds
+
+        # database name to TailingFeed
+        self.feeds = dict()
+        self.__lock = threading.Lock()
+
+    def subscribe(self, db: Database, name: str) -> tuple:
+        """
+        Starts watching for switches of an actuator, unsubscribe the client from the feed when done
+        :param db: the greenhouse database of the actuator's site
+        :param name: the name of the actuator
+        :return: a tuple of (feed, client), the client is handed the actuator's new state log entries
+        """
+        with self.__lock:
+            if sum(len(feed.clients) for feed in self.feeds.values()) >= self.max_waiters:
+                raise LiveFeedFull("too many requests are watching actuators")
+
+            feed = self.feeds.get(db.name)
+
+            if feed is None:
+                feed = self.feeds[db.name] = TailingFeed(db.actuators_state_log, dict(),
+                                                         db.name + "-actuators-state-log", self.max_await_seconds,
+                                                         self.resume_overlap_seconds)
+
+            client = LiveClient(self.queue_size, lambda entry: entry["name"] == name)
+            feed.subscribe(client)
+
+        return feed, client
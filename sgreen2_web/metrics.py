@@ -0,0 +1,271 @@
+import bisect
+import logging
+import threading
+import time
+
+from pymongo import monitoring
+from pyramid.registry import Registry
+from pyramid.request import Request
+
+log = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram(object):
+    """
+    Cumulative histogram in the Prometheus sense, with a sum and a count
+    """
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    Request and Mongo command metrics of this process. Recorded by the tween and MongoCommandListener,
+    read by GET /metrics
+    """
+
+    def __init__(self, slow_request_seconds: float = 0):
+        """
+        :param slow_request_seconds: requests slower than this are logged with their Mongo commands, 0 turns it off
+        """
+        self.slow_request_seconds = slow_request_seconds
+
+        self.lock = threading.Lock()
+        # (route, method) to Histogram
+        self.request_seconds = dict()
+        self.response_bytes = dict()
+        # (route, method, status) to count
+        self.responses = dict()
+        # (collection, command) to Histogram
+        self.command_seconds = dict()
+        # (collection, command) to count
+        self.command_failures = dict()
+
+        # the Mongo commands of the request being handled by this thread, only kept for the slow request log
+        self.current = threading.local()
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float, size: int = None) -> None:
+        with self.lock:
+            _get_histogram(self.request_seconds, (route, method), LATENCY_BUCKETS).observe(seconds)
+
+            if size is not None:
+                _get_histogram(self.response_bytes, (route, method), SIZE_BUCKETS).observe(size)
+
+            key = (route, method, str(status))
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def observe_command(self, collection: str, command: str, seconds: float, failed: bool = False) -> None:
+        with self.lock:
+            _get_histogram(self.command_seconds, (collection, command), LATENCY_BUCKETS).observe(seconds)
+
+            if failed:
+                key = (collection, command)
+                self.command_failures[key] = self.command_failures.get(key, 0) + 1
+
+    def render(self, ingest_queue=None, response_cache=None) -> str:
+        """
+        Writes the metrics in the Prometheus text format
+        :param ingest_queue: the IngestionQueue, if buffered ingestion is on
+        :param response_cache: the ResponseCache, if it is on
+        :return: the metrics
+        """
+        lines = list()
+
+        with self.lock:
+            write_histograms(lines, "sgreen2_http_request_duration_seconds", "Time to handle a request",
+                             ("route", "method"), self.request_seconds)
+            write_histograms(lines, "sgreen2_http_response_size_bytes",
+                             "Size of responses with a known length", ("route", "method"), self.response_bytes)
+            write_counters(lines, "sgreen2_http_responses_total", "Responses by status",
+                           ("route", "method", "status"), self.responses)
+            write_histograms(lines, "sgreen2_mongo_command_duration_seconds", "Time the Mongo server took",
+                             ("collection", "command"), self.command_seconds)
+            write_counters(lines, "sgreen2_mongo_command_failures_total", "Mongo commands that failed",
+                           ("collection", "command"), self.command_failures)
+
+        if ingest_queue is not None:
+            write_ingest_queue(lines, ingest_queue)
+
+        if response_cache is not None:
+            write_response_cache(lines, response_cache)
+
+        return "\n".join(lines) + "\n"
+
+
+def _get_histogram(histograms: dict, key: tuple, buckets: tuple) -> Histogram:
+    histogram = histograms.get(key)
+
+    if histogram is None:
+        histogram = histograms[key] = Histogram(buckets)
+
+    return histogram
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for name, value in zip(names, values))
+
+
+def write_histograms(lines: list, name: str, description: str, label_names: tuple, histograms: dict) -> None:
+    lines.append("# HELP {} {}".format(name, description))
+    lines.append("# TYPE {} histogram".format(name))
+
+    for key, histogram in sorted(histograms.items()):
+        labels = _format_labels(label_names, key)
+        cumulative = 0
+
+        for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative))
+
+        lines.append("{}_sum{{{}}} {}".format(name, labels, histogram.sum))
+        lines.append("{}_count{{{}}} {}".format(name, labels, histogram.count))
+
+
+def write_counters(lines: list, name: str, description: str, label_names: tuple, counters: dict) -> None:
+    lines.append("# HELP {} {}".format(name, description))
+    lines.append("# TYPE {} counter".format(name))
+
+    for key, count in sorted(counters.items()):
+        lines.append("{}{{{}}} {}".format(name, _format_labels(label_names, key), count))
+
+
+def write_value(lines: list, name: str, metric_type: str, description: str, value) -> None:
+    lines.append("# HELP {} {}".format(name, description))
+    lines.append("# TYPE {} {}".format(name, metric_type))
+    lines.append("{} {}".format(name, value))
+
+
+def write_ingest_queue(lines: list, ingest_queue) -> None:
+    write_value(lines, "sgreen2_ingest_queue_depth", "gauge", "Items waiting to be written", ingest_queue.depth)
+    write_value(lines, "sgreen2_ingest_enqueued_total", "counter", "Items queued", ingest_queue.enqueued)
+    write_value(lines, "sgreen2_ingest_rejected_total", "counter", "Items rejected because the queue was full",
+                ingest_queue.rejected)
+    write_value(lines, "sgreen2_ingest_flushed_total", "counter", "Items written", ingest_queue.flushed)
+    write_value(lines, "sgreen2_ingest_failed_total", "counter", "Items that could not be written",
+                ingest_queue.failed)
+    write_value(lines, "sgreen2_ingest_flushes_total", "counter", "Batches written", ingest_queue.flushes)
+    write_value(lines, "sgreen2_ingest_flush_seconds_total", "counter", "Time spent writing batches",
+                ingest_queue.flush_seconds_total)
+
+
+def write_response_cache(lines: list, response_cache) -> None:
+    write_value(lines, "sgreen2_response_cache_hits_total", "counter", "Responses served from the cache",
+                response_cache.hits)
+    write_value(lines, "sgreen2_response_cache_misses_total", "counter", "Cacheable requests not in the cache",
+                response_cache.misses)
+    write_value(lines, "sgreen2_response_cache_evictions_total", "counter", "Responses evicted to stay in budget",
+                response_cache.evictions)
+    write_value(lines, "sgreen2_response_cache_entries", "gauge", "Responses in the cache", response_cache.count)
+    write_value(lines, "sgreen2_response_cache_bytes", "gauge", "Bytes of responses in the cache",
+                response_cache.size)
+
+
+def write_listener(lines: list, listener) -> None:
+    write_value(lines, "sgreen2_listener_lines_received_total", "counter", "Line protocol lines received",
+                listener.received)
+    write_value(lines, "sgreen2_listener_lines_invalid_total", "counter", "Lines that were not valid data readings",
+                listener.invalid)
+    write_value(lines, "sgreen2_listener_lines_dropped_total", "counter", "Lines dropped because the queue was full",
+                listener.dropped)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Times every command the MongoClient sends by collection and command name
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        # (connection, request id) to (collection, command, filter) of commands waiting for a reply
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        command = event.command
+        # getMore names its collection in a field of its own
+        collection = command.get("collection" if event.command_name == "getMore" else event.command_name)
+
+        if not isinstance(collection, str):
+            # commands like ping and isMaster aren't run on a collection
+            collection = ""
+
+        query = command.get("filter", command.get("pipeline", command.get("updates", command.get("deletes"))))
+
+        with self.lock:
+            self.pending[(event.connection_id, event.request_id)] = (collection, event.command_name, query)
+
+    def succeeded(self, event):
+        self.__finish(event, False)
+
+    def failed(self, event):
+        self.__finish(event, True)
+
+    def __finish(self, event, failed: bool) -> None:
+        with self.lock:
+            pending = self.pending.pop((event.connection_id, event.request_id), None)
+
+        if pending is None:
+            return
+
+        collection, command, query = pending
+        seconds = event.duration_micros / 1000000.0
+        self.metrics.observe_command(collection, command, seconds, failed)
+
+        commands = getattr(self.metrics.current, "commands", None)
+
+        if commands is not None:
+            commands.append((collection, command, query, seconds))
+
+
+def metrics_tween_factory(handler, registry: Registry):
+    """
+    Records the latency, status and response size of every request by route and method
+    """
+    metrics = registry.metrics
+
+    def metrics_tween(request: Request):
+        if metrics.slow_request_seconds:
+            metrics.current.commands = list()
+
+        start = time.perf_counter()
+        status = 500
+        size = None
+
+        try:
+            response = handler(request)
+            status = response.status_code
+            size = response.content_length
+            return response
+        finally:
+            seconds = time.perf_counter() - start
+            matched_route = getattr(request, "matched_route", None)
+            route = matched_route.name if matched_route is not None else "unmatched"
+            metrics.observe_request(route, request.method, status, seconds, size)
+
+            if metrics.slow_request_seconds:
+                commands = metrics.current.commands
+                metrics.current.commands = None
+
+                if seconds >= metrics.slow_request_seconds:
+                    log.warning("slow request %s %s took %.1f ms: %s", request.method, request.path_qs,
+                                seconds * 1000, "; ".join(
+                                    "{} {} {} {:.1f} ms".format(command, collection, query, command_seconds * 1000)
+                                    for collection, command, query, command_seconds in commands) or "no Mongo commands")
+
+    return metrics_tween
@@ -0,0 +1,237 @@
+import functools
+
+from pymongo.database import Database
+
+from sgreen2_web.helpers import get_timestamp
+
+
+@functools.lru_cache(maxsize=None)
+def load_numpy():
+    """
+    numpy converts a whole batch of readings at once but it is optional. It is imported when the first batch is
+    converted so it doesn't slow down startup
+    :return: the numpy module, or None if it isn't installed
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    return numpy
+
+
+class LinearConversion(object):
+    """
+    Converts readings with reading * scale + offset, then clamps them to [minimum, maximum].
+    Unit conversions and sensor calibrations are both linear so they combine into one conversion
+    """
+
+    def __init__(self, scale: float = 1.0, offset: float = 0.0, minimum: float = None, maximum: float = None):
+        self.scale = scale
+        self.offset = offset
+        self.minimum = float("-inf") if minimum is None else float(minimum)
+        self.maximum = float("inf") if maximum is None else float(maximum)
+
+    def then(self, calibration: "LinearConversion") -> "LinearConversion":
+        """
+        Combines this conversion with a calibration applied after it. The result is clamped to this conversion's range
+        :param calibration: the calibration of the sensor
+        :return: a conversion that does both
+        """
+        return LinearConversion(self.scale * calibration.scale,
+                                self.offset * calibration.scale + calibration.offset,
+                                self.minimum, self.maximum)
+
+    def convert(self, readings: list) -> list:
+        """
+        Converts a batch of readings in one call
+        :param readings: the readings as floats
+        :return: the converted readings as floats, in the same order
+        """
+        numpy = load_numpy()
+
+        if numpy is not None:
+            return numpy.clip(numpy.asarray(readings, dtype=float) * self.scale + self.offset,
+                              self.minimum, self.maximum).tolist()
+
+        scale, offset, minimum, maximum = self.scale, self.offset, self.minimum, self.maximum
+        return [min(max(reading * scale + offset, minimum), maximum) for reading in readings]
+
+
+# readings are stored in Fahrenheit, % soil moisture, % humidity, volts and rpm. The units the RAML lists that are
+# already in those (temp_f, soil_percent, humid_percent, batt_volts, fanspeed_rpm) and unknown units are left as is
+DEFAULT_CONVERSIONS = {
+    ("temp", "temp_c"): LinearConversion(9.0 / 5.0, 32),
+    ("soil", "soil_raw"): LinearConversion(100.0 / 1023.0, maximum=100)
+}
+
+IDENTITY = LinearConversion()
+
+
+class UnitConverter(object):
+    """
+    Registry of unit conversions keyed by (sensor type, unit) and calibrations keyed by sensor name
+    """
+
+    def __init__(self, conversions: dict = None, calibrations: dict = None):
+        self.conversions = dict(DEFAULT_CONVERSIONS)
+        self.conversions.update(conversions or dict())
+        self.calibrations = dict(calibrations or dict())
+
+    def register(self, sensor_type: str, unit: str, conversion: LinearConversion) -> None:
+        self.conversions[(sensor_type, unit.lower())] = conversion
+
+    def calibrate(self, name: str, calibration: LinearConversion) -> None:
+        self.calibrations[name] = calibration
+
+    def get_conversion(self, sensor_type: str, unit: str, name: str) -> LinearConversion:
+        """
+        Gets the conversion for readings of a sensor given in a unit
+        :param sensor_type: the type of the sensor
+        :param unit: the unit of the readings, None if none was given
+        :param name: the name of the sensor
+        :return: the unit conversion followed by the sensor's calibration
+        """
+        conversion = IDENTITY
+
+        if unit is not None:
+            conversion = self.conversions.get((sensor_type, unit.lower()), IDENTITY)
+
+        if name in self.calibrations:
+            conversion = conversion.then(self.calibrations[name])
+
+        return conversion
+
+    def convert(self, sensor_type: str, unit: str, name: str, readings: list) -> list:
+        """
+        Converts a batch of readings from one sensor given in one unit
+        :param sensor_type: the type of the sensor
+        :param unit: the unit of the readings, None if none was given
+        :param name: the name of the sensor
+        :param readings: the readings as floats
+        :return: the converted readings
+        """
+        return self.get_conversion(sensor_type, unit, name).convert(readings)
+
+
+def _parse_numbers(key: str, value: str, count: int) -> list:
+    try:
+        numbers = [float(number) for number in value.split()]
+    except ValueError:
+        numbers = list()
+
+    if not 0 < len(numbers) <= count:
+        raise ValueError(key + " must be up to " + str(count) + " numbers separated by spaces")
+
+    return numbers
+
+
+def get_unit_converter(settings: dict) -> UnitConverter:
+    """
+    Builds the unit converter from the .ini settings:
+    unit.<sensor type>.<unit> = <scale> [offset] [minimum] [maximum] adds or replaces a unit conversion and
+    calibration.<sensor name> = <gain> [offset] is applied to a sensor's readings after the unit conversion
+    :param settings: the app settings
+    :return: the unit converter
+    """
+    converter = UnitConverter()
+
+    for key, value in settings.items():
+        if key.startswith("unit.") and key.count(".") == 2:
+            _, sensor_type, unit = key.split(".")
+            converter.register(sensor_type, unit, LinearConversion(*_parse_numbers(key, value, 4)))
+        elif key.startswith("calibration."):
+            converter.calibrate(key[len("calibration."):], LinearConversion(*_parse_numbers(key, value, 2)))
+
+    return converter
+
+
+def _validate(body) -> dict:
+    if not (isinstance(body, dict) and "reading" in body and "sensor" in body and
+            "type" in body["sensor"] and "name" in body["sensor"]):
+        raise Exception("Required fields not met")
+
+    if not (isinstance(body["sensor"]["type"], str) and isinstance(body["sensor"]["name"], str)):
+        raise Exception("sensor type and name must be strings")
+
+    if not isinstance(body.get("unit", ""), str):
+        raise Exception("unit must be a string")
+
+    return {
+        "timestamp": get_timestamp(),
+        "reading": float(body["reading"]),
+        "sensor": {
+            "type": body["sensor"]["type"],
+            "name": body["sensor"]["name"]
+        }
+    }
+
+
+def build_data_readings(bodies: list, converter: UnitConverter) -> list:
+    """
+    Validates posted data readings and converts them to the documents stored in the database.
+    Readings are grouped by sensor and unit so each group is converted in one call.
+    Used by POST /data_readings and the line protocol listener so both follow the same rules
+    :param bodies: the posted data readings
+    :param converter: the unit converter
+    :return: the data reading document for each body, or the exception that made it invalid, in the same order
+    """
+    data_readings = list()
+    # (sensor type, unit, name) to the indexes of its data readings
+    groups = dict()
+
+    for i, body in enumerate(bodies):
+        try:
+            data_reading = _validate(body)
+        except Exception as err:
+            data_readings.append(err)
+            continue
+
+        data_readings.append(data_reading)
+        sensor = data_reading["sensor"]
+        groups.setdefault((sensor["type"], body.get("unit"), sensor["name"]), list()).append(i)
+
+    for (sensor_type, unit, name), indexes in groups.items():
+        readings = converter.convert(sensor_type, unit, name, [data_readings[i]["reading"] for i in indexes])
+
+        for i, reading in zip(indexes, readings):
+            data_readings[i]["reading"] = reading
+
+            if sensor_type == "batt":
+                data_readings[i]["health"] = battery_health(reading)
+
+    return data_readings
+
+
+def build_data_reading(body: dict, converter: UnitConverter) -> dict:
+    """
+    Validates a posted data reading and converts it to the document stored in the database
+    :param body: the posted data reading
+    :param converter: the unit converter
+    :return: the data reading document
+    """
+    data_reading = build_data_readings([body], converter)[0]
+
+    if isinstance(data_reading, Exception):
+        raise data_reading
+
+    return data_reading
+
+
+def battery_health(volts: float) -> str:
+    if volts > 5:
+        return "good"
+    elif volts > 4:
+        return "low"
+    else:
+        return "critical"
+
+
+def insert_data_readings(db: Database, data_readings: list) -> None:
+    """
+    Writes a batch of queued data readings
+    :param db: the greenhouse database
+    :param data_readings: the data reading documents
+    :return: None
+    """
+    db.data_readings.insert_many(data_readings, ordered=False)
@@ -0,0 +1,65 @@
+import json
+
+from bson import json_util
+
+try:
+    # orjson is much faster than the standard library but it is optional
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """
+    Encodes the values the JSON backends don't know about
+    :param obj: the value to encode
+    :return: a JSON serializable value
+    """
+    # pymongo cursors and other iterables are written out as arrays
+    if hasattr(obj, "__iter__") and not isinstance(obj, (str, bytes, dict)):
+        return list(obj)
+
+    # ObjectId, datetime, Decimal128, etc. become MongoDB extended JSON
+    return json_util.default(obj)
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(value) -> bytes:
+        """
+        Encodes a value, including BSON types and pymongo cursors, as JSON in a single pass
+        :param value: the value to encode
+        :return: the UTF-8 encoded JSON
+        """
+        return orjson.dumps(value, default=default, option=_ORJSON_OPTIONS)
+else:
+    def dumps(value) -> bytes:
+        """
+        Encodes a value, including BSON types and pymongo cursors, as JSON in a single pass
+        :param value: the value to encode
+        :return: the UTF-8 encoded JSON
+        """
+        return json.dumps(value, default=default, separators=(",", ":")).encode("utf-8")
+
+
+class BSONJSONRenderer(object):
+    """
+    Pyramid renderer that replaces the default json renderer. Views can return
+    documents and cursors straight from pymongo instead of round tripping them
+    through json_util first
+    """
+
+    def __init__(self, info):
+        self.info = info
+
+    def __call__(self, value, system):
+        request = system.get("request")
+
+        if request is not None:
+            response = request.response
+
+            if response.content_type == response.default_content_type:
+                response.content_type = "application/json"
+
+        return dumps(value)
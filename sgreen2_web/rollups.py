@@ -0,0 +1,248 @@
+import collections
+import heapq
+import itertools
+import logging
+import time
+
+import pymongo
+from pymongo import ReplaceOne
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+
+from sgreen2_web.db import create_client, get_databases
+from sgreen2_web.helpers import get_timestamp
+from sgreen2_web.tenancy import Tenants
+
+log = logging.getLogger(__name__)
+
+# a tier holds the min, max, mean and count of the data readings of each sensor per bucket
+RollupTier = collections.namedtuple("RollupTier", ["name", "bucket", "collection"])
+
+# finest first, each tier is rolled up from the one before it so it outlives the capped data_readings
+TIERS = (
+    RollupTier("1m", 60 * 1000, "data_readings_1m"),
+    RollupTier("1h", 60 * 60 * 1000, "data_readings_1h"),
+    RollupTier("1d", 24 * 60 * 60 * 1000, "data_readings_1d"),
+)
+
+
+def pick_tier(resolution: int, time_range: int) -> RollupTier:
+    """
+    Picks the coarsest tier whose buckets are no larger than the resolution or the time range
+    :param resolution: the largest bucket size the client wants in milliseconds, or None for data readings
+    :param time_range: end_time - start_time in milliseconds
+    :return: the tier, or None if only the data readings themselves are fine enough
+    """
+    if resolution is None:
+        return None
+
+    fits = [tier for tier in TIERS if tier.bucket <= resolution and tier.bucket <= time_range]
+
+    return fits[-1] if fits else None
+
+
+def bucket_pipeline(sensor_type: str, timestamp: dict, bucket: int, rolled_up: bool = False) -> list:
+    """
+    Builds the aggregation that groups data readings, or the buckets of a finer tier, into buckets that start on
+    multiples of the bucket size since the Unix epoch
+    :param sensor_type: the type of data reading
+    :param timestamp: the condition on timestamp, such as {"$gte": start_time, "$lt": end_time}
+    :param bucket: the bucket size in milliseconds
+    :param rolled_up: whether the documents are buckets of a finer tier instead of data readings
+    :return: the pipeline, its documents are shaped like the documents of a tier
+    """
+    if rolled_up:
+        group = {
+            "min": {"$min": "$min"},
+            "max": {"$max": "$max"},
+            # means are weighted by their counts
+            "total": {"$sum": {"$multiply": ["$mean", "$count"]}},
+            "count": {"$sum": "$count"}
+        }
+        mean = {"$divide": ["$total", "$count"]}
+    else:
+        group = {
+            "min": {"$min": "$reading"},
+            "max": {"$max": "$reading"},
+            "mean": {"$avg": "$reading"},
+            "count": {"$sum": 1}
+        }
+        mean = 1
+
+    group["_id"] = {
+        "name": "$sensor.name",
+        "timestamp": {"$subtract": ["$timestamp", {"$mod": ["$timestamp", bucket]}]}
+    }
+
+    return [
+        # filters on type and timestamp so the type_timestamp_id_index is used
+        {"$match": {"sensor.type": sensor_type, "timestamp": timestamp}},
+        {"$group": group},
+        # same ordering as GET /data_readings
+        {"$sort": {"_id.name": pymongo.ASCENDING, "_id.timestamp": pymongo.DESCENDING}},
+        {"$project": {
+            "_id": 0,
+            "sensor": {
+                "type": {"$literal": sensor_type},
+                "name": "$_id.name"
+            },
+            "timestamp": "$_id.timestamp",
+            "min": 1,
+            "max": 1,
+            "mean": mean,
+            "count": 1
+        }}
+    ]
+
+
+def get_rolled_up_to(db: Database, tier: RollupTier) -> int:
+    """
+    Gets the high-water mark of a tier, every bucket before it is complete
+    :param db: the greenhouse database
+    :param tier: the tier
+    :return: the timestamp, or None if the tier was never rolled up
+    """
+    state = db.rollup_state.find_one({"_id": tier.name})
+    return state["rolled_up_to"] if state is not None else None
+
+
+def roll_up(db: Database, lag: int, max_buckets: int, now: int = None) -> dict:
+    """
+    Rolls up the complete buckets after each tier's high-water mark. Buckets are replaced whole,
+    so running it again or from two processes at once does no harm
+    :param db: the greenhouse database
+    :param lag: how long after a bucket ends data readings may still arrive for it, in milliseconds
+    :param max_buckets: the most buckets of each sensor to roll up per tier per run, bounds the first runs
+    :param now: the current timestamp, defaults to the current time
+    :return: a dict of tier name to how many buckets were written
+    """
+    if now is None:
+        now = get_timestamp()
+
+    written = dict()
+    source = db.data_readings
+    source_end = now - lag
+
+    for i, tier in enumerate(TIERS):
+        start = get_rolled_up_to(db, tier)
+
+        if start is None:
+            # the oldest document of the source, data readings and buckets are inserted in time order
+            first = source.find_one(projection={"_id": 0, "timestamp": 1}, sort=[("$natural", pymongo.ASCENDING)])
+
+            if first is None:
+                break
+
+            start = first["timestamp"] - first["timestamp"] % tier.bucket
+
+        # only buckets the source has completely covered
+        end = min(source_end - source_end % tier.bucket, start + max_buckets * tier.bucket)
+        written[tier.name] = 0
+
+        if end > start:
+            for sensor_type in source.distinct("sensor.type"):
+                buckets = list(source.aggregate(bucket_pipeline(sensor_type, {"$gte": start, "$lt": end},
+                                                                tier.bucket, rolled_up=i > 0)))
+
+                if buckets:
+                    db[tier.collection].bulk_write([
+                        ReplaceOne({"sensor.type": sensor_type, "sensor.name": b["sensor"]["name"],
+                                    "timestamp": b["timestamp"]}, b, upsert=True)
+                        for b in buckets
+                    ], ordered=False)
+                    written[tier.name] += len(buckets)
+
+            db.rollup_state.update_one({"_id": tier.name}, {"$set": {"rolled_up_to": end}}, upsert=True)
+        else:
+            end = start
+
+        source = db[tier.collection]
+        source_end = end
+
+    return written
+
+
+def find_rollups(db: Database, tier: RollupTier, sensor_type: str, start_time: int, end_time: int,
+                 after: list, limit: int) -> list:
+    """
+    Gets the buckets of a tier that overlap the time range, sorted by sensor name ascending then by timestamp
+    descending. Buckets after the tier's high-water mark are aggregated from the data readings
+    :param db: the greenhouse database
+    :param tier: the tier
+    :param sensor_type: the type of data reading
+    :param start_time: the start of the time range
+    :param end_time: the end of the time range
+    :param after: the [name, timestamp] of the last bucket of the previous page, or None for the first page
+    :param limit: the most buckets to return
+    :return: a list of buckets
+    """
+    start = start_time - start_time % tier.bucket
+    rolled_up_to = get_rolled_up_to(db, tier) or start
+
+    query = {
+        "sensor.type": sensor_type,
+        "timestamp": {
+            "$gte": start,
+            "$lte": end_time,
+            "$lt": rolled_up_to
+        }
+    }
+
+    # seek past the last bucket of the previous page instead of skipping
+    if after is not None:
+        name, timestamp = after
+        query["$or"] = [
+            {"sensor.name": {"$gt": name}},
+            {"sensor.name": name, "timestamp": {"$lt": timestamp}}
+        ]
+
+    rollups = db[tier.collection].find(filter=query, projection={"_id": 0},
+                                       sort=[("sensor.name", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)],
+                                       limit=limit)
+
+    # the newest buckets haven't been rolled up yet, there are at most a few per sensor
+    recent = list()
+
+    if end_time >= rolled_up_to:
+        recent = [b for b in db.data_readings.aggregate(bucket_pipeline(
+            sensor_type, {"$gte": max(start, rolled_up_to), "$lte": end_time}, tier.bucket))
+                  if after is None or (b["sensor"]["name"], -b["timestamp"]) > (after[0], -after[1])]
+
+    buckets = heapq.merge(recent, rollups, key=lambda b: (b["sensor"]["name"], -b["timestamp"]))
+
+    return list(itertools.islice(buckets, limit))
+
+
+def serve(settings: dict) -> None:
+    """
+    Rolls up the data readings of the default database and every site every rollup.interval seconds until interrupted
+    :param settings: the app settings from the .ini file
+    :return: None
+    """
+    client = create_client(settings)
+    tenants = Tenants(client, settings)
+
+    interval = float(settings.get("rollup.interval", 60))
+    lag = int(float(settings.get("rollup.lag", 60)) * 1000)
+    max_buckets = int(settings.get("rollup.max_buckets", 1440))
+
+    while True:
+        try:
+            sites = [None] + tenants.list_sites()
+        except PyMongoError:
+            log.exception("listing the sites failed, rolling up the default database")
+            sites = [None]
+
+        for site in sites:
+            name = tenants.get_database_name(site)
+            start = time.perf_counter()
+
+            try:
+                written = roll_up(get_databases(client, settings, name)["rollups"], lag, max_buckets)
+                summary = ", ".join("{} {}".format(count, tier) for tier, count in written.items())
+                log.info("rolled up %s of %s in %.0f ms", summary or "nothing", name,
+                         (time.perf_counter() - start) * 1000)
+            except PyMongoError:
+                log.exception("rollup of %s failed, retrying in %s seconds", name, interval)
+
+        time.sleep(interval)
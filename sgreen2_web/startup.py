@@ -0,0 +1,57 @@
+import configparser
+import logging
+import os
+import time
+
+from pyramid.registry import Registry
+
+log = logging.getLogger(__name__)
+
+
+def load_settings(config_file: str, section: str = "app:main") -> dict:
+    """
+    Reads the app settings from a .ini file without paste.deploy, which needs the package installed
+    to resolve "use = egg:..." and is why every boot used to run setup.py develop
+    :param config_file: the .ini file
+    :param section: the section holding the settings
+    :return: the settings
+    """
+    parser = configparser.ConfigParser(defaults={"here": os.path.dirname(os.path.abspath(config_file))})
+
+    if not parser.read(config_file):
+        raise ValueError(config_file + " could not be read")
+
+    return {key: value for key, value in parser.items(section)
+            if key not in parser.defaults() and key != "use"}
+
+
+def warm_up(registry: Registry) -> None:
+    """
+    Does the work the first requests would otherwise pay for: connects to Mongo, primes the settings cache
+    and imports the modules the views import lazily
+    :param registry: the Pyramid registry after the app is configured
+    :return: None
+    """
+    from sgreen2_web.readings import load_numpy
+    from sgreen2_web.views.settings import RESTSettings
+
+    start = time.perf_counter()
+    db = registry.databases[None]
+
+    # opens a connection to the primary, and to a secondary for the history profile if there is one
+    db.command("ping")
+    registry.databases["history"].command("ping", read_preference=registry.databases["history"].read_preference)
+
+    RESTSettings.refresh_cache(db, registry.settings_cache)
+
+    # the first query of every controller poll
+    db.actuators.find_one(projection={"_id": 0, "version": 1}, sort=[("version", -1)])
+
+    # imported by POST /settings when it's first called
+    import dateutil.parser
+    import validate_email
+
+    # imported by the first POST /data_readings
+    load_numpy()
+
+    log.info("warmed up in %.0f ms", (time.perf_counter() - start) * 1000)
@@ -0,0 +1,124 @@
+from types import GeneratorType
+
+from pymongo.cursor import Cursor
+from pyramid.request import Request
+from pyramid.response import Response
+
+from sgreen2_web.helpers import encode_page_cursor
+from sgreen2_web.renderers import dumps
+
+NDJSON = "ndjson"
+JSON_ARRAY = "json"
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# how many documents pymongo fetches from the server per round trip while streaming
+STREAM_BATCH_SIZE = 500
+
+
+def get_stream_format(request: Request) -> str:
+    """
+    Gets the streaming format asked for by the stream query param or the Accept header
+    :param request: the Pyramid request
+    :return: "ndjson", "json" or None if the response should not be streamed
+    """
+    if "stream" in request.GET.keys():
+        stream_format = request.GET.getone("stream")
+
+        if stream_format not in (NDJSON, JSON_ARRAY):
+            raise ValueError("stream must be one of " + NDJSON + ", " + JSON_ARRAY)
+
+        return stream_format
+
+    if NDJSON_CONTENT_TYPE in request.headers.get("Accept", ""):
+        return NDJSON
+
+    return None
+
+
+def stream_cursor(cursor: Cursor, stream_format: str) -> Response:
+    """
+    Builds a response that writes out documents as they come off the cursor
+    so the whole result is never held in memory
+    :param cursor: the pymongo cursor to stream
+    :param stream_format: "ndjson" for newline delimited JSON or "json" for a chunked JSON array
+    :return: a Pyramid response
+    """
+    cursor.batch_size(STREAM_BATCH_SIZE)
+
+    return stream_documents(cursor, stream_format)
+
+
+def stream_page(cursor, limit: int, get_key, stream_format: str) -> Response:
+    """
+    Builds a response that writes out one page of a cursor as the documents come off it, like stream_cursor.
+    The cursor for the next page is only known once the page is written, so if there is another page the
+    response ends with a {"next": cursor} record instead of the X-Next-Cursor header
+    :param cursor: the pymongo cursor queried with a limit of one more than the page size, or a list
+    :param limit: the page size
+    :param get_key: a function that returns the sort key values of a document, as for helpers.paginate
+    :param stream_format: "ndjson" for newline delimited JSON or "json" for a chunked JSON array
+    :return: a Pyramid response
+    """
+    if isinstance(cursor, Cursor):
+        cursor.batch_size(STREAM_BATCH_SIZE)
+
+    return stream_documents(_page_iter(cursor, limit, get_key), stream_format)
+
+
+def stream_documents(documents, stream_format: str) -> Response:
+    """
+    Builds a response that encodes documents one at a time as they are written out
+    :param documents: an iterable of documents, such as a pymongo cursor or a page of documents
+    :param stream_format: "ndjson" for newline delimited JSON or "json" for a chunked JSON array
+    :return: a Pyramid response
+    """
+    if stream_format == NDJSON:
+        return Response(app_iter=_ndjson_iter(documents), content_type=NDJSON_CONTENT_TYPE, charset="utf-8")
+
+    return Response(app_iter=_json_array_iter(documents), content_type="application/json", charset="utf-8")
+
+
+def _close(documents) -> None:
+    # cursors hold a server side cursor open until they are exhausted or closed, pages close theirs when closed
+    if isinstance(documents, (Cursor, GeneratorType)):
+        documents.close()
+
+
+def _page_iter(cursor, limit: int, get_key):
+    key = None
+
+    try:
+        for i, document in enumerate(cursor):
+            # the extra document only says there is another page
+            if i == limit:
+                yield {"next": encode_page_cursor(key)}
+                break
+
+            key = get_key(document)
+            document.pop("_id", None)
+            yield document
+    finally:
+        _close(cursor)
+
+
+def _ndjson_iter(documents):
+    try:
+        for document in documents:
+            yield dumps(document) + b"\n"
+    finally:
+        _close(documents)
+
+
+def _json_array_iter(documents):
+    try:
+        yield b"["
+
+        separator = b""
+        for document in documents:
+            yield separator + dumps(document)
+            separator = b","
+
+        yield b"]"
+    finally:
+        _close(documents)
@@ -0,0 +1,156 @@
+import re
+import threading
+import time
+
+from pymongo import MongoClient
+from pyramid.registry import Registry
+from pyramid.request import Request
+from pyramid.response import Response
+
+from sgreen2_web.db import get_database_name, get_databases
+
+# site names are part of a database name, which can't hold characters like / . or $
+SITE_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
+
+SITE_HEADER = "X-Greenhouse-Site"
+
+# /sites/<site>/... in tenancy.mode = path
+SITE_PATH = re.compile(r"^/sites/([^/]+)(/.*)?$")
+
+TENANCY_MODES = ("none", "header", "path")
+
+
+class UnknownSite(Exception):
+    pass
+
+
+def find_sites(client: MongoClient, database_prefix: str) -> list:
+    """
+    :param client: the MongoClient
+    :param database_prefix: the prefix of every site's database name
+    :return: the sites that have a database, sorted
+    """
+    return sorted(name[len(database_prefix):] for name in client.list_database_names()
+                  if name.startswith(database_prefix) and SITE_PATTERN.match(name[len(database_prefix):]))
+
+
+class Tenants(object):
+    """
+    The databases of every greenhouse site, all on one MongoClient and so one connection pool. Requests without a site
+    use mongo.database, a site uses the database tenancy.database_prefix + site
+    """
+
+    def __init__(self, client: MongoClient, settings: dict, check_interval: float = 10.0):
+        """
+        :param client: the MongoClient
+        :param settings: the app settings
+        :param check_interval: the least seconds between looking for newly provisioned sites
+        """
+        self.client = client
+        self.settings = settings
+        self.check_interval = check_interval
+
+        self.mode = settings.get("tenancy.mode", "none")
+
+        if self.mode not in TENANCY_MODES:
+            raise ValueError("tenancy.mode must be one of " + ", ".join(TENANCY_MODES))
+
+        self.database_prefix = settings.get("tenancy.database_prefix", get_database_name(settings) + "_")
+        # sites listed in the .ini file, if none are listed any site with a database is served
+        self.sites = set(site.strip() for site in settings.get("tenancy.sites", "").split(",") if site.strip())
+
+        # site to a dict of profile to Database, None is the default database
+        self.__databases = {None: get_databases(client, settings)}
+        self.__lock = threading.Lock()
+        # sites found by their database, looked for again at most every check_interval seconds
+        self.__found = set()
+        self.__checked_at = 0.0
+
+    def get_database_name(self, site: str) -> str:
+        return get_database_name(self.settings) if site is None else self.database_prefix + site
+
+    def get_databases(self, site: str) -> dict:
+        """
+        Gets the databases of a site, looked up once per site
+        :param site: the site, or None for the default database
+        :return: a dict of profile to Database as returned by db.get_databases
+        """
+        databases = self.__databases.get(site)
+
+        if databases is None:
+            if not self.is_site(site):
+                raise UnknownSite("site '" + str(site) + "' not found")
+
+            with self.__lock:
+                databases = self.__databases.setdefault(site, get_databases(self.client, self.settings,
+                                                                            self.get_database_name(site)))
+
+        return databases
+
+    def is_site(self, site: str) -> bool:
+        """
+        :param site: the site
+        :return: True if the site is listed in tenancy.sites, or if none are listed and its database exists
+        """
+        if not isinstance(site, str) or not SITE_PATTERN.match(site):
+            return False
+
+        if self.sites:
+            return site in self.sites
+
+        # so that requests for a site that doesn't exist can't list the databases every time
+        with self.__lock:
+            if site not in self.__found and time.monotonic() - self.__checked_at >= self.check_interval:
+                self.__found = set(self.list_sites())
+                self.__checked_at = time.monotonic()
+
+            return site in self.__found
+
+    def list_sites(self) -> list:
+        """
+        :return: the sites listed in tenancy.sites, or the sites that have a database if none are listed
+        """
+        if self.sites:
+            return sorted(self.sites)
+
+        return find_sites(self.client, self.database_prefix)
+
+    def get_site(self, request: Request) -> str:
+        """
+        Finds the site of a request. In path mode the /sites/<site> prefix is moved to the script name,
+        so routes match as usual and generated URLs keep the prefix
+        :param request: the Pyramid request
+        :return: the site, or None for the default database
+        """
+        if self.mode == "header":
+            return request.headers.get(SITE_HEADER) or None
+
+        if self.mode == "path":
+            match = SITE_PATH.match(request.path_info)
+
+            if match is not None:
+                request.script_name += "/sites/" + match.group(1)
+                request.path_info = match.group(2) or "/"
+                return match.group(1)
+
+        return None
+
+
+def tenancy_tween_factory(handler, registry: Registry):
+    """
+    Sets request.site and answers 404 for sites that don't exist
+    """
+    tenants = registry.tenants
+
+    def tenancy_tween(request: Request):
+        request.site = tenants.get_site(request)
+
+        if request.site is not None:
+            try:
+                tenants.get_databases(request.site)
+            except UnknownSite as err:
+                return Response(status_code=404, json_body={"message": str(err)})
+
+        return handler(request)
+
+    return tenancy_tween
@@ -0,0 +1,1770 @@
+import configparser
+import contextlib
+import io
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+
+class FunctionalTests(unittest.TestCase):
+    """
+    Runs the whole app, tweens and renderers included, against an in memory mongomock client
+    """
+    # .ini settings on top of the defaults, overridden by the test cases that need them
+    settings = dict()
+
+    def setUp(self):
+        import mongomock
+        from webtest import TestApp
+
+        from sgreen2_web import main
+
+        self.client = mongomock.MongoClient()
+
+        with mock.patch("sgreen2_web.create_client", return_value=self.client):
+            app = main({}, **dict({"mongo_uri": "mongodb://localhost:27017/greenhouse"}, **self.settings))
+
+        # main wraps the Pyramid app in the CORS middleware
+        self.registry = app.application.registry
+        self.testapp = TestApp(app)
+        self.db = self.client.greenhouse
+
+    def tearDown(self):
+        if self.registry.ingest_queue is not None:
+            self.registry.ingest_queue.close()
+
+    def add_actuator(self, name: str, state: bool = False, actuator_type: str = "fan", db=None) -> None:
+        (db if db is not None else self.db).actuators.insert_one({"name": name, "type": actuator_type, "state": state})
+
+    def add_data_readings(self, sensor_type: str, name: str, timestamps, db=None) -> None:
+        (db if db is not None else self.db).data_readings.insert_many([{
+            "timestamp": timestamp,
+            "reading": float(i),
+            "sensor": {"type": sensor_type, "name": name}
+        } for i, timestamp in enumerate(timestamps)])
+
+
+class PostDataReadingsTests(FunctionalTests):
+    def test_single_data_reading(self):
+        response = self.testapp.post_json("/data_readings", {"sensor": {"type": "temp", "name": "temp01"},
+                                                             "reading": "21.5"}, status=201)
+
+        # as documented, only a batch has a body
+        self.assertEqual(response.body, b"")
+        data_reading = self.db.data_readings.find_one()
+        self.assertEqual(data_reading["reading"], 21.5)
+        self.assertEqual(data_reading["sensor"], {"type": "temp", "name": "temp01"})
+
+    def test_json_array_reports_each_item(self):
+        response = self.testapp.post_json("/data_readings", [
+            {"sensor": {"type": "temp", "name": "temp01"}, "reading": 20},
+            {"sensor": {"type": "temp"}, "reading": 20},
+            {"sensor": {"type": "temp", "name": "temp02"}, "reading": "warm"},
+        ], status=207)
+
+        self.assertEqual(response.json["inserted"], 1)
+        self.assertEqual([result["status"] for result in response.json["results"]], [201, 400, 400])
+        self.assertEqual(self.db.data_readings.count_documents({}), 1)
+
+    def test_ndjson_body(self):
+        lines = [
+            json.dumps({"sensor": {"type": "soil", "name": "soil01"}, "reading": 40}),
+            "",
+            "not json",
+            json.dumps({"sensor": {"type": "soil", "name": "soil02"}, "reading": 41}),
+        ]
+
+        response = self.testapp.post("/data_readings", "\n".join(lines), content_type="application/x-ndjson",
+                                     status=207)
+
+        self.assertEqual([result["status"] for result in response.json["results"]], [201, 400, 201])
+        self.assertEqual(self.db.data_readings.count_documents({}), 2)
+
+    def test_empty_batch(self):
+        self.testapp.post_json("/data_readings", [], status=400)
+
+
+class StreamingTests(FunctionalTests):
+    def setUp(self):
+        super().setUp()
+
+        self.db.greenhouse_server_uptime.insert_many([
+            {"start_time": 1000, "end_time": 2000, "pings": 2},
+            {"start_time": 5000, "end_time": 9000, "pings": 5},
+        ])
+
+    def test_ndjson(self):
+        response = self.testapp.get("/greenhouse_server_state?start_time=0&end_time=10000&stream=ndjson")
+
+        self.assertEqual(response.content_type, "application/x-ndjson")
+        self.assertEqual([json.loads(line) for line in response.text.splitlines()], [
+            {"start_time": 5000, "end_time": 9000},
+            {"start_time": 1000, "end_time": 2000},
+        ])
+
+    def test_ndjson_from_accept_header(self):
+        response = self.testapp.get("/greenhouse_server_state?start_time=0&end_time=10000",
+                                    headers={"Accept": "application/x-ndjson"})
+
+        self.assertEqual(len(response.text.splitlines()), 2)
+
+    def test_chunked_json_array(self):
+        response = self.testapp.get("/greenhouse_server_state?start_time=0&end_time=10000&stream=json")
+
+        self.assertEqual(response.content_type, "application/json")
+        self.assertEqual(response.json, [
+            {"start_time": 5000, "end_time": 9000},
+            {"start_time": 1000, "end_time": 2000},
+        ])
+
+    def test_bad_stream_format(self):
+        self.testapp.get("/greenhouse_server_state?stream=xml", status=400)
+
+
+class RendererTests(unittest.TestCase):
+    def test_bson_types_match_json_util(self):
+        import datetime
+
+        from bson import ObjectId, json_util
+
+        from sgreen2_web.renderers import dumps
+
+        document = {
+            "_id": ObjectId("5bc7ae6f1c9d440000a1b2c3"),
+            "at": datetime.datetime(2018, 10, 17, 12, 0, tzinfo=datetime.timezone.utc),
+            "reading": 21.5
+        }
+
+        self.assertEqual(json.loads(dumps(document)), json.loads(json_util.dumps(document)))
+
+    def test_iterables_are_arrays(self):
+        from sgreen2_web.renderers import dumps
+
+        self.assertEqual(json.loads(dumps({"readings": (reading for reading in [1, 2, 3])})), {"readings": [1, 2, 3]})
+
+    def test_cursor_is_rendered(self):
+        import mongomock
+
+        from sgreen2_web.renderers import BSONJSONRenderer
+
+        collection = mongomock.MongoClient().greenhouse.actuators
+        collection.insert_one({"name": "fan01", "state": True})
+
+        body = BSONJSONRenderer(None)(collection.find(projection={"_id": 0}), {})
+
+        self.assertEqual(json.loads(body), [{"name": "fan01", "state": True}])
+
+
+class AggregateTests(FunctionalTests):
+    settings = {"max_page_size": "100"}
+
+    def test_buckets(self):
+        self.add_data_readings("temp", "temp01", [0, 30000, 60000, 90000])
+
+        response = self.testapp.get("/data_readings/aggregate?type=temp&bucket=1m&start_time=0&end_time=119999")
+
+        self.assertEqual([(bucket["timestamp"], bucket["count"], bucket["mean"]) for bucket in response.json],
+                         [(60000, 2, 2.5), (0, 2, 0.5)])
+
+    def test_too_many_buckets(self):
+        response = self.testapp.get("/data_readings/aggregate?type=temp&bucket=1s&start_time=0&end_time=100000",
+                                    status=400)
+
+        self.assertEqual(response.json["message"], "bucket is too small for the time range")
+
+    def test_most_buckets(self):
+        self.testapp.get("/data_readings/aggregate?type=temp&bucket=1s&start_time=0&end_time=99999", status=200)
+
+
+class PaginationTests(FunctionalTests):
+    def setUp(self):
+        super().setUp()
+
+        self.add_data_readings("temp", "temp01", [1000, 2000, 3000])
+        self.add_data_readings("temp", "temp02", [1000, 2000])
+
+    def test_pages_follow_the_sort_order(self):
+        url = "/data_readings?type=temp&start_time=0&end_time=10000&limit=2"
+        pages = list()
+
+        while url is not None:
+            response = self.testapp.get(url)
+            pages.append([(reading["sensor"]["name"], reading["timestamp"]) for reading in response.json])
+            url = url.split("&next=")[0] + "&next=" + response.headers["X-Next-Cursor"] \
+                if "X-Next-Cursor" in response.headers else None
+
+        self.assertEqual(pages, [
+            [("temp01", 3000), ("temp01", 2000)],
+            [("temp01", 1000), ("temp02", 2000)],
+            [("temp02", 1000)],
+        ])
+
+    def test_bad_cursor(self):
+        import base64
+
+        def encode(text):
+            return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii").rstrip("=")
+
+        self.add_actuator("fan01")
+        _id = '{"$oid": "5b0c3a7e9d1e8a2f4c6b1a2d"}'
+        cursors = {
+            "/data_readings?type=temp": [
+                "garbage", encode('["a", 1, {"$oid": "zz"}]'), encode('["a", {"$date": "bad"}, 1]'),
+                encode('["a", {"$numberDecimal": "x"}, 1]'), encode('[{"$ne": 1}, 1, 2]'),
+                encode('["temp01", {"$gt": 0}, ' + _id + ']'), encode('["temp01", true, ' + _id + ']'),
+                encode('["temp01", 1]')
+            ],
+            "/actuators/fan01/state?": [
+                "garbage", encode('[1, {"$oid": "zz"}]'), encode('[{"$date": "bad"}, ' + _id + ']'),
+                encode('[1, {"$numberDecimal": "x"}]'), encode('[{"$ne": 1}, ' + _id + ']'), encode('[1, 2]')
+            ]
+        }
+
+        for url in cursors:
+            for cursor in cursors[url]:
+                with self.subTest(url=url, cursor=cursor):
+                    response = self.testapp.get(url + "&next=" + cursor, status=400)
+                    self.assertEqual(response.json["message"], "next is not a valid cursor")
+
+    def test_streamed_page_ends_with_the_next_cursor(self):
+        url = "/data_readings?type=temp&start_time=0&end_time=10000&limit=2&stream=ndjson"
+        response = self.testapp.get(url)
+        records = [json.loads(line) for line in response.text.splitlines()]
+
+        self.assertNotIn("X-Next-Cursor", response.headers)
+        self.assertEqual([reading["timestamp"] for reading in records[:-1]], [3000, 2000])
+        self.assertEqual(list(records[-1].keys()), ["next"])
+
+        response = self.testapp.get(url + "&next=" + records[-1]["next"])
+        records = [json.loads(line) for line in response.text.splitlines()]
+
+        self.assertEqual([(reading["sensor"]["name"], reading["timestamp"]) for reading in records[:-1]],
+                         [("temp01", 1000), ("temp02", 2000)])
+
+    def test_last_streamed_page_has_no_cursor(self):
+        response = self.testapp.get("/data_readings?type=temp&start_time=0&end_time=10000&stream=json")
+
+        self.assertEqual(len(response.json), 5)
+        self.assertTrue(all("next" not in reading for reading in response.json))
+
+    def test_streamed_page_is_read_off_the_cursor(self):
+        from sgreen2_web.streaming import stream_page
+
+        read = list()
+
+        def cursor():
+            for timestamp in range(10):
+                read.append(timestamp)
+                yield {"_id": timestamp, "timestamp": timestamp}
+
+        app_iter = stream_page(cursor(), 3, lambda document: [document["timestamp"]], "ndjson").app_iter
+
+        self.assertEqual(json.loads(next(app_iter)), {"timestamp": 0})
+        self.assertEqual(read, [0])
+        self.assertEqual([json.loads(line) for line in app_iter][-1].keys(), {"next"})
+        self.assertEqual(read, [0, 1, 2, 3])
+
+
+class SettingsCacheTests(unittest.TestCase):
+    def test_entry_is_never_seen_before_its_check_time(self):
+        from sgreen2_web.cache import SettingsCache
+
+        cache = SettingsCache(5)
+        touch = cache.touch
+        seen = list()
+
+        # another thread checking while set is half done
+        def racing_touch(site=None):
+            seen.append(cache.needs_check(site))
+            touch(site)
+
+        with mock.patch.object(cache, "touch", racing_touch):
+            cache.set("1", {}, "north")
+
+        self.assertEqual(seen, [True])
+        self.assertFalse(cache.needs_check("north"))
+
+    def test_needs_check_after_the_interval(self):
+        from sgreen2_web.cache import SettingsCache
+
+        cache = SettingsCache(5)
+        cache.set("1", {})
+
+        with mock.patch("time.monotonic", return_value=time.monotonic() + 6):
+            self.assertTrue(cache.needs_check())
+
+
+class SettingsTests(FunctionalTests):
+    settings = {"settings_cache.check_interval": "0"}
+
+    def setUp(self):
+        super().setUp()
+
+        self.db.settings.insert_one({
+            "is_manual_mode": False,
+            "temperature": {"min": 60, "max": 80},
+            "soil_moisture": {"min": 20, "max": 40},
+            "lights": {"start_time": 6 * 3600, "end_time": 20 * 3600},
+            "watering_times": [7 * 3600],
+            "error_flush_times": [],
+            "email_addresses": [],
+            "version": 1
+        })
+
+    def test_not_modified(self):
+        response = self.testapp.get("/settings")
+
+        self.assertEqual(response.json["lights"], {"start_time": "06:00", "end_time": "20:00"})
+        self.testapp.get("/settings", headers={"If-None-Match": response.headers["ETag"]}, status=304)
+
+    def test_write_by_another_process_is_picked_up(self):
+        etag = self.testapp.get("/settings").headers["ETag"]
+
+        self.db.settings.update_one({}, {"$set": {"is_manual_mode": True}, "$inc": {"version": 1}})
+
+        response = self.testapp.get("/settings", headers={"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json["is_manual_mode"])
+
+
+class ActuatorVersionTests(FunctionalTests):
+    def setUp(self):
+        super().setUp()
+
+        self.add_actuator("fan01")
+        self.add_actuator("fan02")
+
+    def get_since(self, version: str) -> tuple:
+        response = self.testapp.get("/actuators?since_version=" + version)
+        return response.headers["X-Actuators-Version"], {actuator["name"]: actuator["state"]
+                                                         for actuator in response.json}
+
+    def test_switch_bumps_the_version(self):
+        etag = self.testapp.get("/actuators").headers["ETag"]
+        self.testapp.get("/actuators", headers={"If-None-Match": etag}, status=304)
+
+        self.testapp.put("/actuators/fan01/state", status=204)
+
+        self.assertEqual(self.get_since("0"), ("1", {"fan01": True}))
+        self.assertEqual(self.get_since("1"), ("1", {}))
+        self.testapp.get("/actuators", headers={"If-None-Match": etag}, status=200)
+
+    def test_switch_committed_out_of_order_is_not_skipped(self):
+        from sgreen2_web.views import actuators
+
+        next_sequence = actuators.next_sequence
+        polls = list()
+
+        # fan02 takes a later version and commits it, then a poller reads, all before fan01's version is written
+        def interleaved(db, name, count=1):
+            version = next_sequence(db, name, count)
+
+            if not polls:
+                polls.append(None)
+                self.testapp.put("/actuators/fan02/state", status=204)
+                polls[0] = self.get_since("0")
+
+            return version
+
+        with mock.patch.object(actuators, "next_sequence", interleaved):
+            self.testapp.put("/actuators/fan01/state", status=204)
+
+        version, seen = polls[0]
+        seen_next = self.get_since(version)[1]
+
+        self.assertEqual(version, "2")
+        self.assertEqual(seen["fan02"], True)
+        self.assertTrue(seen.get("fan01") or seen_next.get("fan01"))
+        self.assertNotIn("version_pending", self.db.actuators.find_one({"name": "fan01"}))
+
+    def test_no_op_and_missing_switches_take_no_version(self):
+        self.testapp.delete("/actuators/fan01/state", status=204)
+        self.testapp.put("/actuators/fan03/state", status=404)
+
+        self.assertIsNone(self.db.counters.find_one({"_id": "actuators_version"}))
+        self.assertEqual(self.db.actuators_state_log.count_documents({}), 0)
+
+
+class PatchActuatorsTests(FunctionalTests):
+    def setUp(self):
+        super().setUp()
+
+        self.add_actuator("fan01")
+        self.add_actuator("fan02", state=True)
+
+    def test_reports_each_actuator(self):
+        response = self.testapp.patch_json("/actuators", {"fan01": True, "fan02": True, "fan03": False})
+
+        self.assertEqual(response.json, {"switched": ["fan01"], "unchanged": ["fan02"], "not_found": ["fan03"],
+                                         "failed": []})
+        self.assertEqual([entry["name"] for entry in self.db.actuators_state_log.find()], ["fan01"])
+        self.assertEqual(self.db.actuators.find_one({"name": "fan01"})["version"], 1)
+        self.assertEqual(self.db.actuators.find_one({"name": "fan01"})["pending_switches"], [])
+
+    def test_reports_the_switches_that_failed(self):
+        from mongomock.collection import Collection
+        from pymongo.errors import BulkWriteError
+
+        self.add_actuator("fan03")
+        bulk_write = Collection.bulk_write
+
+        # the write of fan02 fails, the others of the unordered bulk write still go through
+        def failing_bulk_write(collection, requests, ordered=True):
+            if not any("$addToSet" in repr(request) for request in requests):
+                return bulk_write(collection, requests, ordered=ordered)
+
+            bulk_write(collection, [request for i, request in enumerate(requests) if i != 1], ordered=ordered)
+            raise BulkWriteError({"writeErrors": [{"index": 1, "code": 50, "errmsg": "operation exceeded time limit"}]})
+
+        with mock.patch.object(Collection, "bulk_write", failing_bulk_write):
+            response = self.testapp.patch_json("/actuators", {"fan01": True, "fan02": False, "fan03": False,
+                                                              "fan04": True}, status=207)
+
+        self.assertEqual(response.json, {"switched": ["fan01"], "unchanged": ["fan03"], "not_found": ["fan04"],
+                                         "failed": [{"name": "fan02", "message": "operation exceeded time limit"}]})
+        self.assertTrue(self.db.actuators.find_one({"name": "fan02"})["state"])
+        self.assertEqual([entry["name"] for entry in self.db.actuators_state_log.find()], ["fan01"])
+
+    def test_concurrent_put_does_not_hide_a_switch(self):
+        from sgreen2_web.views import actuators
+
+        next_sequence = actuators.next_sequence
+        put = list()
+
+        # another request switches fan02 back on while this one is stamping its versions
+        def interleaved(db, name, count=1):
+            if not put:
+                put.append(self.testapp.put("/actuators/fan02/state", status=204))
+
+            return next_sequence(db, name, count)
+
+        with mock.patch.object(actuators, "next_sequence", interleaved):
+            response = self.testapp.patch_json("/actuators", {"fan01": True, "fan02": False})
+
+        self.assertEqual(response.json["switched"], ["fan01", "fan02"])
+        self.assertEqual(sorted((entry["name"], entry["to_state"]) for entry in self.db.actuators_state_log.find()),
+                         [("fan01", True), ("fan02", False), ("fan02", True)])
+
+    def test_bad_body(self):
+        self.testapp.patch_json("/actuators", {"fan01": "on"}, status=400)
+
+
+class ScriptTests(unittest.TestCase):
+    """
+    Runs the scripts/ modules against an in memory mongomock database
+    """
+
+    def setUp(self):
+        import mongomock
+
+        scripts = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+
+        if scripts not in sys.path:
+            sys.path.insert(0, scripts)
+
+        self.config = configparser.ConfigParser()
+        self.config.read(os.path.join(scripts, "db_config.ini"))
+        self.db = mongomock.MongoClient().greenhouse
+
+
+class BenchQueryPlansTests(ScriptTests):
+    def test_every_query_runs_on_seeded_data(self):
+        import bench_query_plans
+
+        # two hours so the last hour is rolled up
+        end_time = bench_query_plans.seed(self.db, self.config, 2 / 24, 1)
+
+        self.assertGreater(self.db.data_readings_1m.count_documents({}), 0)
+
+        for name, query, explain in bench_query_plans.get_queries(self.db, end_time):
+            with self.subTest(name):
+                query()
+
+
+class MigrateTests(ScriptTests):
+    def migrate(self, dry_run: bool = False) -> str:
+        import migrate
+
+        output = io.StringIO()
+
+        # mongomock has no collStats
+        with mock.patch("migrations.estimate_cost", return_value="~0 documents"), \
+                contextlib.redirect_stdout(output):
+            migrate.migrate(self.db, dry_run)
+
+        return output.getvalue()
+
+    def test_applies_every_migration_once(self):
+        from migrations import MIGRATIONS
+
+        self.db.actuators.create_index([("name", "text")], name="name_index")
+        self.db.greenhouse_server_state.insert_many([{"timestamp": t} for t in (0, 60000, 10000000)])
+
+        self.migrate()
+
+        self.assertEqual(sorted(m["_id"] for m in self.db.schema_migrations.find()), [m.version for m in MIGRATIONS])
+        self.assertNotIn("name_index", self.db.actuators.index_information())
+        self.assertEqual(list(self.db.greenhouse_server_uptime.find(projection={"_id": 0}, sort=[("start_time", 1)])),
+                         [{"start_time": 0, "end_time": 60000, "pings": 2},
+                          {"start_time": 10000000, "end_time": 10000000, "pings": 1}])
+        self.assertEqual(self.migrate(), "database is up to date\n")
+
+    def test_ping_conversion_is_done_once(self):
+        from migrations import ConvertPingsToIntervals
+
+        conversion = ConvertPingsToIntervals(2 * 60 * 1000)
+        self.db.greenhouse_server_state.insert_many([{"timestamp": t} for t in (0, 60000)])
+
+        self.assertFalse(conversion.is_done(self.db))
+        conversion.apply(self.db)
+
+        self.assertTrue(conversion.is_done(self.db))
+        self.assertNotIn("greenhouse_server_state", self.db.list_collection_names())
+        # the pings are kept until someone drops them
+        self.assertEqual(self.db.greenhouse_server_state_converted.count_documents({}), 2)
+
+    def test_pings_collection_is_no_longer_created(self):
+        from reinitialize_db import create_indexes
+
+        create_indexes(self.db)
+
+        self.assertNotIn("greenhouse_server_state", self.db.list_collection_names())
+
+    def test_dry_run_changes_nothing(self):
+        output = self.migrate(dry_run=True)
+
+        self.assertIn("create index name_unique_index", output)
+        self.assertEqual(self.db.schema_migrations.count_documents({}), 0)
+        self.assertNotIn("name_unique_index", self.db.actuators.index_information())
+
+    def test_migrates_every_site(self):
+        import migrate
+        from migrations import MIGRATIONS
+
+        client = self.db.client
+
+        for name in ("greenhouse_north", "greenhouse_south", "greenhouse_Bad!", "other"):
+            client[name].actuators.insert_one({"name": "fan01"})
+
+        # a site that is already up to date is still visited
+        client["greenhouse_east"].schema_migrations.insert_many([{"_id": m.version} for m in MIGRATIONS])
+
+        with mock.patch("migrations.estimate_cost", return_value="~0 documents"), \
+                contextlib.redirect_stdout(io.StringIO()) as out:
+            migrate.migrate_all(client, "greenhouse", "greenhouse_")
+
+        for name in ("greenhouse", "greenhouse_north", "greenhouse_south"):
+            with self.subTest(name=name):
+                self.assertEqual(client[name].schema_migrations.count_documents({}), len(MIGRATIONS))
+
+        for name in ("greenhouse_Bad!", "other"):
+            self.assertEqual(client[name].schema_migrations.count_documents({}), 0)
+
+        # the default database first, then the sites in order
+        self.assertEqual([line for line in out.getvalue().splitlines() if line.startswith("== ")],
+                         ["== greenhouse", "== greenhouse_east", "== greenhouse_north", "== greenhouse_south"])
+        self.assertIn("== greenhouse_east\ndatabase is up to date", out.getvalue())
+
+    def test_provisions_a_single_site(self):
+        from reinitialize_db import reinitialize_db
+
+        client = self.db.client
+        client.greenhouse_south.actuators.insert_one({"name": "fan01"})
+        # mongomock can't create the capped collections
+        tables = ["actuators", "settings", "greenhouse_server_uptime", "rollups"]
+
+        with mock.patch("reinitialize_db.MongoClient", return_value=client):
+            reinitialize_db(self.config, tables, "north")
+
+            with self.assertRaises(ValueError):
+                reinitialize_db(self.config, tables, "North/..")
+
+        north = client.greenhouse_north
+
+        self.assertGreater(north.actuators.count_documents({}), 0)
+        self.assertGreater(north.settings.count_documents({}), 0)
+        self.assertIn("previous_id_unique_index", north.greenhouse_server_uptime.index_information())
+        # the other databases are left alone
+        self.assertNotIn("greenhouse", client.list_database_names())
+        self.assertEqual(client.greenhouse_south.actuators.count_documents({}), 1)
+
+
+class GreenhouseServerStateTests(FunctionalTests):
+    def ping_at(self, timestamp: int) -> None:
+        with mock.patch("sgreen2_web.views.greenhouse_server_state.get_timestamp", return_value=timestamp):
+            self.testapp.post("/greenhouse_server_state", status=201)
+
+    def get_intervals(self) -> list:
+        return [(interval["start_time"], interval["end_time"], interval["pings"])
+                for interval in self.db.greenhouse_server_uptime.find(sort=[("start_time", 1)])]
+
+    def test_pings_within_the_gap_extend_the_interval(self):
+        for timestamp in (0, 60000, 120000, 500000, 560000):
+            self.ping_at(timestamp)
+
+        self.assertEqual(self.get_intervals(), [(0, 120000, 3), (500000, 560000, 2)])
+
+    def test_gaps(self):
+        self.ping_at(200000)
+        self.ping_at(260000)
+
+        response = self.testapp.get("/greenhouse_server_state?start_time=0&end_time=600000&gaps=true")
+
+        self.assertEqual(response.json, [
+            {"start_time": 260000, "end_time": 600000, "state": False},
+            {"start_time": 200000, "end_time": 260000, "state": True},
+            {"start_time": 0, "end_time": 200000, "state": False},
+        ])
+
+    def test_queued_pings_are_written_together(self):
+        from sgreen2_web.views.greenhouse_server_state import record_pings
+
+        self.ping_at(0)
+        record_pings(self.db, [300000, 60000, 120000], 2 * 60 * 1000)
+
+        self.assertEqual(self.get_intervals(), [(0, 120000, 3), (300000, 300000, 1)])
+
+    def race(self, method: str, timestamp: int):
+        """
+        Patches a collection method so that another process records a ping right after it first runs
+        """
+        from mongomock.collection import Collection
+
+        from sgreen2_web.views.greenhouse_server_state import record_ping
+
+        original = getattr(Collection, method)
+        raced = list()
+
+        def racing(collection, *args, **kwargs):
+            result = original(collection, *args, **kwargs)
+
+            if not raced:
+                raced.append(True)
+                record_ping(self.db, timestamp, timestamp, 1, 2 * 60 * 1000)
+
+            return result
+
+        return mock.patch.object(Collection, method, racing)
+
+    def test_first_pings_after_a_silence_start_one_interval(self):
+        from sgreen2_web.views.greenhouse_server_state import record_ping
+
+        self.ping_at(0)
+
+        # the other process starts the interval after this one's extend missed, or after it read the latest interval
+        for method, timestamp in (("find_one_and_update", 500000), ("find_one", 900000)):
+            with self.subTest(method=method), self.race(method, timestamp + 10000):
+                record_ping(self.db, timestamp, timestamp, 1, 2 * 60 * 1000)
+
+        self.assertEqual(self.get_intervals(), [(0, 0, 1), (500000, 510000, 2), (900000, 910000, 2)])
+
+    def test_lost_insert_race_writes_to_the_winners_interval(self):
+        from mongomock.collection import Collection
+        from pymongo.errors import DuplicateKeyError
+
+        from sgreen2_web.views.greenhouse_server_state import record_ping
+
+        update_one = Collection.update_one
+
+        # the other process inserts the interval between this one's upsert finding nothing and inserting
+        def racing_update_one(collection, query, update, upsert=False, **kwargs):
+            if upsert:
+                update_one(collection, query, {"$min": {"start_time": 510000}, "$max": {"end_time": 510000},
+                                               "$inc": {"pings": 1}}, upsert=True)
+                raise DuplicateKeyError("E11000 duplicate key error")
+
+            return update_one(collection, query, update, **kwargs)
+
+        self.ping_at(0)
+
+        with mock.patch.object(Collection, "update_one", racing_update_one):
+            record_ping(self.db, 500000, 500000, 1, 2 * 60 * 1000)
+
+        self.assertEqual(self.get_intervals(), [(0, 0, 1), (500000, 510000, 2)])
+
+
+class DutyCycleTests(FunctionalTests):
+    settings = {"max_page_size": "100"}
+
+    def setUp(self):
+        super().setUp()
+
+        self.add_actuator("fan01", state=True)
+        self.add_actuator("fan02")
+        self.db.actuators_state_log.insert_many([
+            {"name": "fan01", "to_state": True, "timestamp": 10000},
+            {"name": "fan01", "to_state": False, "timestamp": 40000},
+            # a repeated state isn't a switch
+            {"name": "fan01", "to_state": False, "timestamp": 45000},
+            {"name": "fan01", "to_state": True, "timestamp": 70000},
+        ])
+
+    def test_buckets(self):
+        response = self.testapp.get("/actuators/fan01/duty_cycle?start_time=0&end_time=100000&bucket=50s")
+
+        self.assertEqual((response.json["on_time"], response.json["switches"], response.json["duty_cycle"]),
+                         (60000, 3, 0.6))
+        self.assertEqual([(b["timestamp"], b["on_time"], b["switches"]) for b in response.json["buckets"]],
+                         [(0, 30000, 2), (50000, 30000, 1)])
+
+    def test_state_before_the_window(self):
+        response = self.testapp.get("/actuators/fan01/duty_cycle?start_time=50000&end_time=60000")
+
+        self.assertEqual((response.json["on_time"], response.json["switches"]), (0, 0))
+
+        response = self.testapp.get("/actuators/fan01/duty_cycle?start_time=80000&end_time=90000")
+
+        self.assertEqual(response.json["duty_cycle"], 1.0)
+
+    def test_every_actuator_of_a_type(self):
+        response = self.testapp.get("/actuators/duty_cycle?type=fan&start_time=0&end_time=100000")
+
+        self.assertEqual([(a["name"], a["on_time"]) for a in response.json], [("fan01", 60000), ("fan02", 0)])
+
+    def test_too_many_buckets(self):
+        self.testapp.get("/actuators/fan01/duty_cycle?start_time=0&end_time=1000000&bucket=1s", status=400)
+        self.testapp.get("/actuators/fan03/duty_cycle", status=404)
+
+
+class IngestionQueueTests(unittest.TestCase):
+    def setUp(self):
+        import mongomock
+
+        from sgreen2_web.ingest import IngestionQueue
+
+        self.db = mongomock.MongoClient().greenhouse
+        self.queue = IngestionQueue(self.db, {"data_readings": lambda db, items: db.data_readings.insert_many(items)},
+                                    max_size=2, batch_size=100, flush_interval=60)
+
+    def tearDown(self):
+        self.queue.close()
+
+    def test_close_writes_everything_queued(self):
+        self.queue.put("data_readings", {"reading": 1.0})
+        self.queue.put("data_readings", {"reading": 2.0})
+        self.queue.close()
+
+        self.assertEqual(self.db.data_readings.count_documents({}), 2)
+        self.assertEqual((self.queue.enqueued, self.queue.flushed, self.queue.flushes), (2, 2, 1))
+
+    def test_full_and_closed_queues_reject(self):
+        from sgreen2_web.ingest import IngestionQueueFull
+
+        self.queue.put("data_readings", {"reading": 1.0})
+        self.queue.put("data_readings", {"reading": 2.0})
+
+        with self.assertRaises(IngestionQueueFull):
+            self.queue.put("data_readings", {"reading": 3.0})
+
+        self.queue.close()
+
+        with self.assertRaises(IngestionQueueFull):
+            self.queue.put("data_readings", {"reading": 4.0})
+
+        self.assertEqual(self.queue.rejected, 1)
+        self.assertEqual(self.db.data_readings.count_documents({}), 2)
+
+    def test_put_racing_close_is_written_or_rejected(self):
+        from sgreen2_web.ingest import IngestionQueueFull
+
+        accepted = list()
+        started = threading.Event()
+
+        def producer():
+            for i in range(1000):
+                started.set()
+
+                try:
+                    self.queue.put("data_readings", {"reading": float(i)})
+                    accepted.append(i)
+                except IngestionQueueFull:
+                    # full until the flusher drains it, rejected for good once closed
+                    time.sleep(0.0001)
+
+        self.queue = type(self.queue)(self.db, self.queue.handlers, max_size=10000, batch_size=10, flush_interval=0.01)
+        thread = threading.Thread(target=producer)
+        thread.start()
+        started.wait()
+        self.queue.close()
+        thread.join()
+
+        self.assertEqual(self.db.data_readings.count_documents({}), len(accepted))
+
+    def test_sigterm_closes_the_queue(self):
+        from sgreen2_web.ingest import close_on_sigterm
+
+        previous = mock.Mock()
+        original = signal.signal(signal.SIGTERM, previous)
+
+        try:
+            close_on_sigterm(self.queue)
+            self.queue.put("data_readings", {"reading": 1.0})
+
+            signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+        finally:
+            signal.signal(signal.SIGTERM, original)
+
+        self.assertEqual(self.db.data_readings.count_documents({}), 1)
+        previous.assert_called_once_with(signal.SIGTERM, None)
+
+
+class BufferedIngestionTests(FunctionalTests):
+    settings = {"ingest.mode": "buffered", "ingest.flush_interval": "60"}
+
+    def setUp(self):
+        # main installs a SIGTERM handler for the queue
+        self.sigterm = signal.getsignal(signal.SIGTERM)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        signal.signal(signal.SIGTERM, self.sigterm)
+
+    def test_readings_are_written_on_close(self):
+        self.testapp.post_json("/data_readings", {"sensor": {"type": "temp", "name": "temp01"}, "reading": 20},
+                               status=202)
+        self.testapp.post("/greenhouse_server_state", status=202)
+
+        self.assertEqual(self.db.data_readings.count_documents({}), 0)
+
+        self.registry.ingest_queue.close()
+
+        self.assertEqual(self.db.data_readings.count_documents({}), 1)
+        self.assertEqual(self.db.greenhouse_server_uptime.count_documents({}), 1)
+
+    def test_sigterm_handler_is_installed(self):
+        self.assertIsNot(signal.getsignal(signal.SIGTERM), self.sigterm)
+
+
+class LineProtocolListenerTests(unittest.TestCase):
+    def setUp(self):
+        import mongomock
+
+        from sgreen2_web.ingest import IngestionQueue
+        from sgreen2_web.listener import LineProtocolListener
+        from sgreen2_web.readings import UnitConverter, insert_data_readings
+
+        self.db = mongomock.MongoClient().greenhouse
+        self.queue = IngestionQueue(self.db, {"data_readings": insert_data_readings},
+                                    max_size=100, batch_size=100, flush_interval=60)
+        self.listener = LineProtocolListener(self.queue, UnitConverter())
+
+    def tearDown(self):
+        self.queue.close()
+
+    def test_lines_are_converted_like_posted_readings(self):
+        self.listener.handle_lines([b"temp,temp01 100 temp_c", b"", b"# a comment", b"batt,batt01 4.5"])
+        self.queue.close()
+
+        readings = {r["sensor"]["name"]: r for r in self.db.data_readings.find()}
+
+        self.assertEqual(readings["temp01"]["reading"], 212.0)
+        self.assertEqual(readings["batt01"]["health"], "low")
+        self.assertEqual((self.listener.received, self.listener.invalid), (2, 0))
+
+    def test_bad_lines_are_counted(self):
+        self.listener.handle_lines([b"temp temp01 20", b"temp,temp01 warm", b"temp,temp01 20"])
+        self.queue.close()
+
+        self.assertEqual((self.listener.received, self.listener.invalid), (3, 2))
+        self.assertEqual(self.db.data_readings.count_documents({}), 1)
+
+    def test_dropped_once_the_queue_is_closed(self):
+        self.queue.close()
+        self.listener.handle_line(b"temp,temp01 20\n")
+
+        self.assertEqual(self.listener.dropped, 1)
+
+    def test_tcp(self):
+        import socket
+
+        from sgreen2_web.listener import _TCPHandler, _TCPServer
+
+        server = _TCPServer(("127.0.0.1", 0), _TCPHandler)
+        server.listener = self.listener
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        try:
+            with socket.create_connection(server.server_address) as connection:
+                connection.sendall(b"temp,temp01 20\nsoil,soil01 40\n")
+
+            # the handler thread reads until the connection is closed
+            deadline = time.monotonic() + 5
+            while self.listener.received < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.queue.close()
+
+        self.assertEqual(sorted(r["sensor"]["name"] for r in self.db.data_readings.find()), ["soil01", "temp01"])
+
+
+class ResponseFormatTests(FunctionalTests):
+    def setUp(self):
+        super().setUp()
+
+        self.add_data_readings("temp", "temp01", [1000, 2000])
+        self.add_data_readings("temp", "temp02", [1000])
+
+    def test_columnar(self):
+        response = self.testapp.get("/data_readings?type=temp&start_time=0&end_time=10000&shape=columnar")
+
+        self.assertEqual(response.json, {
+            "temp01": {"timestamps": [2000, 1000], "readings": [1.0, 0.0]},
+            "temp02": {"timestamps": [1000], "readings": [0.0]}
+        })
+
+    def test_columnar_state_log(self):
+        self.add_actuator("fan01")
+        self.db.actuators_state_log.insert_many([{"name": "fan01", "to_state": True, "timestamp": 1000},
+                                                 {"name": "fan01", "to_state": False, "timestamp": 2000}])
+
+        response = self.testapp.get("/actuators/fan01/state?start_time=0&end_time=10000&shape=columnar")
+
+        self.assertEqual(response.json, {"fan01": {"timestamps": [2000, 1000], "to_states": [False, True]}})
+
+    def test_msgpack(self):
+        msgpack = self.import_msgpack()
+
+        response = self.testapp.get("/data_readings?type=temp&start_time=0&end_time=10000&limit=2",
+                                    headers={"Accept": "application/msgpack"})
+
+        self.assertEqual(response.content_type, "application/msgpack")
+        self.assertEqual([(r["sensor"]["name"], r["timestamp"]) for r in msgpack.unpackb(response.body, raw=False)],
+                         [("temp01", 2000), ("temp01", 1000)])
+        self.assertIn("X-Next-Cursor", response.headers)
+
+    def test_msgpack_columnar(self):
+        msgpack = self.import_msgpack()
+
+        response = self.testapp.get("/data_readings?type=temp&start_time=0&end_time=10000&format=msgpack"
+                                    "&shape=columnar")
+
+        self.assertEqual(msgpack.unpackb(response.body, raw=False)["temp02"],
+                         {"timestamps": [1000], "readings": [0.0]})
+
+    def test_streams_are_json_rows(self):
+        self.testapp.get("/data_readings?type=temp&stream=ndjson&shape=columnar", status=400)
+        self.testapp.get("/data_readings?type=temp&format=xml", status=400)
+
+    def import_msgpack(self):
+        try:
+            import msgpack
+        except ImportError:
+            self.skipTest("msgpack is not installed")
+
+        return msgpack
+
+
+class RecalibrateTests(ScriptTests):
+    def setUp(self):
+        super().setUp()
+
+        from sgreen2_web.rollups import roll_up
+
+        self.db.data_readings.insert_many([{
+            "timestamp": timestamp,
+            "reading": reading,
+            "sensor": {"type": "temp", "name": "temp01"}
+        } for timestamp, reading in [(0, 10.0), (30000, 20.0), (60000, 30.0), (90000, 40.0)]])
+        roll_up(self.db, 0, 10000, now=2 * 24 * 60 * 60 * 1000)
+
+    def recalibrate(self, *args, **kwargs) -> tuple:
+        from recalibrate import recalibrate
+        from sgreen2_web.readings import LinearConversion
+
+        return recalibrate(self.db, "temp01", LinearConversion(1.0), *args, **kwargs)
+
+    def get_buckets(self, collection: str) -> list:
+        return [(b["timestamp"], b["min"], b["max"], b["mean"], b["count"])
+                for b in self.db[collection].find(sort=[("timestamp", 1)])]
+
+    def test_rollups_are_converted_with_the_readings(self):
+        from sgreen2_web.readings import LinearConversion
+
+        self.assertEqual(self.recalibrate(LinearConversion(2.0, 1.0)), (4, 0, 4))
+
+        self.assertEqual([r["reading"] for r in self.db.data_readings.find(sort=[("timestamp", 1)])],
+                         [21.0, 41.0, 61.0, 81.0])
+        self.assertEqual(self.get_buckets("data_readings_1m"), [(0, 21.0, 41.0, 31.0, 2), (60000, 61.0, 81.0, 71.0, 2)])
+        self.assertEqual(self.get_buckets("data_readings_1h"), [(0, 21.0, 81.0, 51.0, 4)])
+
+    def test_negative_gain_swaps_min_and_max(self):
+        from sgreen2_web.readings import LinearConversion
+
+        self.recalibrate(LinearConversion(-1.0), start_time=0, end_time=24 * 60 * 60 * 1000 - 1)
+
+        self.assertEqual(self.get_buckets("data_readings_1d"), [(0, -40.0, -10.0, -25.0, 4)])
+
+    def test_range_cutting_through_a_bucket_is_refused(self):
+        from sgreen2_web.readings import LinearConversion
+
+        with self.assertRaises(ValueError):
+            self.recalibrate(LinearConversion(2.0), start_time=60000, end_time=119999)
+
+        self.assertEqual(self.db.data_readings.find_one({"timestamp": 60000})["reading"], 30.0)
+
+    def test_dry_run(self):
+        from sgreen2_web.readings import LinearConversion
+
+        self.assertEqual(self.recalibrate(LinearConversion(2.0), dry_run=True), (4, 0, 4))
+        self.assertEqual(self.get_buckets("data_readings_1h"), [(0, 10.0, 40.0, 25.0, 4)])
+
+    def test_results_are_clamped_to_the_unit_range(self):
+        from sgreen2_web.readings import LinearConversion
+
+        self.recalibrate(LinearConversion(2.0), unit=LinearConversion(minimum=25.0, maximum=70.0))
+
+        self.assertEqual([r["reading"] for r in self.db.data_readings.find(sort=[("timestamp", 1)])],
+                         [25.0, 40.0, 60.0, 70.0])
+        self.assertEqual(self.get_buckets("data_readings_1m"), [(0, 25.0, 40.0, 30.0, 2), (60000, 60.0, 70.0, 70.0, 2)])
+
+    def test_site_database(self):
+        import mongomock
+
+        from recalibrate import get_database
+
+        client = mongomock.MongoClient()
+
+        self.assertEqual(get_database(client, self.config).name, "greenhouse")
+        self.assertEqual(get_database(client, self.config, "north").name, "greenhouse_north")
+
+        with self.assertRaises(ValueError):
+            get_database(client, self.config, "../north")
+
+
+class MetricsTests(FunctionalTests):
+    def test_requests_are_counted_by_route(self):
+        self.add_actuator("fan01")
+        self.testapp.get("/actuators")
+        self.testapp.put("/actuators/fan02/state", status=404)
+        self.testapp.get("/nowhere", status=404)
+
+        response = self.testapp.get("/metrics")
+
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        self.assertIn('sgreen2_http_responses_total{route="actuators",method="GET",status="200"} 1', response.text)
+        self.assertIn('sgreen2_http_responses_total{route="actuators_state",method="PUT",status="404"} 1',
+                      response.text)
+        self.assertIn('sgreen2_http_responses_total{route="unmatched",method="GET",status="404"} 1', response.text)
+        self.assertIn('sgreen2_http_request_duration_seconds_count{route="actuators",method="GET"} 1', response.text)
+
+    def test_mongo_commands(self):
+        from sgreen2_web.metrics import Metrics, MongoCommandListener
+
+        metrics = Metrics()
+        listener = MongoCommandListener(metrics)
+        started = mock.Mock(command={"find": "data_readings", "filter": {"sensor.type": "temp"}},
+                            command_name="find", connection_id=1, request_id=7)
+        finished = mock.Mock(connection_id=1, request_id=7, duration_micros=2000)
+
+        listener.started(started)
+        listener.failed(finished)
+        # a reply for a command that wasn't seen starting is ignored
+        listener.succeeded(finished)
+
+        text = metrics.render()
+
+        self.assertIn('sgreen2_mongo_command_duration_seconds_bucket{collection="data_readings",command="find",'
+                      'le="0.0025"} 1', text)
+        self.assertIn('sgreen2_mongo_command_failures_total{collection="data_readings",command="find"} 1', text)
+        self.assertEqual(listener.pending, {})
+
+
+class StartupTests(unittest.TestCase):
+    def get_views(self, scan: bool) -> set:
+        import mongomock
+
+        from sgreen2_web import main
+
+        with mock.patch("sgreen2_web.create_client", return_value=mongomock.MongoClient()):
+            app = main({}, mongo_uri="mongodb://localhost:27017/greenhouse", **{"startup.scan": str(scan).lower()})
+
+        return set((view["route_name"], str(view["request_methods"]), view["attr"])
+                   for view in (item["introspectable"] for item in
+                                app.application.registry.introspector.get_category("views")))
+
+    def test_explicit_registration_matches_scanning(self):
+        views = self.get_views(False)
+
+        self.assertIn(("actuators_state_watch", "GET", "get_state_watch"), views)
+        self.assertEqual(views, self.get_views(True))
+
+
+class BenchStartupTests(ScriptTests):
+    def test_fresh_interpreter_is_timed(self):
+        import bench_startup
+
+        result = bench_startup.bench("development.ini", {"startup.scan": "false", "startup.warm_up": "false"}, 1)
+
+        self.assertGreater(result["total_ms"], result["import_ms"])
+
+
+class LoadTestTests(ScriptTests):
+    def make_clients(self) -> list:
+        import types
+
+        return [types.SimpleNamespace(latencies={"POST /data_readings": [i / 1000.0 for i in range(1, 51)],
+                                                 "GET /settings": [0.004, 0.002]},
+                                      errors={"GET /settings": 1}),
+                types.SimpleNamespace(latencies={"POST /data_readings": [i / 1000.0 for i in range(51, 101)]},
+                                      errors=dict())]
+
+    def test_endpoints_are_picked_by_weight(self):
+        from load_test import TRAFFIC_MIX, Client
+
+        client = Client(0, [("temp", "temp01")], ["fan01"], 0, 0, 0, 1)
+        picked = [endpoint for _ in range(200) for endpoint in client.next_endpoints()]
+        total = sum(weight for name, weight in TRAFFIC_MIX)
+
+        for name, weight in TRAFFIC_MIX:
+            with self.subTest(name=name):
+                self.assertAlmostEqual(picked.count(name) / len(picked), weight / total, delta=0.02)
+
+        self.assertEqual(len(picked), sum(picked.count(name) for name, weight in TRAFFIC_MIX))
+        # the same seed replays the same traffic
+        self.assertEqual(Client(0, [("temp", "temp01")], ["fan01"], 0, 0, 0, 1).next_endpoints(), picked[:100])
+
+    def test_percentile(self):
+        from load_test import percentile
+
+        latencies = list(range(1, 101))
+
+        self.assertEqual([percentile(latencies, p) for p in (0, 50, 95, 99, 100)], [1, 50, 95, 99, 100])
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_summary(self):
+        from load_test import summarize
+
+        results = summarize(self.make_clients(), 10.0, {"ingest.mode": "buffered"},
+                            {"start_mb": 50.0, "peak_mb": 60.0, "end_mb": 55.0})
+
+        self.assertEqual(results["endpoints"], {
+            "POST /data_readings": {"requests": 100, "errors": 0, "throughput_rps": 10.0, "p50_ms": 50.0,
+                                    "p95_ms": 95.0, "p99_ms": 99.0},
+            "GET /settings": {"requests": 2, "errors": 1, "throughput_rps": 0.2, "p50_ms": 2.0, "p95_ms": 4.0,
+                              "p99_ms": 4.0}
+        })
+        self.assertEqual((results["requests"], results["errors"], results["throughput_rps"]), (102, 1, 10.2))
+        self.assertEqual((results["concurrency"], results["ingest_mode"]), (2, "buffered"))
+
+    def test_compare_to_a_saved_baseline(self):
+        import copy
+        import tempfile
+
+        from load_test import compare, load_baseline, save_baseline, summarize
+
+        results = summarize(self.make_clients(), 10.0, dict(), {"start_mb": None, "peak_mb": None, "end_mb": None})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "baseline.json")
+            save_baseline(results, path)
+            baseline = load_baseline(path)
+
+        self.assertEqual(baseline, results)
+
+        slower = copy.deepcopy(results)
+        slower["endpoints"]["GET /settings"]["p95_ms"] *= 1.5
+        fewer = copy.deepcopy(results)
+        fewer["endpoints"]["POST /data_readings"]["throughput_rps"] *= 0.5
+        # an endpoint the baseline didn't record isn't compared
+        new_endpoint = copy.deepcopy(results)
+        new_endpoint["endpoints"]["GET /actuators"] = dict(results["endpoints"]["GET /settings"], p95_ms=1000.0)
+
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            self.assertTrue(compare(results, baseline, 20))
+            self.assertTrue(compare(slower, baseline, 60))
+            self.assertFalse(compare(slower, baseline, 20))
+            self.assertFalse(compare(fewer, baseline, 20))
+            self.assertTrue(compare(new_endpoint, baseline, 20))
+
+        self.assertIn("WORSE", out.getvalue())
+
+
+class DatabaseProfileTests(unittest.TestCase):
+    def setUp(self):
+        from pymongo import MongoClient
+
+        self.client = MongoClient("mongodb://localhost:27017", connect=False)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_defaults(self):
+        from pymongo import ReadPreference
+
+        from sgreen2_web.db import get_databases
+
+        databases = get_databases(self.client, {})
+
+        self.assertEqual(databases[None].name, "greenhouse")
+        self.assertEqual(databases["history"].read_preference, ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(databases["readings"].write_concern.document, {"w": 1})
+        self.assertEqual(databases["rollups"].write_concern.document, {"w": 1})
+        self.assertEqual(databases["control"].write_concern.document, {"w": "majority", "wtimeout": 5000})
+
+    def test_overrides(self):
+        from pymongo import ReadPreference
+
+        from sgreen2_web.db import get_databases
+
+        databases = get_databases(self.client, {"mongo.database": "north", "mongo.read_preference.history": "primary",
+                                                "mongo.write_concern.readings": "0"})
+
+        self.assertEqual(databases["history"].name, "north")
+        self.assertEqual(databases["history"].read_preference, ReadPreference.PRIMARY)
+        self.assertFalse(databases["readings"].write_concern.acknowledged)
+
+    def test_bad_settings(self):
+        from sgreen2_web.db import get_databases
+
+        for settings in ({"mongo.write_concern.heartbeats": "0"}, {"mongo.write_concern.rollups": "0"},
+                         {"mongo.write_concern.control": "all"}, {"mongo.read_preference.history": "closest"}):
+            with self.subTest(settings), self.assertRaises(ValueError):
+                get_databases(self.client, settings)
+
+    def test_client_options(self):
+        from sgreen2_web.db import create_client
+
+        with mock.patch("sgreen2_web.db.MongoClient") as client:
+            create_client({"mongo_uri": "mongodb://localhost", "mongo.max_pool_size": "20", "mongo.app_name": "web",
+                           "mongo.min_pool_size": ""})
+
+        client.assert_called_once_with("mongodb://localhost", maxPoolSize=20, appname="web")
+
+
+class UnitConversionTests(unittest.TestCase):
+    def test_numpy_is_not_imported_at_startup(self):
+        import subprocess
+
+        output = subprocess.check_output([sys.executable, "-c", "import sys, sgreen2_web, sgreen2_web.readings; "
+                                                                "print('numpy' in sys.modules)"],
+                                         cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+        self.assertEqual(output.decode("utf-8").strip(), "False")
+
+    def test_with_and_without_numpy(self):
+        from sgreen2_web.readings import LinearConversion
+
+        conversion = LinearConversion(100.0 / 1023.0, maximum=100).then(LinearConversion(2.0, -1.0))
+        readings = [0.0, 511.5, 1023.0]
+
+        with mock.patch("sgreen2_web.readings.load_numpy", return_value=None):
+            without_numpy = conversion.convert(readings)
+
+        self.assertEqual(without_numpy, [-1.0, 99.0, 100.0])
+
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            return
+
+        self.assertEqual(conversion.convert(readings), without_numpy)
+
+    def test_settings(self):
+        from sgreen2_web.readings import get_unit_converter
+
+        converter = get_unit_converter({"unit.soil.soil_volts": "20 0 0 100", "calibration.temp01": "1.1 -2"})
+
+        self.assertEqual(converter.convert("soil", "SOIL_VOLTS", "soil01", [2.5, 6.0]), [50.0, 100.0])
+        self.assertAlmostEqual(converter.convert("temp", "temp_c", "temp01", [100.0])[0], 212 * 1.1 - 2)
+
+        with self.assertRaises(ValueError):
+            get_unit_converter({"calibration.temp01": "1 2 3"})
+
+
+class _TailCursor(object):
+    """
+    Stands in for a tailable cursor that hands out one batch and then dies
+    """
+
+    def __init__(self, documents: list):
+        self.documents = documents
+        self.alive = True
+
+    def __iter__(self):
+        yield from self.documents
+        self.alive = False
+
+    def close(self):
+        self.alive = False
+
+
+class LiveFeedTests(FunctionalTests):
+    def stream(self, headers: dict) -> list:
+        """
+        :return: the (id, data reading) of each event
+        """
+        from sgreen2_web.live import LiveClient
+
+        client = LiveClient(10)
+        # the stream ends after the missed data readings
+        client.dropped = True
+
+        with mock.patch.object(self.registry.live_feeds, "subscribe", return_value=(mock.Mock(), client)):
+            response = self.testapp.get("/data_readings/stream?type=temp", headers=headers)
+
+        lines = response.text.splitlines()
+
+        return [(line[len("id: "):], json.loads(lines[i + 2][len("data: "):]))
+                for i, line in enumerate(lines) if line.startswith("id: ")]
+
+    def test_resume_sends_readings_with_lower_ids_inserted_later(self):
+        import datetime
+
+        from bson import ObjectId
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        timestamp = int(now.timestamp()) * 1000
+        # the last event came from a process whose clock is ahead, the next reading from one whose clock is behind
+        last_id = ObjectId.from_datetime(now + datetime.timedelta(seconds=2))
+        later_id = ObjectId.from_datetime(now - datetime.timedelta(seconds=2))
+        old_id = ObjectId.from_datetime(now - datetime.timedelta(minutes=5))
+
+        self.db.data_readings.insert_many([
+            {"_id": old_id, "timestamp": timestamp - 5 * 60 * 1000, "reading": 1.0,
+             "sensor": {"type": "temp", "name": "temp01"}},
+            {"_id": last_id, "timestamp": timestamp, "reading": 2.0, "sensor": {"type": "temp", "name": "temp01"}},
+            {"_id": later_id, "timestamp": timestamp, "reading": 3.0, "sensor": {"type": "temp", "name": "temp02"}},
+        ])
+
+        # the timestamp and _id event ids of earlier versions still resume
+        events = self.stream({"Last-Event-ID": "{}-{}".format(timestamp, last_id)})
+
+        self.assertEqual([data_reading["reading"] for event_id, data_reading in events], [3.0])
+
+    def test_missed_readings_are_sent_in_timestamp_order(self):
+        from sgreen2_web.helpers import get_timestamp
+
+        timestamp = get_timestamp()
+        self.add_data_readings("temp", "temp01", [timestamp, timestamp - 3000, timestamp - 1000, timestamp - 60000])
+        first = self.db.data_readings.find_one({"timestamp": timestamp - 60000})
+
+        events = self.stream({"Last-Event-ID": "{}-{}".format(first["timestamp"], first["_id"])})
+
+        self.assertEqual([data_reading["timestamp"] for event_id, data_reading in events],
+                         [timestamp - 3000, timestamp - 1000, timestamp])
+
+    def test_resuming_sends_nothing_twice(self):
+        from sgreen2_web.helpers import get_timestamp
+
+        timestamp = get_timestamp()
+        self.add_data_readings("temp", "temp01", [timestamp - 60000, timestamp - 3000, timestamp - 1000])
+        first = self.db.data_readings.find_one({"timestamp": timestamp - 60000})
+
+        events = self.stream({"Last-Event-ID": "{}-{}".format(first["timestamp"], first["_id"])})
+        self.assertEqual(len(events), 2)
+
+        # inserted after the client got the others, by a process a little behind
+        self.add_data_readings("temp", "temp02", [timestamp - 2000])
+
+        resumed = self.stream({"Last-Event-ID": events[-1][0]})
+
+        self.assertEqual([(data_reading["sensor"]["name"], data_reading["timestamp"])
+                          for event_id, data_reading in resumed], [("temp02", timestamp - 2000)])
+        self.assertEqual(self.stream({"Last-Event-ID": resumed[-1][0]}), [])
+
+    def test_missed_readings_are_paged(self):
+        from sgreen2_web.helpers import get_timestamp
+
+        timestamp = get_timestamp()
+        # the same timestamp twice so a page ends between readings that only differ by _id
+        timestamps = [timestamp - 4000, timestamp - 3000, timestamp - 3000, timestamp - 2000, timestamp - 1000]
+        self.add_data_readings("temp", "temp01", [timestamp - 60000] + timestamps)
+        first = self.db.data_readings.find_one({"timestamp": timestamp - 60000})
+
+        with mock.patch.dict(self.registry.settings, {"max_page_size": "2"}):
+            events = self.stream({"Last-Event-ID": "{}-{}".format(first["timestamp"], first["_id"])})
+
+        self.assertEqual([data_reading["timestamp"] for event_id, data_reading in events], timestamps)
+
+    def test_missed_readings_are_read_from_the_history_profile(self):
+        from sgreen2_web.helpers import get_timestamp
+
+        timestamp = get_timestamp()
+        self.add_data_readings("temp", "temp01", [timestamp - 60000, timestamp - 1000])
+        first = self.db.data_readings.find_one({"timestamp": timestamp - 60000})
+
+        databases = {profile: mock.MagicMock() for profile in self.registry.tenants.get_databases(None)}
+        databases["history"] = self.db
+
+        with mock.patch.object(self.registry.tenants, "get_databases", return_value=databases):
+            events = self.stream({"Last-Event-ID": "{}-{}".format(first["timestamp"], first["_id"])})
+
+        self.assertEqual([data_reading["timestamp"] for event_id, data_reading in events], [timestamp - 1000])
+
+    def test_bad_last_event_id_sends_nothing_missed(self):
+        from sgreen2_web.helpers import encode_page_cursor
+
+        self.add_data_readings("temp", "temp01", [1000, 2000])
+
+        for last_event_id in ["", "5b0c3a7e9d1e8a2f4c6b1a2d", "x-5b0c3a7e9d1e8a2f4c6b1a2d", "1000-x", "!!",
+                              encode_page_cursor([1000]), encode_page_cursor([{"$gt": 0}, []]),
+                              encode_page_cursor([1000, [[1000, "5b0c3a7e9d1e8a2f4c6b1a2d"]]])]:
+            with self.subTest(last_event_id=last_event_id):
+                self.assertEqual(self.stream({"Last-Event-ID": last_event_id}), [])
+
+    def test_event_id_round_trips(self):
+        from bson import ObjectId
+
+        from sgreen2_web.helpers import encode_page_cursor
+        from sgreen2_web.live import ResumePoint, format_event, parse_event_id
+
+        _id = ObjectId()
+        resume_point = ResumePoint(5000)
+        resume_point.add({"_id": _id, "timestamp": 1527528062000})
+        event_id = encode_page_cursor(resume_point.get_key())
+        event = format_event({"_id": _id, "timestamp": 1527528062000, "reading": 21.5}, event_id)
+
+        self.assertTrue(event.startswith("id: {}\n".format(event_id).encode("ascii")))
+        self.assertNotIn(b"_id", event)
+
+        for event_id in (event_id, "1527528062000-{}".format(_id)):
+            with self.subTest(event_id=event_id):
+                parsed = parse_event_id(event_id, 5000)
+                self.assertEqual((parsed.newest, parsed.seen), (1527528062000, {_id: 1527528062000}))
+
+    def test_resume_point_skips_what_was_handed_out(self):
+        from bson import ObjectId
+
+        from sgreen2_web.live import ResumePoint
+
+        resume_point = ResumePoint(5000)
+        first = {"_id": ObjectId(), "timestamp": 10000}
+        late = {"_id": ObjectId(), "timestamp": 2000}
+
+        self.assertTrue(resume_point.add(first))
+        self.assertFalse(resume_point.add(first))
+        # older than the overlap, a restart doesn't read it again so it isn't kept
+        self.assertTrue(resume_point.add(late))
+        self.assertNotIn(late["_id"], resume_point.seen)
+
+        self.assertTrue(resume_point.add({"_id": ObjectId(), "timestamp": 20000}))
+        resume_point.prune()
+
+        self.assertNotIn(first["_id"], resume_point.seen)
+        self.assertEqual(resume_point.query({"sensor.type": "temp"}),
+                         {"sensor.type": "temp", "timestamp": {"$gte": 15000}})
+
+    def test_feed_restart_does_not_skip_lower_ids(self):
+        from bson import ObjectId
+
+        from sgreen2_web.live import LiveClient, TailingFeed
+
+        existing = {"_id": ObjectId(), "timestamp": 10000}
+        handed_out = {"_id": ObjectId(), "timestamp": 11000}
+        # inserted after handed_out by a process whose _ids are behind
+        lower_id = {"_id": ObjectId.from_datetime(existing["_id"].generation_time), "timestamp": 11000}
+        self.assertLess(lower_id["_id"], handed_out["_id"])
+
+        tail_filters = list()
+        stopped = threading.Event()
+        collection = mock.Mock()
+        collection.find_one.return_value = existing
+
+        def find(query, cursor_type=None, **kwargs):
+            if cursor_type is None:
+                # the documents already there when the feed starts
+                return [existing]
+
+            tail_filters.append(query)
+
+            if len(tail_filters) == 1:
+                return _TailCursor([existing, handed_out])
+            if len(tail_filters) == 2:
+                return _TailCursor([handed_out, lower_id])
+
+            feed.unsubscribe(client)
+            stopped.set()
+            return _TailCursor([])
+
+        collection.find.side_effect = find
+        feed = TailingFeed(collection, {"sensor.type": "temp"}, "test", 1.0, 5.0)
+        client = LiveClient(10)
+
+        with mock.patch("sgreen2_web.live.time.sleep"):
+            feed.subscribe(client)
+            self.assertTrue(stopped.wait(5))
+
+        self.assertEqual([client.queue.get_nowait() for _ in range(client.queue.qsize())], [handed_out, lower_id])
+        self.assertEqual(tail_filters[1], {"sensor.type": "temp", "timestamp": {"$gte": 6000}})
+
+
+class ActuatorWatchTests(FunctionalTests):
+    def setUp(self):
+        super().setUp()
+        self.add_actuator("fan01")
+
+    def watch(self, client=None, status=200, **params):
+        from sgreen2_web.live import LiveClient
+
+        client = client if client is not None else LiveClient(10)
+
+        with mock.patch.object(self.registry.actuator_watches, "subscribe", return_value=(mock.Mock(), client)):
+            return self.testapp.get("/actuators/fan01/state/watch", params=dict({"timeout": "1"}, **params),
+                                    status=status)
+
+    def log_switch(self, to_state: bool, timestamp: int) -> dict:
+        entry = {"name": "fan01", "to_state": to_state, "timestamp": timestamp}
+        self.db.actuators_state_log.insert_one(entry)
+        return entry
+
+    def test_switch_in_the_same_second_is_returned(self):
+        from sgreen2_web.helpers import get_timestamp
+
+        timestamp = get_timestamp()
+        self.log_switch(True, timestamp)
+
+        # switches logged before the first watch aren't returned
+        response = self.watch()
+        self.assertEqual(response.json, [])
+
+        self.log_switch(False, timestamp)
+        response = self.watch(after=response.headers["X-Watch-Cursor"])
+        self.assertEqual(response.json, [{"name": "fan01", "to_state": False, "timestamp": timestamp}])
+
+        self.log_switch(True, timestamp)
+        response = self.watch(after=response.headers["X-Watch-Cursor"])
+        self.assertEqual(response.json, [{"name": "fan01", "to_state": True, "timestamp": timestamp}])
+
+        response = self.watch(after=response.headers["X-Watch-Cursor"])
+        self.assertEqual(response.json, [])
+
+    def test_switch_handed_over_by_the_feed(self):
+        from sgreen2_web.helpers import get_timestamp
+        from sgreen2_web.live import LiveClient
+
+        from bson import ObjectId
+
+        timestamp = get_timestamp()
+        seen = self.log_switch(True, timestamp)
+        cursor = self.watch().headers["X-Watch-Cursor"]
+
+        client = LiveClient(10)
+        # the feed hands over an entry the cursor already covers along with a new one
+        client.push(seen)
+        client.push({"_id": ObjectId(), "name": "fan01", "to_state": False, "timestamp": timestamp})
+
+        with mock.patch.object(self.registry.actuator_watches, "subscribe", return_value=(mock.Mock(), client)):
+            # the new entry isn't logged yet when the watch reads the log
+            response = self.testapp.get("/actuators/fan01/state/watch", params={"after": cursor, "timeout": "1s"})
+
+        self.assertEqual(response.json, [{"name": "fan01", "to_state": False, "timestamp": timestamp}])
+
+    def test_bad_cursor(self):
+        from sgreen2_web.helpers import encode_page_cursor
+
+        import base64
+
+        def encode(text):
+            return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii").rstrip("=")
+
+        for after in ["1527528062000", encode_page_cursor([1, 2]), encode_page_cursor([1, [[1, "x"]]]),
+                      encode('[{"$ne": 1}, []]'), encode('[1, [[1, {"$oid": "zz"}]]]'),
+                      encode('[{"$date": "bad"}, []]'), encode('[{"$numberDecimal": "x"}, []]'),
+                      encode('[1, [[{"$gt": 0}, {"$oid": "5b0c3a7e9d1e8a2f4c6b1a2d"}]]]'),
+                      encode('[1, [[true, {"$oid": "5b0c3a7e9d1e8a2f4c6b1a2d"}]]]'), encode('[1, [{"$ne": 1}]]')]:
+            with self.subTest(after=after):
+                response = self.watch(after=after, status=400)
+                self.assertEqual(response.json["message"], "after is not a valid cursor")
+
+
+class RollupTests(unittest.TestCase):
+    def setUp(self):
+        import mongomock
+
+        self.client = mongomock.MongoClient()
+        self.db = self.client.greenhouse
+        self.db.data_readings.insert_many([{
+            "timestamp": timestamp,
+            "reading": reading,
+            "sensor": {"type": "temp", "name": "temp01"}
+        } for timestamp, reading in [(0, 10.0), (30000, 20.0), (60000, 30.0), (90000, 40.0), (120000, 50.0)]])
+
+    def get_buckets(self, collection: str) -> list:
+        return [(b["timestamp"], b["mean"], b["count"])
+                for b in self.db[collection].find(sort=[("timestamp", 1)])]
+
+    def test_rolling_up_again_does_not_double_count(self):
+        from sgreen2_web.rollups import roll_up
+
+        self.assertEqual(roll_up(self.db, 0, 10000, now=120000), {"1m": 2, "1h": 0})
+        buckets = self.get_buckets("data_readings_1m")
+        self.assertEqual(buckets, [(0, 15.0, 2), (60000, 35.0, 2)])
+
+        # as if the high-water mark write was lost
+        self.db.rollup_state.delete_many({})
+        roll_up(self.db, 0, 10000, now=120000)
+
+        self.assertEqual(self.get_buckets("data_readings_1m"), buckets)
+
+    def test_recent_buckets_are_aggregated_from_the_data_readings(self):
+        from sgreen2_web.rollups import TIERS, find_rollups, roll_up
+
+        roll_up(self.db, 0, 10000, now=120000)
+
+        buckets = find_rollups(self.db, TIERS[0], "temp", 0, 150000, None, 10)
+
+        self.assertEqual([(b["timestamp"], b["mean"], b["count"]) for b in buckets],
+                         [(120000, 50.0, 1), (60000, 35.0, 2), (0, 15.0, 2)])
+
+    def test_serve_writes_with_the_rollups_profile(self):
+        from sgreen2_web.rollups import serve
+
+        databases = {None: self.db, "readings": mock.sentinel.readings, "rollups": mock.sentinel.rollups}
+
+        with mock.patch("sgreen2_web.rollups.create_client", return_value=self.client), \
+                mock.patch("sgreen2_web.rollups.get_databases", return_value=databases), \
+                mock.patch("sgreen2_web.rollups.roll_up", return_value=dict()) as roll_up, \
+                mock.patch("sgreen2_web.rollups.time.sleep", side_effect=KeyboardInterrupt), \
+                self.assertRaises(KeyboardInterrupt):
+            serve({"mongo_uri": "mongodb://localhost:27017/greenhouse"})
+
+        self.assertIs(roll_up.call_args[0][0], mock.sentinel.rollups)
+
+
+class ResponseCacheTests(FunctionalTests):
+    settings = {"cache.max_bytes": "1000000", "cache.settle": "300"}
+
+    def get_readings(self, **kwargs):
+        return self.testapp.get("/data_readings", params={"type": "temp", "start_time": "0", "end_time": "60000"},
+                                **kwargs)
+
+    def test_past_window_is_cached_and_varies_on_accept(self):
+        self.add_data_readings("temp", "temp01", [1000, 2000])
+
+        miss = self.get_readings()
+        self.add_data_readings("temp", "temp02", [3000])
+        hit = self.get_readings()
+
+        self.assertEqual((miss.headers["X-Cache"], hit.headers["X-Cache"]), ("miss", "hit"))
+        self.assertEqual(hit.body, miss.body)
+
+        for response in (miss, hit):
+            self.assertIn("public", response.headers["Cache-Control"])
+            self.assertEqual(response.headers["Vary"], "Accept")
+
+    def test_formats_are_cached_apart(self):
+        try:
+            import msgpack
+        except ImportError:
+            self.skipTest("msgpack isn't installed")
+
+        self.add_data_readings("temp", "temp01", [1000])
+
+        self.get_readings()
+        response = self.get_readings(headers={"Accept": "application/msgpack"})
+
+        self.assertEqual(response.headers["X-Cache"], "miss")
+        self.assertEqual(msgpack.unpackb(response.body, raw=False)[0]["reading"], 0.0)
+
+    def test_recent_window_is_not_cached(self):
+        response = self.testapp.get("/data_readings", params={"type": "temp"})
+
+        self.assertNotIn("X-Cache", response.headers)
+        self.assertNotIn("Vary", response.headers)
+
+    def test_least_recently_used_is_evicted(self):
+        from pyramid.response import Response
+
+        from sgreen2_web.cache import ResponseCache
+
+        cache = ResponseCache(8 * 100, settle=300, max_age=60, recent_ttl=0)
+
+        for key in range(9):
+            cache.set(key, Response(body=b"x" * 100), 60)
+            # key 0 is used again, so key 1 is the least recently used
+            cache.get(0)
+
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get(1))
+        self.assertIsNotNone(cache.get(0))
+
+
+class SitePathTests(FunctionalTests):
+    settings = {"tenancy.mode": "path"}
+
+    def test_routes_under_the_site_prefix(self):
+        self.add_actuator("fan01")
+        self.add_actuator("fan02", db=self.client.greenhouse_north)
+
+        response = self.testapp.get("/sites/north/actuators")
+        self.assertEqual([actuator["name"] for actuator in response.json], ["fan02"])
+
+        self.testapp.put("/sites/north/actuators/fan02/state", status=204)
+        self.assertTrue(self.client.greenhouse_north.actuators.find_one({"name": "fan02"})["state"])
+        self.assertFalse(self.db.actuators.find_one({"name": "fan01"})["state"])
+
+        # without the prefix it's the default database
+        response = self.testapp.get("/actuators")
+        self.assertEqual([actuator["name"] for actuator in response.json], ["fan01"])
+
+    def test_next_links_keep_the_prefix(self):
+        from urllib.parse import urlsplit
+
+        self.add_data_readings("temp", "temp01", [1000, 2000, 3000], db=self.client.greenhouse_north)
+
+        url = "/sites/north/data_readings?type=temp&start_time=0&end_time=60000&limit=2"
+        timestamps = list()
+
+        while url:
+            response = self.testapp.get(url)
+            timestamps.extend(reading["timestamp"] for reading in response.json)
+            url = None
+
+            if "Link" in response.headers:
+                link = urlsplit(response.headers["Link"][1:response.headers["Link"].index(">")])
+                self.assertEqual(link.path, "/sites/north/data_readings")
+                url = link.path + "?" + link.query
+
+        self.assertEqual(timestamps, [3000, 2000, 1000])
+
+    def test_unknown_site_is_not_found(self):
+        self.add_actuator("fan01", db=self.client.greenhouse_north)
+
+        for path in ("/sites/south/actuators", "/sites/North/actuators", "/sites/a.b/actuators"):
+            with self.subTest(path=path):
+                response = self.testapp.get(path, status=404)
+                self.assertIn("not found", response.json["message"])
+
+
+class ListedSitesTests(FunctionalTests):
+    settings = {"tenancy.mode": "header", "tenancy.sites": "north, east"}
+
+    def test_only_listed_sites_are_served(self):
+        for site in ("north", "south"):
+            self.add_actuator("fan01", db=self.client["greenhouse_" + site])
+
+        response = self.testapp.get("/actuators", headers={"X-Greenhouse-Site": "north"})
+        self.assertEqual([actuator["name"] for actuator in response.json], ["fan01"])
+
+        # has a database but isn't listed
+        self.testapp.get("/actuators", headers={"X-Greenhouse-Site": "south"}, status=404)
+        # listed before its database is provisioned
+        self.assertEqual(self.testapp.get("/actuators", headers={"X-Greenhouse-Site": "east"}).json, [])
+
+
+class SiteResponseCacheTests(FunctionalTests):
+    settings = {"cache.max_bytes": "1000000", "tenancy.mode": "header"}
+
+    def test_cached_responses_vary_on_the_site(self):
+        for site, sensor in (("north", "temp01"), ("south", "temp02")):
+            self.add_data_readings("temp", sensor, [1000], db=self.client["greenhouse_" + site])
+
+        for site, sensor in (("north", "temp01"), ("south", "temp02"), ("north", "temp01")):
+            with self.subTest(site=site):
+                response = self.testapp.get("/data_readings", params={"type": "temp", "start_time": "0",
+                                                                      "end_time": "60000"},
+                                            headers={"X-Greenhouse-Site": site})
+
+                self.assertEqual([reading["sensor"]["name"] for reading in response.json], [sensor])
+                self.assertEqual(response.headers["Vary"], "Accept, X-Greenhouse-Site")
@@ -0,0 +1,42 @@
+def includeme(config):
+    """
+    Registers every view without scanning the package, which starts faster (startup.scan = false).
+    Keep this in step with the @view_config decorators, config.scan registers the same views from them
+    """
+    from sgreen2_web.views.actuators import RESTActuators
+    from sgreen2_web.views.data_readings import RESTDataReadings
+    from sgreen2_web.views.greenhouse_server_state import RESTGreenhouseServerState
+    from sgreen2_web.views.home import home
+    from sgreen2_web.views.metrics import metrics
+    from sgreen2_web.views.settings import RESTSettings
+
+    config.add_view(home, route_name="home")
+
+    config.add_view(RESTDataReadings, attr="get", route_name="data_readings", request_method="GET", renderer="json")
+    config.add_view(RESTDataReadings, attr="post", route_name="data_readings", request_method="POST")
+    config.add_view(RESTDataReadings, attr="get_aggregate", route_name="data_readings_aggregate",
+                    request_method="GET", renderer="json")
+    config.add_view(RESTDataReadings, attr="get_stream", route_name="data_readings_stream", request_method="GET")
+
+    config.add_view(RESTSettings, attr="get", route_name="settings", request_method="GET", renderer="json")
+    config.add_view(RESTSettings, attr="post", route_name="settings", request_method="POST", renderer="json")
+
+    config.add_view(RESTActuators, attr="get", route_name="actuators", request_method="GET", renderer="json")
+    config.add_view(RESTActuators, attr="patch", route_name="actuators", request_method="PATCH", renderer="json")
+    config.add_view(RESTActuators, attr="get_type_duty_cycle", route_name="actuators_type_duty_cycle",
+                    request_method="GET", renderer="json")
+    config.add_view(RESTActuators, attr="get_state", route_name="actuators_state", request_method="GET",
+                    renderer="json")
+    config.add_view(RESTActuators, attr="get_state_watch", route_name="actuators_state_watch", request_method="GET",
+                    renderer="json")
+    config.add_view(RESTActuators, attr="put_state", route_name="actuators_state", request_method="PUT")
+    config.add_view(RESTActuators, attr="delete_state", route_name="actuators_state", request_method="DELETE")
+    config.add_view(RESTActuators, attr="get_duty_cycle", route_name="actuators_duty_cycle", request_method="GET",
+                    renderer="json")
+
+    config.add_view(RESTGreenhouseServerState, attr="get", route_name="greenhouse_server_state", request_method="GET",
+                    renderer="json")
+    config.add_view(RESTGreenhouseServerState, attr="post", route_name="greenhouse_server_state",
+                    request_method="POST")
+
+    config.add_view(metrics, route_name="metrics", request_method="GET")
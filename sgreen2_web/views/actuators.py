@@ -1,9 +1,41 @@
+import queue
+import time
+
 import pymongo
-from bson import json_util
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
 from pyramid.response import Response
 from pyramid.view import view_config
 
-from sgreen2_web.helpers import process_start_time_end_time, get_timestamp
+from sgreen2_web.helpers import process_start_time_end_time, get_timestamp, process_limit, process_page_cursor, \
+    paginate, add_next_cursor_headers, next_sequence, parse_duration, get_max_page_size, encode_page_cursor
+from sgreen2_web.formats import process_response_format, to_columnar, make_response
+from sgreen2_web.live import LiveFeedFull, ResumePoint
+from sgreen2_web.streaming import get_stream_format, stream_page
+
+
+def stamp_versions(db: Database, ids: list, switch_id: ObjectId = None) -> None:
+    """
+    Gives switched actuators a version newer than any a poller could have seen before they were switched.
+    The versions are taken after the switch, so they can only ever be sent again, never skipped
+    :param db: the greenhouse database
+    :param ids: the _ids of the switched actuators
+    :param switch_id: the PATCH that switched them, its mark is removed along with version_pending
+    :return: None
+    """
+    last_version = next_sequence(db, "actuators_version", len(ids))
+    update = {"$unset": {"version_pending": ""}}
+
+    if switch_id is not None:
+        update["$pull"] = {"pending_switches": switch_id}
+
+    # $max as a later switch of the same actuator may have stamped it already
+    db.actuators.bulk_write([
+        UpdateOne({"_id": _id}, dict(update, **{"$max": {"version": version}}))
+        for version, _id in enumerate(ids, last_version - len(ids) + 1)
+    ], ordered=False)
 
 
 class RESTActuators(object):
@@ -13,14 +45,45 @@ class RESTActuators(object):
     @view_config(route_name='actuators', request_method='GET', renderer='json')
     def get(self):
         """
-        Gets actuators from the database
+        Gets actuators from the database. If-None-Match returns 304 if no actuator was switched
+        and since_version only returns the actuators switched after that version
         :return: a JSON representation of the data
         """
+        query = dict()
+
+        try:
+            # an actuator is switched before it gets its version, so pending ones are always sent
+            if "since_version" in self.request.GET.keys():
+                query["$or"] = [{"version": {"$gt": int(self.request.GET.getone("since_version"))}},
+                                {"version_pending": True}]
+        except ValueError:
+            return Response(status_code=400, json_body={
+                "message": "since_version must be an integer"
+            })
+
+        # read the version before the actuators so a switch in between is at worst sent again on the next poll
+        latest = self.request.db.actuators.find_one(projection={"_id": 0, "version": 1},
+                                                    sort=[("version", pymongo.DESCENDING)])
+        version = str(latest.get("version", 0) if latest else 0)
+        etag = "actuators-" + version
+
+        if etag in self.request.if_none_match:
+            response = Response(status_code=304)
+            response.etag = etag
+            response.headers["X-Actuators-Version"] = version
+            return response
+
+        self.request.response.etag = etag
+        self.request.response.headers["X-Actuators-Version"] = version
+        self.request.response.headers["Cache-Control"] = "no-cache"
+
         # sorting by type allows grouping to be done on the actuators more quickly
         # sorting then by name allows for better viewing
-        actuators = self.request.db.actuators.find(projection={"_id": 0},
+        actuators = self.request.db.actuators.find(filter=query,
+                                                   projection={"_id": 0, "version_pending": 0,
+                                                               "pending_switches": 0},
                                                    sort=[("type", pymongo.ASCENDING), ("name", pymongo.ASCENDING)])
-        return json_util.loads(json_util.dumps(actuators))
+        return actuators
 
     @view_config(route_name='actuators_state', request_method='GET', renderer='json')
     def get_state(self):
@@ -40,23 +103,138 @@ class RESTActuators(object):
         # get optional query params
         try:
             start_time, end_time = process_start_time_end_time(self.request)
+            limit = process_limit(self.request)
+            after = process_page_cursor(self.request, (int, ObjectId))
+            stream_format = get_stream_format(self.request)
+            encoding, columnar = process_response_format(self.request, stream_format)
         except ValueError as err:
             return Response(status_code=400, json_body={
                 "message": str(err)
             })
 
-        data = self.request.db.actuators_state_log.find(
-            filter={
-                "name": name,
-                "timestamp": {
-                    "$gte": start_time,
-                    "$lte": end_time
-                }
-            },
-            projection={"_id": 0},
-            sort=[("timestamp", pymongo.DESCENDING)])
+        query = {
+            "name": name,
+            "timestamp": {
+                "$gte": start_time,
+                "$lte": end_time
+            }
+        }
+
+        # seek past the last entry of the previous page instead of skipping
+        if after is not None:
+            timestamp, _id = after
+            query["$or"] = [
+                {"timestamp": {"$lt": timestamp}},
+                {"timestamp": timestamp, "_id": {"$lt": _id}}
+            ]
+
+        # _id breaks ties between switches with the same timestamp
+        data = self.request.get_db("history").actuators_state_log.find(
+            filter=query,
+            sort=[("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+            limit=limit + 1)
+
+        def get_key(entry):
+            return [entry["timestamp"], entry["_id"]]
+
+        if stream_format:
+            return stream_page(data, limit, get_key, stream_format)
+
+        page, next_cursor = paginate(data, limit, get_key)
+
+        # parallel arrays so key names aren't repeated for every entry
+        if columnar:
+            page = to_columnar(page, lambda entry: entry["name"], {"timestamps": "timestamp", "to_states": "to_state"})
+
+        response = make_response(self.request, page, encoding)
+        add_next_cursor_headers(self.request, response, next_cursor)
+
+        return page if response is self.request.response else response
+
+    @view_config(route_name='actuators_state_watch', request_method='GET', renderer='json')
+    def get_state_watch(self):
+        """
+        Waits for an actuator to be switched. Returns the state log entries after the cursor as soon as there are
+        any, or an empty list once the timeout runs out. X-Watch-Cursor holds the cursor to watch again with
+        :return: a JSON representation of the data
+        """
+        name = self.request.matchdict["name"]
+
+        if self.request.db.actuators.find_one({"name": name}, projection={"_id": 1}) is None:
+            return Response(status_code=404, json_body={
+                "message": "actuator '" + name + "' not found"
+            })
+
+        watches = self.request.registry.actuator_watches
+        overlap = int(watches.resume_overlap_seconds * 1000)
 
-        return json_util.loads(json_util.dumps(data))
+        try:
+            after = process_page_cursor(self.request, (int, list), "after")
+            resume_point = None
+            timeout = watches.max_timeout_seconds
+
+            if after is not None:
+                try:
+                    resume_point = ResumePoint.from_key(after, overlap)
+                except ValueError:
+                    raise ValueError("after is not a valid cursor")
+
+            if "timeout" in self.request.GET.keys():
+                timeout = min(parse_duration(self.request.GET.getone("timeout"), "timeout") / 1000, timeout)
+        except ValueError as err:
+            return Response(status_code=400, json_body={
+                "message": str(err)
+            })
+
+        if resume_point is None:
+            # without a cursor only switches from now on are returned, read before watching so a switch in between
+            # is left for the cursor this returns
+            resume_point = ResumePoint(overlap)
+            resume_point.newest = get_timestamp()
+            self.__read_state_log(name, resume_point)
+
+        try:
+            feed, client = watches.subscribe(self.request.db, name)
+        except LiveFeedFull as err:
+            return Response(status_code=503, json_body={"message": str(err)})
+
+        try:
+            # watching before reading the log so a switch in between isn't missed
+            entries = self.__read_state_log(name, resume_point) if after is not None else list()
+
+            deadline = time.monotonic() + timeout
+
+            # a switch wakes the request, the ones queued right behind it are returned with it
+            while not entries and not client.dropped and time.monotonic() < deadline:
+                try:
+                    switched = [client.queue.get(timeout=max(deadline - time.monotonic(), 0))]
+                except queue.Empty:
+                    break
+
+                while not client.queue.empty():
+                    switched.append(client.queue.get_nowait())
+
+                entries = [entry for entry in switched if resume_point.add(entry)]
+        finally:
+            feed.unsubscribe(client)
+
+        self.request.response.headers["Cache-Control"] = "no-cache"
+        self.request.response.headers["X-Watch-Cursor"] = encode_page_cursor(resume_point.get_key())
+
+        return [{key: value for key, value in entry.items() if key != "_id"} for entry in entries]
+
+    def __read_state_log(self, name: str, resume_point: ResumePoint) -> list:
+        """
+        Timestamps only have whole seconds and _ids aren't in insertion order across processes, so the log is read
+        again from a little before the resume point and the entries it already returned are skipped
+        :return: the new state log entries of the actuator, oldest first
+        """
+        logged = self.request.db.actuators_state_log.find(
+            filter={"name": name, "timestamp": {"$gte": resume_point.newest - resume_point.overlap_ms}},
+            sort=[("timestamp", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+            limit=get_max_page_size(self.request))
+
+        return [entry for entry in logged if resume_point.add(entry)]
 
     @view_config(route_name='actuators_state', request_method='PUT')
     def put_state(self):
@@ -74,37 +252,275 @@ class RESTActuators(object):
         """
         return self.__switch_actuator(False)
 
+    @view_config(route_name='actuators', request_method='PATCH', renderer='json')
+    def patch(self):
+        """
+        Switches many actuators at once. The body maps actuator names to the state to switch them to
+        :return: a JSON representation of which actuators were switched, unchanged or not found
+        """
+        try:
+            states = self.request.json_body
+
+            if not isinstance(states, dict) or len(states) == 0 or \
+                    not all(isinstance(state, bool) for state in states.values()):
+                raise Exception()
+        except Exception:
+            return Response(status_code=400, json_body={
+                "message": "body must map actuator names to true or false"
+            })
+
+        # switches must not be lost, they are written with the control write concern
+        db = self.request.get_db("control")
+        names = list(states.keys())
+
+        # one conditional update per actuator in a single bulk write. Each switch is marked with this request's id,
+        # so what this request switched is known for sure whatever other requests switch at the same time
+        switch_id = ObjectId()
+        failed = dict()
+
+        try:
+            db.actuators.bulk_write([
+                UpdateOne({"name": name, "state": {"$ne": state}},
+                          {"$set": {"state": state, "version_pending": True},
+                           "$addToSet": {"pending_switches": switch_id}})
+                for name, state in states.items()
+            ], ordered=False)
+        except BulkWriteError as err:
+            # the other updates of an unordered bulk write are still applied
+            for write_error in err.details["writeErrors"]:
+                failed[names[write_error["index"]]] = write_error["errmsg"]
+
+        switched = dict()
+        unchanged = list()
+
+        for actuator in db.actuators.find({"name": {"$in": names}},
+                                          projection={"_id": 1, "name": 1, "pending_switches": 1}):
+            if switch_id in actuator.get("pending_switches", ()):
+                switched[actuator["name"]] = actuator["_id"]
+            elif actuator["name"] not in failed:
+                unchanged.append(actuator["name"])
+
+        if switched:
+            stamp_versions(db, list(switched.values()), switch_id)
+
+            timestamp = get_timestamp()
+            db.actuators_state_log.insert_many([{
+                "name": name,
+                "to_state": states[name],
+                "timestamp": timestamp
+            } for name in switched])
+
+        found = set(switched.keys()).union(unchanged).union(failed)
+
+        # some switches didn't go through, the ones listed as switched did
+        if failed:
+            self.request.response.status_code = 207
+
+        return {
+            "switched": sorted(switched),
+            "unchanged": sorted(unchanged),
+            "not_found": sorted(name for name in names if name not in found),
+            "failed": [{"name": name, "message": failed[name]} for name in sorted(failed)]
+        }
+
+    @view_config(route_name='actuators_duty_cycle', request_method='GET', renderer='json')
+    def get_duty_cycle(self):
+        """
+        Gets the on time, number of switches and duty cycle of an actuator
+        :return: a JSON representation of the data
+        """
+        name = self.request.matchdict["name"]
+        actuator = self.request.db.actuators.find_one({"name": name}, projection={"_id": 0})
+
+        if actuator is None:
+            return Response(status_code=404, json_body={
+                "message": "actuator '" + name + "' not found"
+            })
+
+        try:
+            start_time, end_time, bucket = self.__process_duty_cycle_params()
+        except ValueError as err:
+            return Response(status_code=400, json_body={
+                "message": str(err)
+            })
+
+        return self.__get_duty_cycle(actuator, start_time, end_time, bucket)
+
+    @view_config(route_name='actuators_type_duty_cycle', request_method='GET', renderer='json')
+    def get_type_duty_cycle(self):
+        """
+        Gets the on time, number of switches and duty cycle of every actuator of a type
+        :return: a JSON representation of the data
+        """
+        if "type" not in self.request.GET.keys():
+            return Response(status_code=400, json_body={
+                "message": "required param 'type' not met"
+            })
+
+        try:
+            start_time, end_time, bucket = self.__process_duty_cycle_params()
+        except ValueError as err:
+            return Response(status_code=400, json_body={
+                "message": str(err)
+            })
+
+        actuators = self.request.db.actuators.find({"type": self.request.GET.getone("type")},
+                                                   projection={"_id": 0},
+                                                   sort=[("type", pymongo.ASCENDING), ("name", pymongo.ASCENDING)])
+
+        return [self.__get_duty_cycle(actuator, start_time, end_time, bucket) for actuator in actuators]
+
+    def __process_duty_cycle_params(self) -> tuple:
+        """
+        Gets the time range and bucket size for the duty cycle endpoints
+        :return: a tuple of (start_time, end_time, bucket), bucket is None if not given
+        """
+        start_time, end_time = process_start_time_end_time(self.request)
+
+        # the state after now isn't known yet
+        end_time = min(end_time, get_timestamp())
+
+        if start_time >= end_time:
+            raise ValueError("start_time must be before end_time and the current time")
+
+        bucket = None
+
+        if "bucket" in self.request.GET.keys():
+            bucket = parse_duration(self.request.GET.getone("bucket"), "bucket")
+
+            if (end_time - start_time) // bucket + 1 > get_max_page_size(self.request):
+                raise ValueError("bucket is too small for the time range")
+
+        return start_time, end_time, bucket
+
+    def __get_duty_cycle(self, actuator: dict, start_time: int, end_time: int, bucket: int) -> dict:
+        """
+        Replays the state log of an actuator over the time range
+        :param actuator: the actuator
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range, not after the current time
+        :param bucket: the bucket size, or None for one bucket over the whole time range
+        :return: the totals for the time range and per bucket
+        """
+        name = actuator["name"]
+        db = self.request.get_db("history")
+
+        # the state at start_time is the last switch before it. If there is none, it is the opposite of the
+        # first switch after it, and if the actuator never switched it is the current state
+        previous = db.actuators_state_log.find_one({"name": name, "timestamp": {"$lt": start_time}},
+                                                   sort=[("timestamp", pymongo.DESCENDING),
+                                                         ("_id", pymongo.DESCENDING)])
+
+        if previous is not None:
+            state = previous["to_state"]
+        else:
+            following = db.actuators_state_log.find_one({"name": name,
+                                                         "timestamp": {"$gte": start_time}},
+                                                        sort=[("timestamp", pymongo.ASCENDING),
+                                                              ("_id", pymongo.ASCENDING)])
+            state = not following["to_state"] if following is not None else actuator["state"]
+
+        entries = db.actuators_state_log.find(
+            filter={
+                "name": name,
+                "timestamp": {
+                    "$gte": start_time,
+                    "$lte": end_time
+                }
+            },
+            projection={"_id": 0, "to_state": 1, "timestamp": 1},
+            sort=[("timestamp", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+
+        # buckets start on multiples of the bucket size since the Unix epoch
+        if bucket is None:
+            bucket = end_time - start_time
+            first_bucket = start_time
+        else:
+            first_bucket = start_time - start_time % bucket
+
+        buckets = [{
+            "timestamp": timestamp,
+            "on_time": 0,
+            "switches": 0
+        } for timestamp in range(first_bucket, end_time, bucket)]
+
+        def add_on_time(on_since: int, off_at: int) -> None:
+            for i in range((on_since - first_bucket) // bucket, len(buckets)):
+                bucket_end = buckets[i]["timestamp"] + bucket
+
+                buckets[i]["on_time"] += min(off_at, bucket_end) - max(on_since, buckets[i]["timestamp"])
+
+                if off_at <= bucket_end:
+                    break
+
+        since = start_time
+
+        for entry in entries:
+            # repeated entries for the same state are not switches
+            if entry["to_state"] == state:
+                continue
+
+            if state:
+                add_on_time(since, entry["timestamp"])
+
+            state = entry["to_state"]
+            since = entry["timestamp"]
+            buckets[min((since - first_bucket) // bucket, len(buckets) - 1)]["switches"] += 1
+
+        # an actuator that is still on is counted up to the end of the time range
+        if state:
+            add_on_time(since, end_time)
+
+        for b in buckets:
+            covered = min(b["timestamp"] + bucket, end_time) - max(b["timestamp"], start_time)
+            b["duty_cycle"] = b["on_time"] / covered if covered > 0 else 0.0
+
+        on_time = sum(b["on_time"] for b in buckets)
+
+        return {
+            "name": name,
+            "type": actuator["type"],
+            "on_time": on_time,
+            "switches": sum(b["switches"] for b in buckets),
+            "duty_cycle": on_time / (end_time - start_time),
+            "buckets": buckets
+        }
+
     def __switch_actuator(self, state):
         """
         Switches the actuator state in the database and inserts the change into the log.
-        If no change will be made, the call is ignored.
+        The switch is a single conditional update, so if no change will be made
+        (or another request made it first) the call is ignored.
         :param state: the state to change the actuator to
         :return: a Pyramid response
         """
 
         name = self.request.matchdict["name"]
+        # switches must not be lost, they are written with the control write concern
+        db = self.request.get_db("control")
 
-        # get actuator by name
-        actuator = self.request.db.actuators.find_one({"name": name})
+        # only matches if the actuator isn't in that state already. Pollers get pending actuators every time
+        # until they are stamped with a version
+        switched = db.actuators.find_one_and_update({
+            "name": name,
+            "state": {"$ne": state}
+        }, {
+            "$set": {"state": state, "version_pending": True}
+        }, projection={"_id": 1})
 
-        if actuator is None:
-            return Response(status_code=404, json_body={"message": "actuator '" + name + "' not found"})
-
-        # don't update databases if state hasn't changed
-        if state != actuator["state"]:
-            # insert into actuator state log
-            self.request.db.actuators_state_log.insert_one({
-                "name": actuator["name"],
-                "to_state": state,
-                "timestamp": get_timestamp()
-            })
+        if switched is None:
+            if db.actuators.find_one({"name": name}, projection={"_id": 1}) is None:
+                return Response(status_code=404, json_body={"message": "actuator '" + name + "' not found"})
 
-            # update actuator state
-            actuator["state"] = state
-            self.request.db.actuators.update_one({
-                "name": actuator["name"]
-            }, {
-                "$set": actuator
-            })
+            return Response(status_code=204)
+
+        stamp_versions(db, [switched["_id"]])
+
+        # insert into actuator state log
+        db.actuators_state_log.insert_one({
+            "name": name,
+            "to_state": state,
+            "timestamp": get_timestamp()
+        })
 
         return Response(status_code=204)
@@ -1,11 +1,23 @@
-import time
+import json
+import queue
 
 import pymongo
-from bson import json_util
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 from pyramid.response import Response
 from pyramid.view import view_config, view_defaults
 
-from sgreen2_web.helpers import process_start_time_end_time, get_timestamp
+from sgreen2_web.helpers import process_start_time_end_time, parse_duration, process_limit, \
+    process_page_cursor, paginate, add_next_cursor_headers, get_max_page_size, encode_page_cursor
+from sgreen2_web.formats import process_response_format, to_columnar, make_response
+from sgreen2_web.ingest import IngestionQueueFull
+from sgreen2_web.live import EVENT_STREAM_CONTENT_TYPE, LiveClient, LiveFeedFull, ResumePoint, TailingFeed, \
+    format_event, parse_event_id
+from sgreen2_web.readings import build_data_reading, build_data_readings
+from sgreen2_web.rollups import bucket_pipeline, find_rollups, pick_tier
+from sgreen2_web.streaming import get_stream_format, stream_page
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson")
 
 
 @view_defaults(route_name="data_readings")
@@ -16,7 +28,7 @@ class RESTDataReadings(object):
     @view_config(request_method="GET", renderer="json")
     def get(self):
         """
-        Returns data readings
+        Returns data readings, or the buckets of the coarsest rollup tier that fits the resolution
         :return: a JSON representation of the data
         """
 
@@ -27,62 +39,261 @@ class RESTDataReadings(object):
 
         try:
             start_time, end_time = process_start_time_end_time(self.request)
+            resolution = None
+
+            if "resolution" in self.request.GET.keys():
+                resolution = parse_duration(self.request.GET.getone("resolution"), "resolution")
+
+            tier = pick_tier(resolution, end_time - start_time)
+            limit = process_limit(self.request)
+            after = process_page_cursor(self.request, (str, int, ObjectId) if tier is None else (str, int))
+            stream_format = get_stream_format(self.request)
+            encoding, columnar = process_response_format(self.request, stream_format)
         except ValueError as err:
             return Response(status_code=400, json_body={
                 "message": str(err)
             })
 
-        data = self.request.db.data_readings.find(
-            filter={
-                "sensor.type": self.request.GET.getone("type"),
-                "timestamp": {
-                    "$gte": start_time,
-                    "$lte": end_time
-                }
-            },
-            projection={"_id": 0},
-            sort=[("sensor.name", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)])
+        if tier is not None:
+            return self.__get_rollups(tier, start_time, end_time, after, limit, stream_format, encoding, columnar)
+
+        query = {
+            "sensor.type": self.request.GET.getone("type"),
+            "timestamp": {
+                "$gte": start_time,
+                "$lte": end_time
+            }
+        }
+
+        # seek past the last document of the previous page instead of skipping
+        if after is not None:
+            name, timestamp, _id = after
+            query["$or"] = [
+                {"sensor.name": {"$gt": name}},
+                {"sensor.name": name, "timestamp": {"$lt": timestamp}},
+                {"sensor.name": name, "timestamp": timestamp, "_id": {"$lt": _id}}
+            ]
+
+        # _id breaks ties between readings of the same sensor with the same timestamp
+        data = self.request.get_db("history").data_readings.find(
+            filter=query,
+            sort=[("sensor.name", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)],
+            limit=limit + 1)
+
+        def get_key(reading):
+            return [reading["sensor"]["name"], reading["timestamp"], reading["_id"]]
+
+        if stream_format:
+            response = stream_page(data, limit, get_key, stream_format)
+            response.headers["X-Resolution"] = "raw"
+            return response
+
+        page, next_cursor = paginate(data, limit, get_key)
+
+        # parallel arrays per sensor so key names aren't repeated for every reading
+        if columnar:
+            columns = {"timestamps": "timestamp", "readings": "reading"}
+
+            if self.request.GET.getone("type") == "batt":
+                columns["health"] = "health"
+
+            page = to_columnar(page, lambda reading: reading["sensor"]["name"], columns)
 
-        return json_util.loads(json_util.dumps(data))
+        response = make_response(self.request, page, encoding)
+        response.headers["X-Resolution"] = "raw"
+        add_next_cursor_headers(self.request, response, next_cursor)
+
+        return page if response is self.request.response else response
+
+    def __get_rollups(self, tier, start_time: int, end_time: int, after: list, limit: int, stream_format: str,
+                      encoding: str, columnar: bool):
+        """
+        Returns a page of the buckets of a rollup tier, shaped like the results of GET /data_readings/aggregate
+        :return: a JSON representation of the data
+        """
+        data = find_rollups(self.request.get_db("history"), tier, self.request.GET.getone("type"), start_time,
+                            end_time, after, limit + 1)
+
+        def get_key(b):
+            return [b["sensor"]["name"], b["timestamp"]]
+
+        if stream_format:
+            response = stream_page(data, limit, get_key, stream_format)
+            response.headers["X-Resolution"] = tier.name
+            return response
+
+        page, next_cursor = paginate(data, limit, get_key)
+
+        if columnar:
+            page = to_columnar(page, lambda b: b["sensor"]["name"], {"timestamps": "timestamp", "mins": "min",
+                                                                     "maxes": "max", "means": "mean",
+                                                                     "counts": "count"})
+
+        response = make_response(self.request, page, encoding)
+        response.headers["X-Resolution"] = tier.name
+        add_next_cursor_headers(self.request, response, next_cursor)
+
+        return page if response is self.request.response else response
+
+    @view_config(route_name="data_readings_aggregate", request_method="GET", renderer="json")
+    def get_aggregate(self):
+        """
+        Returns the min, max, mean and count of data readings per sensor per time bucket
+        :return: a JSON representation of the data
+        """
+
+        if "type" not in self.request.GET.keys():
+            return Response(status_code=400, json_body={
+                "message": "required param 'type' not met"
+            })
+
+        if "bucket" not in self.request.GET.keys():
+            return Response(status_code=400, json_body={
+                "message": "required param 'bucket' not met"
+            })
+
+        try:
+            start_time, end_time = process_start_time_end_time(self.request)
+            bucket = parse_duration(self.request.GET.getone("bucket"), "bucket")
+
+            # every bucket is a $group key held in memory by the aggregation
+            if (end_time - start_time) // bucket + 1 > get_max_page_size(self.request):
+                raise ValueError("bucket is too small for the time range")
+        except ValueError as err:
+            return Response(status_code=400, json_body={
+                "message": str(err)
+            })
+
+        sensor_type = self.request.GET.getone("type")
+
+        data = self.request.get_db("history").data_readings.aggregate(
+            bucket_pipeline(sensor_type, {"$gte": start_time, "$lte": end_time}, bucket))
+
+        return data
+
+    @view_config(route_name="data_readings_stream", request_method="GET")
+    def get_stream(self):
+        """
+        Streams new data readings of a sensor type as Server-Sent Events. Each event's id is where the stream is up
+        to, a client that reconnects with Last-Event-ID first gets the data readings it missed and none it already has
+        :return: a Pyramid response object
+        """
+        if "type" not in self.request.GET.keys():
+            return Response(status_code=400, json_body={
+                "message": "required param 'type' not met"
+            })
+
+        sensor_type = self.request.GET.getone("type")
+        overlap = int(self.request.registry.live_feeds.resume_overlap_seconds * 1000)
+
+        try:
+            feed, client = self.request.registry.live_feeds.subscribe(self.request.db, sensor_type)
+        except LiveFeedFull as err:
+            return Response(status_code=503, json_body={"message": str(err)})
+
+        # subscribed first so nothing inserted while the missed data readings are read falls in between
+        resume_point = parse_event_id(self.request.headers.get("Last-Event-ID", ""), overlap)
+        missed = list()
+
+        if resume_point is None:
+            resume_point = ResumePoint(overlap)
+        else:
+            missed = self.__read_missed(sensor_type, resume_point)
+
+        response = Response(app_iter=self.__event_stream(feed, client, missed, resume_point),
+                            content_type=EVENT_STREAM_CONTENT_TYPE)
+        response.headers["Cache-Control"] = "no-cache"
+        # stops proxies from buffering the events
+        response.headers["X-Accel-Buffering"] = "no"
+
+        return response
+
+    def __read_missed(self, sensor_type: str, resume_point: ResumePoint):
+        """
+        Reads the data readings since the resume point a page at a time, oldest first. _ids aren't in insertion order
+        across processes, so this starts a little before the last event and the event stream skips what the client
+        already has
+        """
+        query = resume_point.query({"sensor.type": sensor_type})
+        page_size = get_max_page_size(self.request)
+        last = None
+
+        while True:
+            page_query = query
+
+            # seek past the last data reading of the previous page
+            if last is not None:
+                page_query = {"$and": [query, {"$or": [
+                    {"timestamp": {"$gt": last["timestamp"]}},
+                    {"timestamp": last["timestamp"], "_id": {"$gt": last["_id"]}}
+                ]}]}
+
+            page = list(self.request.get_db("history").data_readings.find(
+                filter=page_query, sort=[("timestamp", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                limit=page_size))
+
+            yield from page
+
+            if len(page) < page_size:
+                return
+
+            last = page[-1]
+
+    def __event_stream(self, feed: TailingFeed, client: LiveClient, missed, resume_point: ResumePoint):
+        """
+        Writes the missed data readings, then new ones as the feed hands them over, until the client goes away
+        or falls too far behind
+        """
+        keepalive = self.request.registry.live_feeds.keepalive_seconds
+
+        try:
+            yield b"retry: 3000\n\n"
+
+            for document in missed:
+                if resume_point.add(document):
+                    yield format_event(document, encode_page_cursor(resume_point.get_key()))
+
+            while not client.dropped:
+                try:
+                    document = client.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    # a comment line, it also finds clients that have gone away
+                    yield b": keepalive\n\n"
+                    continue
+
+                if resume_point.add(document):
+                    yield format_event(document, encode_page_cursor(resume_point.get_key()))
+        finally:
+            feed.unsubscribe(client)
 
     @view_config(request_method="POST")
     def post(self):
         """
-        Adds a data reading
+        Adds a data reading. If the body is a JSON array or NDJSON, adds a batch of data readings
         :return: a Pyramid response object
         """
         try:
-            if not ("reading" in self.request.json_body and "sensor" in self.request.json_body and
-                    "type" in self.request.json_body["sensor"] and "name" in self.request.json_body["sensor"]):
-                raise Exception("Required fields not met")
-
-            data_reading = {
-                "timestamp": get_timestamp(),
-                "reading": float(self.request.json_body["reading"]),
-                "sensor": {
-                    "type": self.request.json_body["sensor"]["type"],
-                    "name": self.request.json_body["sensor"]["name"]
-                }
-            }
+            if self.request.content_type in NDJSON_CONTENT_TYPES:
+                return self.__post_batch(self.__parse_ndjson_body())
+
+            body = self.request.json_body
+
+            if isinstance(body, list):
+                return self.__post_batch(body)
 
-            if "unit" in self.request.json_body:
-                unit = self.request.json_body["unit"]
+            data_reading = build_data_reading(body, self.request.registry.unit_converter)
 
-                if data_reading["sensor"]["type"] == "temp" and unit.lower() == "temp_c":
-                    data_reading["reading"] = self.__celsius_to_fahrenheit(data_reading["reading"])
+            ingest_queue = self.request.registry.ingest_queue
 
-                if data_reading["sensor"]["type"] == "soil" and unit.lower() == "soil_raw":
-                    data_reading["reading"] = self.__soil_raw_to_percent(data_reading["reading"])
+            if ingest_queue is not None:
+                try:
+                    ingest_queue.put("data_readings", data_reading, self.request.get_db("readings"))
+                except IngestionQueueFull as err:
+                    return Response(status_code=503, json_body={"message": str(err)})
 
-            if data_reading["sensor"]["type"] == "batt":
-                if data_reading["reading"] > 5:
-                    data_reading["health"] = "good"
-                elif data_reading["reading"] > 4:
-                    data_reading["health"] = "low"
-                else:
-                    data_reading["health"] = "critical"
+                return Response(status_code=202)
 
-            self.request.db.data_readings.insert_one(data_reading)
+            self.request.get_db("readings").data_readings.insert_one(data_reading)
 
             return Response(status_code=201)
         except ValueError:
@@ -90,10 +301,76 @@ class RESTDataReadings(object):
         except Exception as err:
             return Response(status_code=400, json_body={"message": str(err)})
 
-    @staticmethod
-    def __soil_raw_to_percent(reading: float) -> float:
-        return min((reading / 1023.0) * 100.0, 100)
+    def __post_batch(self, items: list) -> Response:
+        """
+        Validates each data reading in the batch on its own and writes the valid ones with one unordered bulk insert,
+        or queues them if buffered ingestion is on
+        :param items: the parsed data readings from the request body
+        :return: a Pyramid response with the outcome of each item in the order it was given
+        """
+        ingest_queue = self.request.registry.ingest_queue
+        success_status = 201 if ingest_queue is None else 202
+
+        if len(items) == 0:
+            raise Exception("no data readings given")
+
+        results = list()
+        data_readings = list()
+        # index into items for each document in data_readings so bulk write errors can be traced back
+        item_indexes = list()
+
+        # lines of an NDJSON body that aren't valid JSON are already exceptions
+        built = build_data_readings([None if isinstance(item, Exception) else item for item in items],
+                                    self.request.registry.unit_converter)
+
+        for i, (item, data_reading) in enumerate(zip(items, built)):
+            if isinstance(item, Exception):
+                data_reading = item
+
+            if isinstance(data_reading, ValueError):
+                results.append({"status": 400, "message": "data reading must be of type float"})
+            elif isinstance(data_reading, Exception):
+                results.append({"status": 400, "message": str(data_reading)})
+            else:
+                data_readings.append(data_reading)
+                item_indexes.append(i)
+                results.append({"status": success_status})
+
+        if data_readings and ingest_queue is not None:
+            for i, data_reading in zip(item_indexes, data_readings):
+                try:
+                    ingest_queue.put("data_readings", data_reading, self.request.get_db("readings"))
+                except IngestionQueueFull as err:
+                    results[i] = {"status": 503, "message": str(err)}
+        elif data_readings:
+            try:
+                self.request.get_db("readings").data_readings.insert_many(data_readings, ordered=False)
+            except BulkWriteError as err:
+                for write_error in err.details["writeErrors"]:
+                    results[item_indexes[write_error["index"]]] = {"status": 500, "message": write_error["errmsg"]}
+
+        inserted = sum(1 for result in results if result["status"] == success_status)
+
+        return Response(status_code=success_status if inserted == len(results) else 207, json_body={
+            "inserted": inserted,
+            "results": results
+        })
+
+    def __parse_ndjson_body(self) -> list:
+        """
+        Parses a newline delimited JSON body. Lines that are not valid JSON are kept as an exception
+        so that they are reported for that item only
+        :return: a list of parsed data readings
+        """
+        items = list()
+
+        for line in self.request.text.splitlines():
+            if not line.strip():
+                continue
+
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(Exception("data reading is not valid JSON"))
 
-    @staticmethod
-    def __celsius_to_fahrenheit(temp: float) -> float:
-        return (9.0 / 5.0) * temp + 32
+        return items
@@ -1,9 +1,25 @@
 import pymongo
-from bson import json_util
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
 from pyramid.response import Response
 from pyramid.view import view_config, view_defaults
 
-from sgreen2_web.helpers import process_start_time_end_time, get_timestamp
+from sgreen2_web.cache import mark_window_changing
+from sgreen2_web.helpers import process_start_time_end_time, get_timestamp, parse_duration
+from sgreen2_web.ingest import IngestionQueueFull
+from sgreen2_web.streaming import get_stream_format, stream_cursor, stream_documents
+
+# a ping later than this after the last one starts a new uptime interval, if heartbeat_gap is not set in the .ini file
+DEFAULT_HEARTBEAT_GAP = "2m"
+
+
+def get_heartbeat_gap(settings: dict) -> int:
+    """
+    Gets the heartbeat gap from the .ini settings
+    :param settings: the app settings
+    :return: the heartbeat gap in milliseconds
+    """
+    return parse_duration(settings.get("heartbeat_gap", DEFAULT_HEARTBEAT_GAP), "heartbeat_gap")
 
 
 @view_defaults(route_name="greenhouse_server_state")
@@ -11,43 +27,159 @@ class RESTGreenhouseServerState(object):
     def __init__(self, request):
         self.request = request
 
+    def __get_heartbeat_gap(self) -> int:
+        return get_heartbeat_gap(self.request.registry.settings)
+
     @view_config(request_method="GET", renderer="json")
     def get(self):
         """
-        Gets list of server states
+        Gets the intervals the server was up during, most recent first. With gaps=true
+        the silences between them are included with a state of false
         :return: a JSON representation of the data
         """
         # get optional query params
         try:
             start_time, end_time = process_start_time_end_time(self.request)
+            stream_format = get_stream_format(self.request)
         except ValueError as err:
             return Response(status_code=400, json_body={
                 "message": str(err)
             })
 
-        data = self.request.db.greenhouse_server_state.find(
+        db = self.request.get_db("history")
+
+        # pings still extend the newest interval, so a window it overlaps keeps changing however old its end is
+        if self.request.registry.response_cache is not None and "end_time" in self.request.GET.keys():
+            latest = db.greenhouse_server_uptime.find_one(projection={"_id": 0, "start_time": 1, "end_time": 1},
+                                                          sort=[("end_time", pymongo.DESCENDING)])
+
+            if latest is not None and latest["start_time"] <= end_time and \
+                    latest["end_time"] >= get_timestamp() - self.__get_heartbeat_gap():
+                mark_window_changing(self.request)
+
+        # intervals never overlap, so sorting by end_time is the same as sorting by start_time
+        data = db.greenhouse_server_uptime.find(
             filter={
-                "timestamp": {
-                    "$gte": start_time,
-                    "$lte": end_time
-                }
+                "end_time": {"$gte": start_time},
+                "start_time": {"$lte": end_time}
             },
-            projection={"_id": 0},
-            sort=[("timestamp", pymongo.DESCENDING)])
+            projection={"_id": 0, "start_time": 1, "end_time": 1},
+            sort=[("end_time", pymongo.DESCENDING)])
+
+        if self.request.GET.get("gaps", "false").lower() == "true":
+            data = self.__add_gaps(list(data), start_time, end_time)
+
+            return stream_documents(data, stream_format) if stream_format else data
+
+        if stream_format:
+            return stream_cursor(data, stream_format)
+
+        return data
+
+    def __add_gaps(self, intervals: list, start_time: int, end_time: int) -> list:
+        """
+        Adds the silences between uptime intervals and at the edges of the window
+        :param intervals: the uptime intervals in the window, most recent first
+        :param start_time: the start of the window
+        :param end_time: the end of the window
+        :return: the intervals and gaps, most recent first, each with a state
+        """
+        heartbeat_gap = self.__get_heartbeat_gap()
+        states = list()
+
+        # walking backwards in time, previous_start is the start of the interval after the current one
+        previous_start = end_time
+
+        for interval in intervals:
+            if previous_start - interval["end_time"] > heartbeat_gap:
+                states.append({"start_time": interval["end_time"], "end_time": previous_start, "state": False})
 
-        return json_util.loads(json_util.dumps(data))
+            interval["state"] = True
+            states.append(interval)
+            previous_start = interval["start_time"]
+
+        if previous_start - start_time > heartbeat_gap:
+            states.append({"start_time": start_time, "end_time": previous_start, "state": False})
+
+        return states
 
     @view_config(request_method="POST")
     def post(self):
         """
-        Adds a server state
+        Records that the server is up. A ping within the heartbeat gap of the last one extends
+        the current uptime interval in place, otherwise a new interval is started
         :return: a Pyramid response object
         """
-        server_state = {
-            "timestamp": get_timestamp(),
-            "state": True
-        }
+        timestamp = get_timestamp()
+
+        ingest_queue = self.request.registry.ingest_queue
+
+        if ingest_queue is not None:
+            try:
+                ingest_queue.put("greenhouse_server_uptime", timestamp, self.request.get_db("heartbeats"))
+            except IngestionQueueFull as err:
+                return Response(status_code=503, json_body={"message": str(err)})
 
-        self.request.db.greenhouse_server_state.insert_one(server_state)
+            return Response(status_code=202)
+
+        record_ping(self.request.get_db("heartbeats"), timestamp, timestamp, 1, self.__get_heartbeat_gap())
 
         return Response(status_code=201)
+
+
+def record_ping(db: Database, start_time: int, end_time: int, pings: int, heartbeat_gap: int) -> None:
+    """
+    Extends the current uptime interval if it ended within the heartbeat gap of start_time, otherwise starts a new one
+    :param db: the greenhouse database
+    :param start_time: the first ping
+    :param end_time: the last ping
+    :param pings: how many pings there were from start_time to end_time
+    :param heartbeat_gap: the heartbeat gap in milliseconds
+    :return: None
+    """
+    update = {"$min": {"start_time": start_time}, "$max": {"end_time": end_time}, "$inc": {"pings": pings}}
+
+    extended = db.greenhouse_server_uptime.find_one_and_update(
+        {"end_time": {"$gte": start_time - heartbeat_gap}},
+        update,
+        sort=[("end_time", pymongo.DESCENDING)],
+        projection={"_id": 1})
+
+    if extended is not None:
+        return
+
+    latest = db.greenhouse_server_uptime.find_one(projection={"_id": 1, "end_time": 1},
+                                                  sort=[("end_time", pymongo.DESCENDING)])
+
+    # another process started the interval since
+    if latest is not None and latest["end_time"] >= start_time - heartbeat_gap:
+        db.greenhouse_server_uptime.update_one({"_id": latest["_id"]}, update)
+        return
+
+    # the new interval is keyed on the one before it, with a unique index, so processes whose first pings after
+    # a silence land at once write to the same interval instead of each starting one. 0 if there is none, a null
+    # would also match the intervals converted from pings, which don't have previous_id
+    previous = {"previous_id": latest["_id"] if latest is not None else 0}
+
+    try:
+        db.greenhouse_server_uptime.update_one(previous, update, upsert=True)
+    except DuplicateKeyError:
+        # lost the race to insert it
+        db.greenhouse_server_uptime.update_one(previous, update)
+
+
+def record_pings(db: Database, timestamps: list, heartbeat_gap: int) -> None:
+    """
+    Writes a batch of queued pings, pings within the heartbeat gap of each other are written together
+    :param db: the greenhouse database
+    :param timestamps: the timestamps of the pings
+    :param heartbeat_gap: the heartbeat gap in milliseconds
+    :return: None
+    """
+    timestamps = sorted(timestamps)
+    start = 0
+
+    for i in range(1, len(timestamps) + 1):
+        if i == len(timestamps) or timestamps[i] - timestamps[i - 1] > heartbeat_gap:
+            record_ping(db, timestamps[start], timestamps[i - 1], i - start, heartbeat_gap)
+            start = i
@@ -0,0 +1,16 @@
+from pyramid.response import Response
+from pyramid.view import view_config
+
+from sgreen2_web.metrics import CONTENT_TYPE
+
+
+@view_config(route_name="metrics", request_method="GET")
+def metrics(request):
+    """
+    Returns the request, Mongo command, ingestion queue and response cache metrics of this process in the
+    Prometheus text format
+    :return: a Pyramid response object
+    """
+    registry = request.registry
+    return Response(body=registry.metrics.render(registry.ingest_queue, registry.response_cache).encode("utf-8"),
+                    content_type=CONTENT_TYPE)
@@ -1,9 +1,10 @@
 import pymongo
-from bson import json_util
-from dateutil import parser
+from pymongo import ReturnDocument
+from pymongo.database import Database
 from pyramid.response import Response
 from pyramid.view import view_config, view_defaults
-from validate_email import validate_email
+
+from sgreen2_web.cache import SettingsCache
 
 
 @view_defaults(route_name="settings")
@@ -28,22 +29,35 @@ class RESTSettings(object):
 
     @staticmethod
     def __string_list_to_time_list(times_array) -> list:
+        # dateutil is imported when it's first needed so it doesn't slow down startup
+        from dateutil import parser
+
         for i in range(len(times_array)):
             parsed_time = parser.parse(times_array[i])
             times_array[i] = parsed_time.hour * 3600 + parsed_time.minute * 60
 
         return times_array
 
-    @view_config(request_method="GET", renderer="json")
-    def get(self):
+    @staticmethod
+    def __get_version(data: dict) -> str:
         """
-        Gets settings
-        :return: a JSON representation of the data
+        Gets the version of a settings document. _id is part of it so a reinitialized
+        settings collection never looks like the cached one
+        :param data: the settings document including _id and version
+        :return: the version as a string
         """
+        if data is None:
+            return "0"
 
-        # in MongoDB, _id has a timestamp embedded so sorting by _id descending gets the most recent
-        data = self.request.db.settings.find_one(projection={"_id": 0}, sort=[("_id", pymongo.DESCENDING)])
+        return str(data["_id"]) + "-" + str(data.get("version", 0))
 
+    @staticmethod
+    def __format_settings(data: dict) -> dict:
+        """
+        Formats a settings document for the response
+        :param data: the settings document or None if there are no settings
+        :return: the formatted settings
+        """
         if data is None:
             data = {
                 "is_manual_mode": False,
@@ -64,17 +78,66 @@ class RESTSettings(object):
                 "email_addresses": []
             }
 
+        data.pop("_id", None)
+        data.pop("version", None)
+
         # format times as strings
-        data["lights"]["start_time"] = self.__get_time_as_string(data["lights"]["start_time"])
-        data["lights"]["end_time"] = self.__get_time_as_string(data["lights"]["end_time"])
+        data["lights"]["start_time"] = RESTSettings.__get_time_as_string(data["lights"]["start_time"])
+        data["lights"]["end_time"] = RESTSettings.__get_time_as_string(data["lights"]["end_time"])
 
         for i in range(len(data["watering_times"])):
-            data["watering_times"][i] = self.__get_time_as_string(data["watering_times"][i])
+            data["watering_times"][i] = RESTSettings.__get_time_as_string(data["watering_times"][i])
 
         for i in range(len(data["error_flush_times"])):
-            data["error_flush_times"][i] = self.__get_time_as_string(data["error_flush_times"][i])
+            data["error_flush_times"][i] = RESTSettings.__get_time_as_string(data["error_flush_times"][i])
+
+        return data
 
-        return json_util.loads(json_util.dumps(data))
+    @staticmethod
+    def refresh_cache(db: Database, cache: SettingsCache, site: str = None) -> None:
+        """
+        Loads the settings into the cache if their version in the database changed. Also used to warm up the cache
+        :param db: the greenhouse database
+        :param cache: the settings cache
+        :param site: the site of the database, or None for the default database
+        :return: None
+        """
+        # in MongoDB, _id has a timestamp embedded so sorting by _id descending gets the most recent
+        latest = db.settings.find_one(projection={"version": 1}, sort=[("_id", pymongo.DESCENDING)])
+        cached = cache.get(site)
+
+        if cached is not None and cached[0] == RESTSettings.__get_version(latest):
+            cache.touch(site)
+        else:
+            data = db.settings.find_one(sort=[("_id", pymongo.DESCENDING)])
+            cache.set(RESTSettings.__get_version(data), RESTSettings.__format_settings(data), site)
+
+    @view_config(request_method="GET", renderer="json")
+    def get(self):
+        """
+        Gets settings. The formatted settings are cached in the process and
+        only reloaded when the version in the database changes
+        :return: a JSON representation of the data
+        """
+        cache = self.request.registry.settings_cache
+
+        if cache.needs_check(self.request.site):
+            self.refresh_cache(self.request.db, cache, self.request.site)
+
+        version, data = cache.get(self.request.site)
+        etag = "settings-" + version
+
+        # clients keep their copy but revalidate it every time, which is cheap with If-None-Match
+        if etag in self.request.if_none_match:
+            response = Response(status_code=304)
+            response.etag = etag
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+
+        self.request.response.etag = etag
+        self.request.response.headers["Cache-Control"] = "no-cache"
+
+        return data
 
     @view_config(request_method="POST", renderer="json")
     def post(self):
@@ -101,6 +164,9 @@ class RESTSettings(object):
                 raise Exception("minimum soil moisture must be less than maximum soil moisture")
 
             if "email_addresses" in data:
+                # validate_email is imported when it's first needed so it doesn't slow down startup
+                from validate_email import validate_email
+
                 for email in data["email_addresses"]:
                     if not validate_email(email):
                         raise Exception(email + " is not a valid email address")
@@ -110,10 +176,20 @@ class RESTSettings(object):
             data["watering_times"].sort()
             data["error_flush_times"].sort()
 
-            # update many with no filtering b/c I only expect one document in the collection
-            self.request.db.settings.update_many({}, {"$set": data}, upsert=True)
+            data.pop("version", None)
+
+            # only one document is expected in the collection, update the most recent one (the one GET reads)
+            # and bump its version so the settings cache of every process reloads it
+            updated = self.request.get_db("control").settings.find_one_and_update(
+                {}, {"$set": data, "$inc": {"version": 1}},
+                sort=[("_id", pymongo.DESCENDING)],
+                upsert=True,
+                return_document=ReturnDocument.AFTER)
 
-            return json_util.loads(json_util.dumps(data))
+            self.request.registry.settings_cache.set(self.__get_version(updated), self.__format_settings(updated),
+                                                     self.request.site)
+
+            return data
         except Exception as err:
             return Response(status_code=400, json_body={"message": str(err)})
 
@@ -124,6 +200,8 @@ class RESTSettings(object):
         """
         data = dict()
         error = ""
+        from dateutil import parser
+
         try:
             data = self.request.json_body
 